@@ -2,31 +2,84 @@
 Helmet Sanitizer Kiosk - PayMongo QRPh Integration (COMPLETE FIXED VERSION)
 """
 
-from flask import Flask, render_template, jsonify, url_for, request, redirect, session
-import requests
+from flask import Flask, render_template, jsonify, url_for, request, redirect, session, Response, stream_with_context
+import click
+import aiohttp
+import asyncio
+import concurrent.futures
 import os
 import qrcode
+import qrcode.image.svg
 import base64
+import hashlib
 import time
 import sqlite3
 import json
+import logging
+import logging.handlers
+import atexit
+import csv
 import re
+import math
+import random
+import socket
 import threading
-from io import BytesIO
+import queue
+from io import BytesIO, StringIO
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from array import array
+from collections import namedtuple, OrderedDict, deque
 from functools import wraps
+from itertools import groupby
 from urllib.parse import urlencode
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+# ================= LOGGING =================
+# Handlers (console + size-rotated file) run on a QueueListener thread, so a
+# log call on the request/relay path only enqueues the record.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "logs/kiosk.log")  # empty disables the file
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_FORMAT = "%(asctime)s %(levelname)-7s [%(threadName)s] %(message)s"
+
+
+def setup_logging():
+    """Route all logging through a queue drained by a background listener."""
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    # Root gets the queue handler so werkzeug's request log is off-thread too
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+
+setup_logging()
+log = logging.getLogger("kiosk")
+
 # GPIO Library (gpiozero for Raspberry Pi 5)
 try:
     from gpiozero import OutputDevice
-    print("✅ gpiozero Module Loaded")
+    log.info("✅ gpiozero Module Loaded")
 except ImportError:
-    print("⚠️ gpiozero Not Available - Running in Simulation Mode")
+    log.warning("⚠️ gpiozero Not Available - Running in Simulation Mode")
     OutputDevice = None
 
 # --- Flask App Configuration ---
@@ -58,12 +111,12 @@ try:
 "pump_right": OutputDevice(21, active_high=False, initial_value=False),
 
     }
-    print("✅ Relay devices initialized:", list(relay_devices.keys()))
+    log.info("✅ Relay devices initialized: %s", list(relay_devices.keys()))
     RPI_AVAILABLE = True
 
 except Exception as e:
-    print("❌ GPIO initialization failed:", e)
-    print("⚠️ Running in Simulation Mode")
+    log.error("❌ GPIO initialization failed: %s", e)
+    log.warning("⚠️ Running in Simulation Mode")
     relay_devices = {}
     RPI_AVAILABLE = False
 
@@ -113,53 +166,20 @@ def init_relay_devices():
 
         
 def set_relay(relay_name, state):
-    """
-    Control relay: state = 1 (ON) or 0 (OFF)
-    
-    Active LOW logic:
-    - relay.on() = GPIO LOW = Relay ON
-    - relay.off() = GPIO HIGH = Relay OFF
-    """
-    global relay_devices, RPI_AVAILABLE
-    
-    if not RPI_AVAILABLE:
-        print(f"[SIM] {relay_name} -> {'ON' if state else 'OFF'}")
-        return
-    
-    if not relay_devices:
-        print(f"❌ No relays initialized!")
-        return
-    
-    if relay_name not in relay_devices:
-        print(f"❌ Relay '{relay_name}' not found")
-        print(f"   Available: {list(relay_devices.keys())}")
-        return
-
-    try:
-        if state == 1:
-            relay_devices[relay_name].on()
-            print(f"⚡ {relay_name.upper()} -> ON")
-        else:
-            relay_devices[relay_name].off()
-            print(f"⚡ {relay_name.upper()} -> OFF")
-    except Exception as e:
-        print(f"❌ Relay error on {relay_name}: {e}")
-        import traceback
-        traceback.print_exc()
+    """Control relay: state = 1 (ON) or 0 (OFF); a no-op if it already is."""
+    relay_controller.set(relay_name, state)
 
 
-def all_relays_off():
-    """Turn all relays OFF."""
-    for relay_name in GPIO_PINS.keys():
-        set_relay(relay_name, 0)
-    print("🔌 All relays OFF")
+def all_relays_off(force=False):
+    """Turn all relays OFF. force=True rewrites every pin even if its shadow is OFF."""
+    relay_controller.all(0, force=force)
+    log.info("🔌 All relays OFF")
 
 
 def all_relays_on():
     """Turn all relays ON."""
-    for relay_name in GPIO_PINS.keys():
-        set_relay(relay_name, 1)
-    print("⚡ All relays ON")
+    relay_controller.all(1)
+    log.info("⚡ All relays ON")
 
 
 def relay_on_timer_off(relay_name, duration_seconds):
@@ -169,931 +189,3725 @@ def relay_on_timer_off(relay_name, duration_seconds):
         relay_name: Name of relay to control ('brush', 'solenoid', 'blower', 'uv')
         duration_seconds: How long to keep relay ON before turning OFF
     """
-    print(f"\n⏱️ RELAY CYCLE: {relay_name.upper()}")
-    print(f"   Duration: {duration_seconds} seconds")
+    log.info("⏱️ RELAY CYCLE: %s (%s seconds)", relay_name.upper(), duration_seconds)
     
     try:
         # RELAY ON
-        print(f"   ✅ RELAY ON")
+        log.debug("✅ RELAY ON")
         set_relay(relay_name, 1)
         
         # TIMER
-        print(f"   ⏳ Waiting {duration_seconds} seconds...")
-        time.sleep(duration_seconds)
+        log.debug("⏳ Waiting %s seconds...", duration_seconds)
+        kiosk_clock.sleep(duration_seconds)
         
         # RELAY OFF
-        print(f"   ✅ RELAY OFF")
+        log.debug("✅ RELAY OFF")
         set_relay(relay_name, 0)
         
-        print(f"✅ {relay_name.upper()} cycle complete")
+        log.info("✅ %s cycle complete", relay_name.upper())
         
     except Exception as e:
-        print(f"❌ Error in relay cycle: {e}")
+        log.error("❌ Error in relay cycle: %s", e)
         set_relay(relay_name, 0)  # Safety: turn off on error
 
 
-def run_payment_relay_sequence():
-    """Run complete relay sequence after payment confirmed.
-    
-    PAYMENT → RELAY ON → TIMER → RELAY OFF (repeated for each phase)
-    
-    Timeline:
-    - BRUSH: 20 seconds
-    - SOLENOID: 5 seconds  
-    - BLOWER: 30 seconds
-    - UV: 30 seconds
-    """
-    
-    print("\n" + "="*60)
-    print("💳 PAYMENT CONFIRMED - STARTING RELAY SEQUENCE")
-    print("="*60)
-    
-    try:
-        # Ensure all relays start OFF
-        all_relays_off()
-        time.sleep(0.5)
-
-        # Start mist1 and mist2 (ON for entire cycle)
-        print("\n🌫️ Turning ON mist1 and mist2 for entire cycle")
-        set_relay("mist1", 1)
-        set_relay("mist2", 1)
-
-        # PHASE 1: BRUSH
-        print("\n📍 PHASE 1: BRUSH (20 seconds)")
-        relay_on_timer_off("brush", 20)
-
-        # PHASE 2: SOLENOID
-        print("\n📍 PHASE 2: SOLENOID (5 seconds)")
-        relay_on_timer_off("solenoid", 5)
-
-        # PHASE 2.5: PUMPS (start after solenoid, run for 20 seconds)
-        print("\n🚰 Starting pumps (pump_left, pump_middle, pump_right) for 20 seconds")
-        set_relay("pump_left", 1)
-        set_relay("pump_middle", 1)
-        set_relay("pump_right", 1)
-        time.sleep(20)
-        set_relay("pump_left", 0)
-        set_relay("pump_middle", 0)
-        set_relay("pump_right", 0)
-        print("✅ Pumps OFF after 20 seconds")
-
-        # PHASE 3: BLOWER
-        print("\n📍 PHASE 3: BLOWER (30 seconds)")
-        relay_on_timer_off("blower", 30)
-
-        # PHASE 4: UV
-        print("\n📍 PHASE 4: UV (30 seconds)")
-        relay_on_timer_off("uv", 30)
-
-        # Turn OFF mist1 and mist2 at end of cycle
-        print("\n🌫️ Turning OFF mist1 and mist2 at end of cycle")
-        set_relay("mist1", 0)
-        set_relay("mist2", 0)
-
-        print("\n" + "="*60)
-        print("✅ ALL RELAY PHASES COMPLETE!")
-        print("="*60)
-        
-    except Exception as e:
-        import traceback
-        print(f"\n❌ Error in relay sequence: {e}")
-        print(f"Traceback:\n{traceback.format_exc()}")
-        print("🛑 Emergency shutdown - turning all relays OFF")
-        all_relays_off()
-    
-    finally:
-        # Safety: ensure all relays are OFF
-        print("\n🔒 Safety shutdown - all relays OFF")
-        all_relays_off()
+# ========================================
+# CLOCK
+# ========================================
+# The relay engine and the sanitizer worker sleep and measure durations
+# through `kiosk_clock`, so simulation mode can run sanitization cycles faster
+# than real time. Hardware always uses the real clock. Database timestamps
+# never do: they come from now_ts(), which is always real time.
 
+SIM_TIME_SCALE = float(os.getenv("SIM_TIME_SCALE", "1"))  # simulation only: 60 = a minute per second, 0 = virtual time
 
-# In-memory payment tracking
-payments = {}
 
-# ========================================
-# DATABASE FUNCTIONS
-# ========================================
+class Clock:
+    """Real time: time.time / time.monotonic / time.sleep."""
 
-def init_db():
-    """Initialize SQLite database."""
-    conn = sqlite3.connect('helmet_sanitizer.db')
-    c = conn.cursor()
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            reference TEXT UNIQUE NOT NULL,
-            payment_method TEXT NOT NULL,
-            amount REAL NOT NULL,
-            currency TEXT DEFAULT 'PHP',
-            status TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            paid_at TIMESTAMP,
-            paymongo_id TEXT,
-            qr_code TEXT,
-            reference_id TEXT
-        )
-    ''')
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS sanitization_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            payment_id INTEGER,
-            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            completed_at TIMESTAMP,
-            duration INTEGER DEFAULT 55,
-            FOREIGN KEY (payment_id) REFERENCES payments (id)
-        )
-    ''')
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id INTEGER,
-            rating INTEGER NOT NULL CHECK(rating >= 1 AND rating <= 5),
-            feedback TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sanitization_sessions (id)
-        )
-    ''')
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS daily_stats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date DATE UNIQUE NOT NULL,
-            total_payments INTEGER DEFAULT 0,
-            total_revenue REAL DEFAULT 0,
-            successful_sanitizations INTEGER DEFAULT 0,
-            average_rating REAL DEFAULT 0,
-            qrph_payments INTEGER DEFAULT 0,
-            cash_payments INTEGER DEFAULT 0
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    print("✅ Database Initialized")
+    def time(self):
+        return time.time()
 
+    def monotonic(self):
+        return time.monotonic()
 
-def get_db():
-    """Get database connection."""
-    conn = sqlite3.connect('helmet_sanitizer.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
 
 
-def save_payment(reference, method, amount, status='PENDING', paymongo_id=None, qr_code=None, reference_id=None):
-    """Save payment to database."""
-    conn = get_db()
-    c = conn.cursor()
-    try:
-        c.execute('''
-            INSERT INTO payments (reference, payment_method, amount, status, paymongo_id, qr_code, reference_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (reference, method, amount, status, paymongo_id, qr_code, reference_id))
-        conn.commit()
-        payment_id = c.lastrowid
-        conn.close()
-        return payment_id
-    except sqlite3.IntegrityError:
-        conn.close()
-        return None
+class ScaledClock(Clock):
+    """Time that runs `scale` times faster than real time from creation."""
 
+    def __init__(self, scale):
+        self.scale = scale
+        self._wall_origin = time.time()
+        self._origin = time.monotonic()
 
-def update_payment_status(reference, status, paymongo_payment_id=None):
-    """Update payment status."""
-    conn = get_db()
-    c = conn.cursor()
-    paid_at = datetime.now() if status == 'PAID' else None
-    
-    if paymongo_payment_id:
-        c.execute('''
-            UPDATE payments 
-            SET status = ?, paid_at = ?, paymongo_id = ?
-            WHERE reference = ?
-        ''', (status, paid_at, paymongo_payment_id, reference))
-    else:
-        c.execute('''
-            UPDATE payments 
-            SET status = ?, paid_at = ?
-            WHERE reference = ?
-        ''', (status, paid_at, reference))
-    
-    conn.commit()
-    conn.close()
+    def _elapsed(self):
+        return (time.monotonic() - self._origin) * self.scale
 
+    def time(self):
+        return self._wall_origin + self._elapsed()
 
-def get_payment_by_reference(reference):
-    """Get payment by reference."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT * FROM payments WHERE reference = ?', (reference,))
-    payment = c.fetchone()
-    conn.close()
-    return dict(payment) if payment else None
+    def monotonic(self):
+        return self._origin + self._elapsed()
 
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.scale)
 
-def save_sanitization_session(payment_id):
-    """Create sanitization session."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO sanitization_sessions (payment_id, started_at)
-        VALUES (?, ?)
-    ''', (payment_id, datetime.now()))
-    session_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return session_id
-
-
-def complete_sanitization_session(session_id):
-    """Mark sanitization as complete."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''
-        UPDATE sanitization_sessions 
-        SET completed_at = ?
-        WHERE id = ?
-    ''', (datetime.now(), session_id))
-    conn.commit()
-    conn.close()
 
+class VirtualClock(Clock):
+    """Fully virtual time: sleep() advances the clock and returns at once."""
 
-def save_rating(session_id, rating, feedback=None):
-    """Save rating."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO ratings (session_id, rating, feedback)
-        VALUES (?, ?, ?)
-    ''', (session_id, rating, feedback))
-    conn.commit()
-    conn.close()
-
-
-def update_daily_stats():
-    """Update daily statistics."""
-    conn = get_db()
-    c = conn.cursor()
-    today = datetime.now().date()
-    
-    c.execute('''
-        SELECT 
-            COUNT(*) as total_payments,
-            COALESCE(SUM(amount), 0) as total_revenue,
-            SUM(CASE WHEN payment_method = 'QRPH' THEN 1 ELSE 0 END) as qrph_payments,
-            SUM(CASE WHEN payment_method = 'CASH' THEN 1 ELSE 0 END) as cash_payments
-        FROM payments 
-        WHERE DATE(created_at) = ? AND status = 'PAID'
-    ''', (today,))
-    payment_stats = c.fetchone()
-    
-    c.execute('''
-        SELECT COUNT(*) as successful_sanitizations
-        FROM sanitization_sessions
-        WHERE DATE(started_at) = ? AND completed_at IS NOT NULL
-    ''', (today,))
-    sanitization_stats = c.fetchone()
+    def __init__(self, start=None):
+        self._now = time.time() if start is None else start
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            return self._now
+
+    def monotonic(self):
+        return self.time()
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += max(seconds, 0)
+
+
+def make_clock(scale=SIM_TIME_SCALE):
+    """The clock for this process: scaled or virtual only in simulation mode."""
+    if scale == 1:
+        return Clock()
+    if RPI_AVAILABLE:
+        log.warning("⚠️ SIM_TIME_SCALE ignored: relays are real hardware")
+        return Clock()
+    log.info("⏩ Simulation clock: %s", "virtual time" if scale == 0 else f"{scale}x real time")
+    return VirtualClock() if scale == 0 else ScaledClock(scale)
+
+
+kiosk_clock = make_clock()
+
+
+# ========================================
+# RELAY CONTROLLER
+# ========================================
+
+class RelayController:
+    """Shadow state for every relay channel; only real transitions touch a pin.
     
-    c.execute('''
-        SELECT COALESCE(AVG(rating), 0) as average_rating
-        FROM ratings
-        WHERE DATE(created_at) = ?
-    ''', (today,))
-    rating_stats = c.fetchone()
-    
-    c.execute('''
-        INSERT INTO daily_stats 
-        (date, total_payments, total_revenue, successful_sanitizations, average_rating, qrph_payments, cash_payments)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET
-            total_payments = excluded.total_payments,
-            total_revenue = excluded.total_revenue,
-            successful_sanitizations = excluded.successful_sanitizations,
-            average_rating = excluded.average_rating,
-            qrph_payments = excluded.qrph_payments,
-            cash_payments = excluded.cash_payments
-    ''', (
-        today,
-        payment_stats[0] or 0,
-        payment_stats[1] or 0,
-        sanitization_stats[0] or 0,
-        rating_stats[0] or 0,
-        payment_stats[2] or 0,
-        payment_stats[3] or 0
-    ))
+    Channels are GPIO_PINS in order. State, last-change time and transition
+    counts live in fixed-size arrays indexed by channel, so a status read
+    never allocates per relay. apply() switches a group of relays as one
+    batch under one lock and one timestamp, skipping relays already in the
+    requested state. force=True rewrites every requested pin regardless of
+    the shadow, for safety shutdowns.
     
-    conn.commit()
-    conn.close()
+    Active LOW logic:
+    - relay.on() = GPIO LOW = Relay ON
+    - relay.off() = GPIO HIGH = Relay OFF
+    """
+
+    def __init__(self, names, devices, clock):
+        self.names = tuple(names)
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._devices = devices
+        self._clock = clock
+        self._state = array("b", [0] * len(self.names))  # devices start OFF (initial_value=False)
+        self._changed = array("d", [0.0] * len(self.names))
+        self._transitions = array("L", [0] * len(self.names))
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.skipped = 0
+
+    def apply(self, changes, force=False):
+        """Switch {relay: 0/1} as one batch. Returns the relays that changed."""
+        changed, on, off = [], [], []
+        with self._lock:
+            now = self._clock.time()
+            for name, state in changes.items():
+                i = self._index.get(name)
+                if i is None:
+                    log.error("❌ Relay '%s' not found (available: %s)", name, list(self.names))
+                    continue
+                state = 1 if state else 0
+                if self._state[i] == state and not force:
+                    self.skipped += 1
+                    continue
+                if not self._write(name, state):
+                    continue
+                self.writes += 1
+                if self._state[i] != state:
+                    self._state[i] = state
+                    self._changed[i] = now
+                    self._transitions[i] += 1
+                    changed.append(name)
+                    (on if state else off).append(name)
+        
+        if changed:
+            if RPI_AVAILABLE:
+                log.info("⚡ ON: %s | OFF: %s", ", ".join(on) or "-", ", ".join(off) or "-")
+            else:
+                log.debug("[SIM] ON: %s | OFF: %s", ", ".join(on) or "-", ", ".join(off) or "-")
+        return changed
+
+    def set(self, name, state):
+        return self.apply({name: state})
+
+    def all(self, state, force=False):
+        return self.apply({name: state for name in self.names}, force=force)
+
+    def is_on(self, name):
+        return bool(self._state[self._index[name]])
+
+    def snapshot(self):
+        """Current state, last change and transition count of every channel."""
+        with self._lock:
+            return [
+                {
+                    "name": name,
+                    "pin": GPIO_PINS.get(name),
+                    "state": "ON" if self._state[i] else "OFF",
+                    "last_change": self._changed[i] or None,
+                    "transitions": self._transitions[i]
+                }
+                for i, name in enumerate(self.names)
+            ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "on": [name for i, name in enumerate(self.names) if self._state[i]],
+                "writes": self.writes,
+                "skipped_writes": self.skipped,
+                "transitions": sum(self._transitions)
+            }
 
+    def _write(self, name, state):
+        """Drive one pin; False if the hardware write failed."""
+        if not RPI_AVAILABLE:
+            return True
+        device = self._devices.get(name)
+        if device is None:
+            log.error("❌ Relay '%s' not initialized", name)
+            return False
+        try:
+            device.on() if state else device.off()
+            return True
+        except Exception as e:
+            log.exception("❌ Relay error on %s: %s", name, e)
+            return False
+
+
+relay_controller = RelayController(GPIO_PINS.keys(), relay_devices, kiosk_clock)
 
-init_db()
 
 # ========================================
-# HELPER FUNCTIONS
+# RELAY TIMELINE
 # ========================================
-def run_sanitization_with_timer(session_id, payment_id, delay_seconds=2):
-    """
-    Start sanitization timer, then execute relay sequence.
+# The sanitization cycle is data, not code. Each phase switches its relays
+# ON `offset` seconds after every phase in `after` has finished (after the
+# cycle start when `after` is empty; a negative offset overlaps their tail)
+# and OFF `duration` seconds later. A duration of None keeps the relays on
+# until the last timed phase ends.
+
+RELAY_SETTLE_SECONDS = 0.5  # all relays OFF before the first phase
+RELAY_TIMELINE_FILE = os.getenv("RELAY_TIMELINE_FILE", "")  # JSON list of phases; empty uses the default
+
+RelayPhase = namedtuple("RelayPhase", "name relays offset duration after")
+
+DEFAULT_RELAY_TIMELINE = [
+    RelayPhase("mist", ("mist1", "mist2"), 0, None, ()),
+    RelayPhase("brush", ("brush",), 0, 20, ()),
+    RelayPhase("solenoid", ("solenoid",), 0, 5, ("brush",)),
+    RelayPhase("pumps", ("pump_left", "pump_middle", "pump_right"), 0, 20, ("solenoid",)),
+    RelayPhase("blower", ("blower",), 0, 30, ("pumps",)),
+    RelayPhase("uv", ("uv",), 0, 30, ("blower",)),
+]
+
+# phases: [(RelayPhase, start, end)] in start order
+# events: [(at, relay, state, phase name)] in firing order, OFFs before ONs at the same instant
+TimelinePlan = namedtuple("TimelinePlan", "phases events total")
+
+# What a phase actually did: planned window (seconds into the cycle) and the
+# epoch times (real clock, like every *_ts column) its relays were switched
+# ON and OFF
+PhaseTiming = namedtuple("PhaseTiming", "phase nominal_start nominal_seconds started_ts ended_ts")
+
+
+class TimelineError(ValueError):
+    """A relay timeline failed validation; problems lists every issue found."""
+
+    def __init__(self, problems):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+def parse_timeline(items):
+    """Build RelayPhases from JSON objects: name, relays, offset, duration, after."""
+    if not isinstance(items, list):
+        raise TimelineError(["timeline must be a list of phases"])
+    
+    phases = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get("name"):
+            raise TimelineError([f"phase #{i + 1}: expected an object with a name"])
+        relays = item.get("relays", item["name"])
+        after = item.get("after", ())
+        phases.append(RelayPhase(
+            str(item["name"]),
+            (relays,) if isinstance(relays, str) else tuple(relays),
+            item.get("offset", 0),
+            item.get("duration"),
+            (after,) if isinstance(after, str) else tuple(after)
+        ))
+    return phases
+
+
+def plan_timeline(phases):
+    """Validate a timeline and lay it out on the clock without touching relays.
     
-    Flow:
-    1. Payment confirmed → Create session
-    2. Wait for delay (default 2 seconds) - sanitization "prepares"
-    3. When timer starts → Run relay sequence
-    4. Mark session complete
+    Returns a TimelinePlan. Raises TimelineError for unknown relays or
+    dependencies, dependency cycles, bad offsets/durations, phases starting
+    before the cycle, or one relay driven by two overlapping phases.
     """
-    print(f"\n⏱️ SANITIZATION TIMER STARTED")
-    print(f"   Session: {session_id}")
-    print(f"   Waiting {delay_seconds} seconds before relay sequence...")
+    problems = []
+    names = {p.name for p in phases}
+    by_name = {}
+    for phase in phases:
+        if phase.name in by_name:
+            problems.append(f"{phase.name}: duplicate phase name")
+        by_name[phase.name] = phase
+        if not phase.relays:
+            problems.append(f"{phase.name}: no relays")
+        for relay in phase.relays:
+            if relay not in GPIO_PINS:
+                problems.append(f"{phase.name}: unknown relay '{relay}'")
+        if isinstance(phase.offset, bool) or not isinstance(phase.offset, (int, float)):
+            problems.append(f"{phase.name}: offset must be a number of seconds")
+        if phase.duration is not None and (isinstance(phase.duration, bool)
+                                           or not isinstance(phase.duration, (int, float))
+                                           or phase.duration <= 0):
+            problems.append(f"{phase.name}: duration must be a positive number of seconds or null")
+        for dep in phase.after:
+            if dep not in names:
+                problems.append(f"{phase.name}: depends on unknown phase '{dep}'")
+    for phase in phases:
+        for dep in phase.after:
+            if dep in by_name and by_name[dep].duration is None:
+                problems.append(f"{phase.name}: cannot follow '{dep}', which runs until the end")
+    if not any(p.duration is not None for p in phases):
+        problems.append("timeline needs at least one phase with a duration")
+    if problems:
+        raise TimelineError(problems)
     
-    # Wait for sanitization to prepare
-    time.sleep(delay_seconds)
+    # Resolve start/end times in dependency order
+    starts, ends, visiting = {}, {}, set()
     
-    print(f"\n🚀 SANITIZATION TIMER REACHED - STARTING RELAY SEQUENCE")
+    def resolve(name):
+        if name in starts:
+            return
+        if name in visiting:
+            raise TimelineError([f"{name}: dependency cycle"])
+        visiting.add(name)
+        phase = by_name[name]
+        for dep in phase.after:
+            resolve(dep)
+        starts[name] = max((ends[dep] for dep in phase.after), default=0) + phase.offset
+        if phase.duration is not None:
+            ends[name] = starts[name] + phase.duration
+        visiting.discard(name)
     
-    # Now execute relay sequence
-    try:
-        run_payment_relay_sequence()
-    except Exception as e:
-        print(f"❌ Error in relay sequence: {e}")
-    finally:
-        # Mark sanitization complete
-        complete_sanitization_session(session_id)
-        update_daily_stats()
-        print(f"✅ Sanitization session {session_id} complete")
-
-
-def trigger_sanitizer_background(session_id, delay_seconds=2):
-    """Run sanitizer in background thread with timer delay."""
-    thread = threading.Thread(
-        target=run_sanitization_with_timer,
-        args=(session_id, None, delay_seconds),
-        daemon=True,
-        name=f"sanitizer-{session_id}"
+    for phase in phases:
+        resolve(phase.name)
+    total = max(ends.values())
+    for phase in phases:
+        if phase.duration is None:
+            ends[phase.name] = total
+        if starts[phase.name] < 0:
+            problems.append(f"{phase.name}: starts {-starts[phase.name]}s before the cycle")
+        elif starts[phase.name] >= ends[phase.name]:
+            problems.append(f"{phase.name}: starts after the last timed phase ends")
+    
+    # A relay shared by overlapping phases would be switched off by the first to end
+    windows = {}
+    for phase in phases:
+        for relay in phase.relays:
+            windows.setdefault(relay, []).append((starts[phase.name], ends[phase.name], phase.name))
+    for relay, spans in windows.items():
+        spans.sort()
+        for (_, prev_end, prev), (start, _, name) in zip(spans, spans[1:]):
+            if start < prev_end:
+                problems.append(f"{name}: relay '{relay}' is still on for '{prev}'")
+    if problems:
+        raise TimelineError(problems)
+    
+    ordered = sorted(phases, key=lambda p: (starts[p.name], ends[p.name]))
+    events = sorted(
+        [(starts[p.name], relay, 1, p.name) for p in phases for relay in p.relays]
+        + [(ends[p.name], relay, 0, p.name) for p in phases for relay in p.relays],
+        key=lambda e: (e[0], e[2])
     )
-    thread.start()
-    print(f"🔄 Sanitization timer thread started for session {session_id}")
+    return TimelinePlan([(p, starts[p.name], ends[p.name]) for p in ordered], events, total)
 
 
-def mark_payment_as_paid(ref, payment_db_id):
-    """Mark payment as paid and start sanitization timer."""
-    # Update payment status
-    update_payment_status(ref, "PAID")
-    
-    # Create sanitization session
-    session_id = save_sanitization_session(payment_db_id)
+def timeline_summary(plan):
+    """JSON-friendly dry run of a plan: phase windows, events and cycle time."""
+    cycle = RELAY_SETTLE_SECONDS + plan.total
+    return {
+        "total_seconds": plan.total,
+        "cycle_seconds": cycle,
+        "cycles_per_hour": round(3600 / cycle, 1),
+        "phases": [
+            {"name": p.name, "relays": list(p.relays), "start": start, "end": end}
+            for p, start, end in plan.phases
+        ],
+        "events": [
+            {"at": at, "relay": relay, "state": "ON" if state else "OFF", "phase": name}
+            for at, relay, state, name in plan.events
+        ]
+    }
+
+
+def load_relay_timeline(path=RELAY_TIMELINE_FILE):
+    """Read the timeline from a JSON file, or return the built-in default."""
+    if not path:
+        return list(DEFAULT_RELAY_TIMELINE)
+    with open(path, encoding="utf-8") as f:
+        try:
+            items = json.load(f)
+        except json.JSONDecodeError as e:
+            raise TimelineError([f"{path}: invalid JSON ({e})"]) from e
+    return parse_timeline(items)
+
+
+def run_relay_timeline(plan, clock=None, timings=None):
+    """Drive the relays through a plan from one timer loop.
     
-    # Update memory
-    if ref in payments:
-        payments[ref]["status"] = "PAID"
-        payments[ref]["session_id"] = session_id
+    Every event is scheduled against the cycle start on the monotonic clock
+    (kiosk_clock unless another is given), so overlapping phases need no
+    extra threads and sleeps do not drift. A PhaseTiming is appended to
+    `timings` (if given) as each phase switches OFF, so a cycle that fails
+    halfway still reports the phases it finished. Its times are real epoch
+    seconds, comparable with the payment's paid_ts, whatever `clock` is.
+    """
+    clock = clock or kiosk_clock
+    windows = {p.name: (start, end) for p, start, end in plan.phases}
+    switched_on = {}
+    started = clock.monotonic()
+    for at, group in groupby(plan.events, key=lambda e: e[0]):
+        group = list(group)
+        clock.sleep(started + at - clock.monotonic())
+        
+        # One batch per instant; a relay handed from one phase to the next stays ON
+        relay_controller.apply({relay: state for _, relay, state, _ in group})
+        now = time.time()
+        for name, state in dict.fromkeys((e[3], e[2]) for e in group):
+            log.info("📍 %.1fs %s %s", at, name.upper(), "ON" if state else "OFF")
+            if timings is None:
+                continue
+            if state:
+                switched_on[name] = now
+            elif name in switched_on:
+                start, end = windows[name]
+                timings.append(PhaseTiming(name, start, end - start, switched_on.pop(name), now))
+
+
+relay_plan = plan_timeline(load_relay_timeline())
+log.info("🗓️ Relay timeline: %s phase(s), %.1fs per cycle", len(relay_plan.phases), RELAY_SETTLE_SECONDS + relay_plan.total)
+
+
+def run_payment_relay_sequence(plan=None, clock=None, timings=None):
+    """Run the sanitization relay timeline after payment is confirmed.
     
-    print(f"\n💳 PAYMENT CONFIRMED - Session {session_id}")
-    print(f"   Starting sanitization timer (2 second delay before relay sequence)...")
+    Uses relay_plan (DEFAULT_RELAY_TIMELINE or RELAY_TIMELINE_FILE) and
+    kiosk_clock unless others are given. Every relay is OFF before and
+    after the cycle. Returns the PhaseTimings of the phases that ran, also
+    appended to `timings` if given. A failure switches every relay OFF and
+    is re-raised; `timings` then holds the phases finished before it.
+    """
+    plan = plan or relay_plan
+    clock = clock or kiosk_clock
+    timings = [] if timings is None else timings
+    log.info("💳 PAYMENT CONFIRMED - STARTING RELAY SEQUENCE (%.1fs)", plan.total)
     
-    # Start sanitization timer in background (2 second delay before relays start)
-    trigger_sanitizer_background(session_id, delay_seconds=2)
+    try:
+        # Ensure all relays start OFF
+        all_relays_off()
+        clock.sleep(RELAY_SETTLE_SECONDS)
+        
+        run_relay_timeline(plan, clock, timings)
+        log.info("✅ ALL RELAY PHASES COMPLETE!")
+        
+    except Exception as e:
+        log.exception("❌ Error in relay sequence: %s", e)
+        log.warning("🛑 Emergency shutdown - turning all relays OFF")
+        all_relays_off(force=True)
+        raise
     
-    print(f"✅ Payment {ref} completed!")
+    finally:
+        # Safety: ensure all relays are OFF (a no-op when the timeline ended cleanly)
+        log.info("🔒 Safety shutdown - all relays OFF")
+        all_relays_off()
     
-    return jsonify({"status": "PAID", "session_id": session_id})
+    return timings
 
 
-def login_required(f):
-    """Admin login decorator."""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'admin_logged_in' not in session:
-            return redirect(url_for('admin_login'))
-        return f(*args, **kwargs)
-    return decorated_function
+# ========================================
+# UPSTREAM CLIENTS (PAYMONGO, SOLANA RPC)
+# ========================================
 
+PAYMONGO_POOL_SIZE = int(os.getenv("PAYMONGO_POOL_SIZE", "4"))
+PAYMONGO_RETRIES = int(os.getenv("PAYMONGO_RETRIES", "3"))
+PAYMONGO_BACKOFF = float(os.getenv("PAYMONGO_BACKOFF", "0.5"))  # 0.5s, 1s, 2s...
+PAYMONGO_TIMEOUT = (5, 10)  # (connect, read) seconds
 
-def create_paymongo_headers():
-    """Create authenticated headers for PayMongo API."""
-    auth_string = f"{PAYMONGO_SECRET_KEY}:"
-    auth_b64 = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-    
-    return {
-        "accept": "application/json",
-        "Content-Type": "application/json",
-        "authorization": f"Basic {auth_b64}"
-    }
+SOLANA_RPC_URL = os.getenv("SOLANA_RPC_URL", f"https://api.{SOLANA_NETWORK}.solana.com")
+SOLANA_RPC_POOL_SIZE = 2
+SOLANA_RPC_TIMEOUT = (5, 10)
 
-# ========================================
-# KIOSK ROUTES
-# ========================================
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
 
-@app.route("/")
-def home():
-    """Main kiosk screen."""
-    return render_template("index.html")
+# PayMongo circuit breaker: trip when >= GATEWAY_ERROR_RATE of the calls in
+# the last GATEWAY_WINDOW_SECONDS failed (given at least GATEWAY_MIN_CALLS),
+# then fail fast for GATEWAY_COOLDOWN_SECONDS before letting a trial through.
+GATEWAY_WINDOW_SECONDS = int(os.getenv("GATEWAY_WINDOW_SECONDS", "120"))
+GATEWAY_MIN_CALLS = int(os.getenv("GATEWAY_MIN_CALLS", "5"))
+GATEWAY_ERROR_RATE = float(os.getenv("GATEWAY_ERROR_RATE", "0.5"))
+GATEWAY_COOLDOWN_SECONDS = int(os.getenv("GATEWAY_COOLDOWN_SECONDS", "30"))
+GATEWAY_UNAVAILABLE_MESSAGE = "QR temporarily unavailable, use cash"
 
 
-@app.route("/pay/qr")
-def qr_payment():
-    """QRPh payment screen."""
-    return render_template("qr_payment.html")
+class UpstreamError(Exception):
+    """An outbound call failed at the network level or timed out."""
 
 
-@app.route("/solana_pay")
-def solana_pay():
-    """Render Solana Pay payment page."""
-    return render_template("solana_payment.html")
+class CircuitOpenError(UpstreamError):
+    """The circuit breaker is open, so the call was not attempted."""
 
 
-@app.route("/pay/cash")
-def cash_payment():
-    """Cash payment screen."""
-    return render_template("cash_payment.html")
+class CircuitBreaker:
+    """Rolling-window circuit breaker that also tracks call latency.
+    
+    Keeps (time, latency_ms, ok) for the calls of the last `window`
+    seconds. Closed: everything goes through, and the breaker opens once
+    at least min_calls were made and the error rate reaches error_rate.
+    Open: calls fail fast until `cooldown` has passed. Half-open: one trial
+    call goes through; success closes the breaker, failure reopens it.
+    """
 
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, window=120, min_calls=5, error_rate=0.5, cooldown=30, max_samples=1000):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._trial_in_flight = False
+        self._calls = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may go out now (claims the half-open trial)."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def available(self):
+        """True unless the breaker is open and still cooling down."""
+        with self._lock:
+            return self.state != self.OPEN or time.monotonic() - self.opened_at >= self.cooldown
+
+    def record(self, latency_ms, ok):
+        with self._lock:
+            now = time.monotonic()
+            self._calls.append((now, latency_ms, ok))
+            self._prune(now)
+            
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = False
+                if ok:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                    log.info("✅ %s circuit closed", self.name)
+                else:
+                    self._open(now)
+            elif self.state == self.CLOSED and len(self._calls) >= self.min_calls:
+                errors = sum(1 for _, _, call_ok in self._calls if not call_ok)
+                if errors / len(self._calls) >= self.error_rate:
+                    self._open(now)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            latencies = [latency for _, latency, _ in self._calls]
+            errors = sum(1 for _, _, ok in self._calls if not ok)
+            summary = latency_summary(latencies)
+            
+            return {
+                "state": self.state,
+                "available": self.state != self.OPEN or now - self.opened_at >= self.cooldown,
+                "retry_in": round(max(self.cooldown - (now - self.opened_at), 0), 1) if self.state == self.OPEN else None,
+                "window_seconds": self.window,
+                "calls": len(latencies),
+                "error_rate": round(errors / len(latencies), 3) if latencies else None,
+                **{f"p{p}_ms": summary[f"p{p}"] for p in (50, 95, 99)},
+                "times_opened": self.times_opened,
+                "rejected": self.rejected
+            }
 
-@app.route("/rating/<session_id>")
-def rating_page(session_id):
-    """Rating page."""
-    return render_template("rating.html", session_id=session_id)
+    def _prune(self, now):
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
 
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        log.warning("🚫 %s circuit opened - failing fast for %ss", self.name, self.cooldown)
 
-@app.route("/debug")
-@login_required
-def debug_page():
-    """Webhook debugger page."""
-    return render_template("debug.html")
 
-# ========================================
-# PAYMONGO QRPh PAYMENT
-# ========================================
+class UpstreamResponse:
+    """Buffered response handed back across the event-loop boundary."""
+    __slots__ = ("status_code", "text", "headers")
 
-@app.route("/create_payment", methods=["POST"])
-def create_payment():
-    """Create PayMongo QRPh payment."""
-    reference = f"helmet-{int(time.time())}-{os.urandom(3).hex()}"
-    amount = PAYMENT_AMOUNT
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncUpstream:
+    """Event loop on a dedicated thread that runs every outbound HTTP call.
     
-    try:
-        headers = create_paymongo_headers()
-        
-        # Create QRPh payment
-        payload = {
-            "data": {
-                "attributes": {
-                    "kind": "instore",
-                    "amount": int(amount * 100),
-                    "currency": "PHP",
-                    "reference_number": reference,
-                    "description": f"Helmet Sanitization - Ref: {reference}",
-                    "metadata": {
-                        "reference_number": reference,
-                        "product": "helmet_sanitization",
-                        "kiosk_id": "helmet_kiosk_001"
-                    }
-                }
-            }
-        }
-        
-        print(f"🔵 Creating PayMongo QRPh for ₱{amount}")
-        print(f"   Reference: {reference}")
-        
-        # Call the QRPh endpoint
-        response = requests.post(
-            f"{PAYMONGO_API_URL}/qrph/generate",
-            json=payload,
-            headers=headers,
-            timeout=10
-        )
-        
-        print(f"   Response Status: {response.status_code}")
+    Clients keep one aiohttp session (and connection pool) per upstream on
+    this loop, so a slow Solana RPC node cannot use up PayMongo's
+    connections. Flask threads call run()/gather(), which block only the
+    caller, with a deadline; gather() issues calls concurrently.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="upstream-loop", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and wait for its result."""
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise UpstreamError(f"Upstream call timed out after {timeout}s")
+
+    def gather(self, *coros, timeout=None):
+        """Run coroutines concurrently; results in order, exceptions returned in place."""
+        async def _gather():
+            return await asyncio.gather(*coros, return_exceptions=True)
+        return self.run(_gather(), timeout)
+
+    def session(self, name, factory):
+        """Shared aiohttp session for an upstream, created by factory() on
+        first use. Must be called on the loop."""
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            session = self._sessions[name] = factory()
+        return session
+
+    def close(self):
+        if self._thread is None or not self._thread.is_alive():
+            return
         
-        if response.status_code not in [200, 201]:
-            print(f"❌ PayMongo Error: {response.text}")
-            return jsonify({
-                "error": "Payment gateway error", 
-                "details": response.text
-            }), 400
+        async def _close():
+            for session in self._sessions.values():
+                await session.close()
+            self._sessions.clear()
         
-        response_data = response.json()
+        try:
+            self.run(_close(), timeout=5)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+
+class PayMongoClient:
+    """Keep-alive client for the PayMongo API, running on AsyncUpstream.
+    
+    Auth headers are built once and the session keeps the TCP+TLS
+    connection to api.paymongo.com alive between payments. Connection
+    failures are retried for every method (nothing reached PayMongo); read
+    errors and 429/5xx responses only for idempotent methods, so a POST
+    that may have created a QR code is never sent twice. Backoff is
+    exponential and honours Retry-After. Every request goes through
+    `breaker`, which fails fast with CircuitOpenError while PayMongo is
+    degraded.
+    """
+
+    def __init__(self, upstream, base_url, headers, breaker, pool_size=4, retries=3, backoff=0.5, timeout=(5, 10)):
+        self.upstream = upstream
+        self.breaker = breaker
+        self.base_url = base_url.rstrip("/")
+        self.headers = headers
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def _session(self):
+        return self.upstream.session("paymongo", lambda: aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        ))
+
+    async def request_async(self, method, path, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"PayMongo circuit open: {GATEWAY_UNAVAILABLE_MESSAGE}")
         
-        # Extract QR code from response
-        qrph_data = response_data.get('data', {})
-        qrph_id = qrph_data.get('id')
-        attributes = qrph_data.get('attributes', {})
+        started = time.monotonic()
+        ok = False
+        try:
+            response = await self._request_with_retries(method, path, **kwargs)
+            ok = response.status_code < 500 and response.status_code != 429
+            return response
+        finally:
+            self.breaker.record((time.monotonic() - started) * 1000, ok)
+
+    async def _request_with_retries(self, method, path, **kwargs):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        idempotent = method in IDEMPOTENT_METHODS
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * (2 ** attempt)
+            try:
+                async with self._session().request(method, url, **kwargs) as response:
+                    text = await response.text()
+                    if response.status in RETRY_STATUSES and idempotent and attempt < self.retries:
+                        retry_after = response.headers.get("Retry-After", "")
+                        await asyncio.sleep(float(retry_after) if retry_after.isdigit() else delay)
+                        continue
+                    return UpstreamResponse(response.status, text, dict(response.headers))
+            except aiohttp.ClientConnectorError as e:
+                if attempt >= self.retries:
+                    raise UpstreamError(f"PayMongo unreachable: {e}") from e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not idempotent or attempt >= self.retries:
+                    raise UpstreamError(f"PayMongo request failed: {e!r}") from e
+            await asyncio.sleep(delay)
+
+    def request(self, method, path, **kwargs):
+        # Worst case: every attempt times out, plus the backoff between them
+        deadline = sum(self.timeout) * (self.retries + 1) + self.backoff * (2 ** (self.retries + 1))
+        return self.upstream.run(self.request_async(method, path, **kwargs), timeout=deadline)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, json=None, **kwargs):
+        return self.request("POST", path, json=json, **kwargs)
+
+
+class SolanaRPCClient:
+    """JSON-RPC client for a Solana node, running on AsyncUpstream."""
+
+    def __init__(self, upstream, url, pool_size=2, timeout=(5, 10)):
+        self.upstream = upstream
+        self.url = url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._ids = 0
+
+    async def call_async(self, method, params=None):
+        self._ids += 1
+        session = self.upstream.session("solana", lambda: aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        ))
+        payload = {"jsonrpc": "2.0", "id": self._ids, "method": method, "params": params or []}
+        try:
+            async with session.post(self.url, json=payload) as response:
+                body = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise UpstreamError(f"Solana RPC {method} failed: {e!r}") from e
+        if body.get("error"):
+            raise UpstreamError(f"Solana RPC {method} error: {body['error']}")
+        return body.get("result")
+
+    async def signature_statuses_async(self, signatures):
+        """{signature: status or None} for up to 256 signatures in one call."""
+        result = await self.call_async("getSignatureStatuses", [signatures, {"searchTransactionHistory": True}])
+        return dict(zip(signatures, (result or {}).get("value") or [None] * len(signatures)))
+
+    def call(self, method, params=None):
+        return self.upstream.run(self.call_async(method, params), timeout=sum(self.timeout) + 1)
+
+    def signature_statuses(self, signatures):
+        return self.upstream.run(self.signature_statuses_async(signatures), timeout=sum(self.timeout) + 1)
+
+
+def signature_confirmed(status):
+    """True if a getSignatureStatuses entry is a successful, confirmed transaction."""
+    return bool(status) and status.get("err") is None and \
+        status.get("confirmationStatus") in ("confirmed", "finalized")
+
+
+upstream = AsyncUpstream()
+solana_rpc = SolanaRPCClient(upstream, SOLANA_RPC_URL, pool_size=SOLANA_RPC_POOL_SIZE, timeout=SOLANA_RPC_TIMEOUT)
+
+
+# ========================================
+# PAYMENT STATUS CACHE
+# ========================================
+
+PAYMENT_CACHE_SIZE = int(os.getenv("PAYMENT_CACHE_SIZE", "512"))
+PAYMENT_CACHE_TTL = int(os.getenv("PAYMENT_CACHE_TTL", "300"))  # seconds
+
+# Batch status lookups: references per request, and per IN (...) query so
+# we stay under SQLite's bound-parameter limit (999 on older builds).
+STATUS_BATCH_MAX = 1000
+STATUS_BATCH_CHUNK = 500
+
+# A cached record is never replaced by one in an earlier state, so a slow
+# read-through that saw PENDING cannot clobber a confirmation written after it.
+PAYMENT_STATUS_RANK = {"PENDING": 0, "FAILED": 1, "EXPIRED": 1, "PAID": 2}
+
+
+class PaymentRecord:
+    """Compact in-memory view of a payment's status.
+
+    Records are replaced, never mutated, so etag (the version served to
+    status pollers) is fixed at construction.
+    """
+    __slots__ = ("reference", "id", "status", "method", "amount", "session_id", "etag", "expires_at")
+
+    def __init__(self, reference, id, status, method, amount=None, session_id=None):
+        self.reference = reference
+        self.id = id
+        self.status = status
+        self.method = method
+        self.amount = amount
+        self.session_id = session_id
+        self.etag = f"{id}-{status}-{session_id or 0}"
+        self.expires_at = 0.0
+
+
+class PaymentCache:
+    """Bounded LRU cache of PaymentRecords with a per-entry TTL.
+
+    Writers (payment creation, confirm_payment) put records after their
+    transaction commits; status endpoints read through get_payment_status().
+    """
+
+    def __init__(self, maxsize=512, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, reference):
+        with self._lock:
+            record = self._entries.get(reference)
+            if record is None:
+                self.misses += 1
+                return None
+            if record.expires_at < time.monotonic():
+                del self._entries[reference]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(reference)
+            self.hits += 1
+            return record
+
+    def put(self, record):
+        with self._lock:
+            current = self._entries.get(record.reference)
+            if current is not None and (PAYMENT_STATUS_RANK.get(current.status, 0)
+                                        > PAYMENT_STATUS_RANK.get(record.status, 0)):
+                return current
+            record.expires_at = time.monotonic() + self.ttl
+            self._entries[record.reference] = record
+            self._entries.move_to_end(record.reference)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return record
+
+    def invalidate(self, reference):
+        with self._lock:
+            self._entries.pop(reference, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+payment_cache = PaymentCache(maxsize=PAYMENT_CACHE_SIZE, ttl=PAYMENT_CACHE_TTL)
+
+
+# ========================================
+# WEBHOOK REFERENCE INDEX
+# ========================================
+
+REFERENCE_INDEX_SIZE = int(os.getenv("REFERENCE_INDEX_SIZE", "4096"))
+REFERENCE_INDEX_WARM_HOURS = int(os.getenv("REFERENCE_INDEX_WARM_HOURS", "24"))
+
+
+class ReferenceIndex:
+    """In-process map from payment identifiers to our reference.
+
+    Keys are (kind, value) pairs where kind is "reference", "paymongo_id"
+    (the QRPh id) or "reference_id", so the webhook can resolve whichever
+    identifier PayMongo sends in O(1) before falling back to SQL. Bounded
+    LRU; each payment uses up to three entries.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, reference, paymongo_id=None, reference_id=None):
+        with self._lock:
+            for key in (("reference", reference), ("paymongo_id", paymongo_id), ("reference_id", reference_id)):
+                if key[1]:
+                    self._keys[key] = reference
+                    self._keys.move_to_end(key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def resolve(self, kind, value):
+        """Our reference for an identifier, or None if not indexed."""
+        if not value:
+            return None
+        with self._lock:
+            reference = self._keys.get((kind, value))
+            if reference is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return reference
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._keys), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+reference_index = ReferenceIndex(maxsize=REFERENCE_INDEX_SIZE)
+
+
+# ========================================
+# PAYMENT STATUS NOTIFICATIONS
+# ========================================
+
+STATUS_STREAM_MAX_SECONDS = 600     # same as the kiosk's 10 minute QR window
+STATUS_KEEPALIVE_SECONDS = 15
+LONG_POLL_MAX_SECONDS = 30
+
+
+class StatusWaiters:
+    """Per-reference wake-ups for clients waiting on a payment status change.
+
+    Waiters register with watch() *before* reading the current status, so a
+    notify() that lands between the read and the wait still wakes them.
+    notify() hands the current event to everyone registered and starts a
+    fresh one for later waiters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}  # reference -> [threading.Event, waiter count]
+
+    @contextmanager
+    def watch(self, reference):
+        with self._lock:
+            entry = self._waiters.setdefault(reference, [threading.Event(), 0])
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0 and self._waiters.get(reference) is entry:
+                    del self._waiters[reference]
+
+    def notify(self, reference):
+        with self._lock:
+            entry = self._waiters.pop(reference, None)
+        if entry:
+            entry[0].set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "references": len(self._waiters),
+                "waiters": sum(count for _, count in self._waiters.values())
+            }
+
+
+status_waiters = StatusWaiters()
+
+# ========================================
+# DATABASE FUNCTIONS
+# ========================================
+
+DATABASE_PATH = os.getenv("DATABASE_PATH", "helmet_sanitizer.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+
+class ConnectionPool:
+    """Small pool of long-lived SQLite connections.
+
+    Connections are opened once in WAL mode and handed out per `with` block.
+    A thread that is already inside a block gets the same connection back, so
+    helpers called from within a transaction join it instead of opening a
+    second connection that would wait on the first one's write lock.
+    """
+
+    def __init__(self, path, size=4, busy_timeout_ms=5000):
+        self.path = path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._local = threading.local()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,       # explicit BEGIN/COMMIT in transaction()
+            check_same_thread=False     # connections move between request threads
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -8000")         # ~8 MB page cache
+        conn.execute("PRAGMA mmap_size = 67108864")       # 64 MB
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the block."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.depth = 0
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in a write transaction.
+
+        The outermost block takes the write lock up front (BEGIN IMMEDIATE) so
+        concurrent writers queue on busy_timeout instead of failing with
+        "database is locked" on upgrade. Nested blocks become savepoints.
+        """
+        with self.connection() as conn:
+            depth = self._local.depth
+            savepoint = f"sp_{depth}"
+            conn.execute("BEGIN IMMEDIATE" if depth == 0 else f"SAVEPOINT {savepoint}")
+            self._local.depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth == 0:
+                    conn.rollback()
+                else:
+                    conn.execute(f"ROLLBACK TO {savepoint}")
+                    conn.execute(f"RELEASE {savepoint}")
+                raise
+            else:
+                if depth == 0:
+                    conn.commit()
+                else:
+                    conn.execute(f"RELEASE {savepoint}")
+            finally:
+                self._local.depth = depth
+
+    def close_all(self):
+        """Close every idle connection (used on shutdown)."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+db_pool = ConnectionPool(DATABASE_PATH, size=DB_POOL_SIZE, busy_timeout_ms=DB_BUSY_TIMEOUT_MS)
+
+
+def db_connection():
+    """Context manager yielding a pooled connection (reads / autocommit)."""
+    return db_pool.connection()
+
+
+def db_transaction():
+    """Context manager yielding a pooled connection inside a transaction."""
+    return db_pool.transaction()
+
+
+# ----------------------------------------
+# Timestamps
+# ----------------------------------------
+# The *_ts INTEGER columns (Unix epoch seconds, UTC) are the canonical
+# timestamps: every date filter is a range scan over them. The legacy text
+# columns are still written for display, but created_at is SQLite UTC while
+# paid_at/started_at/completed_at are local time, so never filter on them.
+
+def now_ts():
+    """Current time as integer epoch seconds."""
+    return int(time.time())
+
+
+def local_day(ts):
+    """Local calendar day ('YYYY-MM-DD') of an epoch timestamp."""
+    return datetime.fromtimestamp(ts).date().isoformat()
+
+
+def day_bounds(day):
+    """Epoch range [start, end) covering a local calendar day."""
+    if isinstance(day, str):
+        day = datetime.strptime(day, "%Y-%m-%d").date()
+    start = datetime.combine(day, datetime.min.time())
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
+
+def save_payment(reference, method, amount, status='PENDING', paymongo_id=None, qr_code=None, reference_id=None,
+                 pooled=False):
+    """Save payment to database.
+    
+    pooled=True saves a pre-generated QRPh code unclaimed (claimed_ts NULL)
+    until QRPhPool hands it out.
+    """
+    created_ts = now_ts()
+    claimed_ts = None if pooled else created_ts
+    paid_ts = created_ts if status == 'PAID' else None
+    paid_at = datetime.fromtimestamp(paid_ts) if paid_ts else None
+    
+    try:
+        with db_transaction() as conn:
+            c = conn.execute('''
+                INSERT INTO payments (reference, payment_method, amount, status, paymongo_id, qr_code, reference_id,
+                                      created_ts, claimed_ts, paid_at, paid_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (reference, method, amount, status, paymongo_id, qr_code, reference_id,
+                  created_ts, claimed_ts, paid_at, paid_ts))
+            if status == 'PAID':
+                _count_paid_payment(conn, c.lastrowid)
+            payment_id = c.lastrowid
+    except sqlite3.IntegrityError:
+        return None
+    
+    payment_cache.put(PaymentRecord(reference, payment_id, status, method, amount))
+    reference_index.add(reference, paymongo_id, reference_id)
+    return payment_id
+
+
+def get_payment_by_reference(reference):
+    """Get payment by reference."""
+    with db_connection() as conn:
+        payment = conn.execute('SELECT * FROM payments WHERE reference = ?', (reference,)).fetchone()
+    return dict(payment) if payment else None
+
+
+def get_payment_status(reference):
+    """PaymentRecord for a reference, served from payment_cache when possible.
+
+    On a miss the payment and its latest session are loaded in one query and
+    cached. Returns None for unknown references (not cached).
+    """
+    record = payment_cache.get(reference)
+    if record is not None:
+        return record
+    
+    with db_connection() as conn:
+        row = conn.execute('''
+            SELECT p.id, p.status, p.payment_method, p.amount,
+                   (SELECT s.id FROM sanitization_sessions s
+                    WHERE s.payment_id = p.id ORDER BY s.id DESC LIMIT 1) AS session_id
+            FROM payments p
+            WHERE p.reference = ?
+        ''', (reference,)).fetchone()
+    if not row:
+        return None
+    
+    return payment_cache.put(PaymentRecord(
+        reference, row["id"], row["status"], row["payment_method"], row["amount"], row["session_id"]
+    ))
+
+
+def get_payment_statuses(references):
+    """Batch form of get_payment_status: {reference: PaymentRecord}.
+    
+    Cache hits are served directly; the misses are loaded with one
+    IN (...) query per STATUS_BATCH_CHUNK references. Unknown references
+    are left out of the result.
+    """
+    records = {}
+    missing = []
+    for reference in dict.fromkeys(references):
+        record = payment_cache.get(reference)
+        if record is not None:
+            records[reference] = record
+        else:
+            missing.append(reference)
+    
+    if missing:
+        with db_connection() as conn:
+            for i in range(0, len(missing), STATUS_BATCH_CHUNK):
+                chunk = missing[i:i + STATUS_BATCH_CHUNK]
+                rows = conn.execute(f'''
+                    SELECT p.reference, p.id, p.status, p.payment_method, p.amount,
+                           (SELECT s.id FROM sanitization_sessions s
+                            WHERE s.payment_id = p.id ORDER BY s.id DESC LIMIT 1) AS session_id
+                    FROM payments p
+                    WHERE p.reference IN ({",".join("?" * len(chunk))})
+                ''', chunk).fetchall()
+                for row in rows:
+                    records[row["reference"]] = payment_cache.put(PaymentRecord(
+                        row["reference"], row["id"], row["status"], row["payment_method"],
+                        row["amount"], row["session_id"]
+                    ))
+    return records
+
+
+def save_sanitization_session(payment_id):
+    """Create sanitization session."""
+    started_ts = now_ts()
+    with db_transaction() as conn:
+        c = conn.execute('''
+            INSERT INTO sanitization_sessions (payment_id, started_at, started_ts)
+            VALUES (?, ?, ?)
+        ''', (payment_id, datetime.fromtimestamp(started_ts), started_ts))
+        return c.lastrowid
+
+
+def complete_sanitization_session(session_id, duration=None):
+    """Mark sanitization as complete.
+    
+    duration is the measured relay sequence in seconds; None keeps the
+    column's current value.
+    """
+    completed_ts = now_ts()
+    with db_transaction() as conn:
+        session = conn.execute(
+            'SELECT started_ts FROM sanitization_sessions WHERE id = ? AND completed_at IS NULL',
+            (session_id,)
+        ).fetchone()
+        conn.execute('''
+            UPDATE sanitization_sessions 
+            SET completed_at = ?, completed_ts = ?, duration = COALESCE(?, duration)
+            WHERE id = ?
+        ''', (datetime.fromtimestamp(completed_ts), completed_ts,
+              None if duration is None else round(duration), session_id))
+        if session:
+            _apply_daily_stats_delta(conn, local_day(session["started_ts"]), successful_sanitizations=1)
+
+
+def fail_sanitization_session(session_id, duration=None):
+    """Mark a session whose relay cycle failed.
+    
+    completed_at stays NULL, so the session is not counted as a successful
+    sanitization.
+    """
+    failed_ts = now_ts()
+    with db_transaction() as conn:
+        conn.execute('''
+            UPDATE sanitization_sessions
+            SET failed_ts = ?, duration = COALESCE(?, duration)
+            WHERE id = ? AND completed_at IS NULL
+        ''', (failed_ts, None if duration is None else round(duration), session_id))
+
+
+def save_rating(session_id, rating, feedback=None):
+    """Save rating."""
+    created_ts = now_ts()
+    with db_transaction() as conn:
+        conn.execute('''
+            INSERT INTO ratings (session_id, rating, feedback, created_ts)
+            VALUES (?, ?, ?, ?)
+        ''', (session_id, rating, feedback, created_ts))
+        _apply_daily_stats_delta(conn, local_day(created_ts), rating_sum=rating, rating_count=1)
+        
+        method = conn.execute('''
+            SELECT p.payment_method FROM sanitization_sessions s
+            JOIN payments p ON p.id = s.payment_id
+            WHERE s.id = ?
+        ''', (session_id,)).fetchone()
+        _apply_hourly_stats_delta(conn, created_ts, method[0] if method else 'UNKNOWN', rating=rating)
+
+
+# ----------------------------------------
+# Daily statistics
+# ----------------------------------------
+# daily_stats is maintained by deltas written in the same transaction as the
+# event that changed it (payment paid, session completed, rating saved). The
+# day an event counts towards is the date of the row's own timestamp, which is
+# exactly what rebuild_daily_stats() groups by, so the two always agree.
+
+DAILY_STATS_FIELDS = (
+    "total_payments", "total_revenue", "successful_sanitizations",
+    "qrph_payments", "cash_payments", "rating_sum", "rating_count"
+)
+
+
+def _apply_daily_stats_delta(conn, day, total_payments=0, total_revenue=0.0,
+                             successful_sanitizations=0, qrph_payments=0,
+                             cash_payments=0, rating_sum=0, rating_count=0):
+    """Add a delta to one day's daily_stats row (created on first use)."""
+    conn.execute('''
+        INSERT INTO daily_stats
+        (date, total_payments, total_revenue, successful_sanitizations,
+         qrph_payments, cash_payments, rating_sum, rating_count, average_rating)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(? * 1.0 / NULLIF(?, 0), 0))
+        ON CONFLICT(date) DO UPDATE SET
+            total_payments = total_payments + excluded.total_payments,
+            total_revenue = total_revenue + excluded.total_revenue,
+            successful_sanitizations = successful_sanitizations + excluded.successful_sanitizations,
+            qrph_payments = qrph_payments + excluded.qrph_payments,
+            cash_payments = cash_payments + excluded.cash_payments,
+            rating_sum = rating_sum + excluded.rating_sum,
+            rating_count = rating_count + excluded.rating_count,
+            average_rating = COALESCE(
+                (rating_sum + excluded.rating_sum) * 1.0
+                / NULLIF(rating_count + excluded.rating_count, 0), 0)
+    ''', (
+        day, total_payments, total_revenue, successful_sanitizations,
+        qrph_payments, cash_payments, rating_sum, rating_count,
+        rating_sum, rating_count
+    ))
+
+
+def _count_paid_payment(conn, payment_id):
+    """Add a newly PAID payment to its day's and hour's stats."""
+    row = conn.execute(
+        'SELECT created_ts, payment_method, amount FROM payments WHERE id = ?',
+        (payment_id,)
+    ).fetchone()
+    if not row:
+        return
+    _apply_daily_stats_delta(
+        conn, local_day(row["created_ts"]),
+        total_payments=1,
+        total_revenue=row["amount"] or 0,
+        qrph_payments=1 if row["payment_method"] == 'QRPH' else 0,
+        cash_payments=1 if row["payment_method"] == 'CASH' else 0
+    )
+    _apply_hourly_stats_delta(
+        conn, row["created_ts"], row["payment_method"],
+        payments=1, revenue=row["amount"] or 0
+    )
+
+
+def _aggregate_daily_stats(conn, day=None):
+    """Compute daily_stats values from the raw tables, keyed by local day."""
+    if day:
+        ts_range, params = "AND {col} >= ? AND {col} < ?", day_bounds(day)
+    else:
+        ts_range, params = "", ()
+    stats = {}
+
+    def row_for(d):
+        return stats.setdefault(d, dict.fromkeys(DAILY_STATS_FIELDS, 0))
+
+    c = conn.execute(f'''
+        SELECT
+            DATE(created_ts, 'unixepoch', 'localtime') AS day,
+            COUNT(*) AS total_payments,
+            COALESCE(SUM(amount), 0) AS total_revenue,
+            SUM(CASE WHEN payment_method = 'QRPH' THEN 1 ELSE 0 END) AS qrph_payments,
+            SUM(CASE WHEN payment_method = 'CASH' THEN 1 ELSE 0 END) AS cash_payments
+        FROM payments
+        WHERE status = 'PAID' {ts_range.format(col="created_ts")}
+        GROUP BY day
+    ''', params)
+    for r in c:
+        row_for(r["day"]).update(
+            total_payments=r["total_payments"], total_revenue=r["total_revenue"],
+            qrph_payments=r["qrph_payments"], cash_payments=r["cash_payments"]
+        )
+
+    c = conn.execute(f'''
+        SELECT DATE(started_ts, 'unixepoch', 'localtime') AS day, COUNT(*) AS successful_sanitizations
+        FROM sanitization_sessions
+        WHERE completed_at IS NOT NULL {ts_range.format(col="started_ts")}
+        GROUP BY day
+    ''', params)
+    for r in c:
+        row_for(r["day"])["successful_sanitizations"] = r["successful_sanitizations"]
+
+    c = conn.execute(f'''
+        SELECT DATE(created_ts, 'unixepoch', 'localtime') AS day, SUM(rating) AS rating_sum, COUNT(*) AS rating_count
+        FROM ratings
+        WHERE 1=1 {ts_range.format(col="created_ts")}
+        GROUP BY day
+    ''', params)
+    for r in c:
+        row_for(r["day"]).update(rating_sum=r["rating_sum"], rating_count=r["rating_count"])
+
+    stats.pop(None, None)  # rows without a timestamp
+    return stats
+
+
+def rebuild_daily_stats(day=None):
+    """Recompute daily_stats from scratch for one day (or every day)."""
+    with db_transaction() as conn:
+        stats = _aggregate_daily_stats(conn, day)
+        if day:
+            conn.execute('DELETE FROM daily_stats WHERE date = ?', (day,))
+        else:
+            conn.execute('DELETE FROM daily_stats')
+        for d, values in stats.items():
+            _apply_daily_stats_delta(conn, d, **values)
+    return len(stats)
+
+
+def check_daily_stats(repair=False):
+    """Compare daily_stats with the raw tables.
+
+    Returns a list of mismatches ({date, field, stored, expected}). With
+    repair=True every mismatching day is rebuilt.
+    """
+    with db_connection() as conn:
+        expected = _aggregate_daily_stats(conn)
+        stored = {row["date"]: dict(row) for row in conn.execute('SELECT * FROM daily_stats')}
+
+    mismatches = []
+    for day in sorted(set(expected) | set(stored)):
+        want = expected.get(day, dict.fromkeys(DAILY_STATS_FIELDS, 0))
+        have = stored.get(day, {})
+        for field in DAILY_STATS_FIELDS:
+            if abs((have.get(field) or 0) - (want[field] or 0)) > 1e-6:
+                mismatches.append({
+                    "date": day,
+                    "field": field,
+                    "stored": have.get(field),
+                    "expected": want[field]
+                })
+
+    if repair:
+        for day in sorted({m["date"] for m in mismatches}):
+            rebuild_daily_stats(day)
+
+    return mismatches
+
+
+# ----------------------------------------
+# Hourly statistics
+# ----------------------------------------
+# hourly_stats is a rollup keyed by (hour bucket, payment method): PAID
+# payment count and revenue plus a 1-5 star rating histogram. It is kept up
+# to date by the same event hooks as daily_stats, so analytics reads cost
+# O(buckets) instead of O(rows).
+
+def _apply_hourly_stats_delta(conn, ts, payment_method, payments=0, revenue=0.0, rating=None):
+    """Add a delta to the hourly bucket containing epoch timestamp ts."""
+    buckets = [0] * 5
+    if rating:
+        buckets[int(rating) - 1] = 1
+    conn.execute('''
+        INSERT INTO hourly_stats
+        (hour_ts, payment_method, payments, revenue, rating_1, rating_2, rating_3, rating_4, rating_5)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(hour_ts, payment_method) DO UPDATE SET
+            payments = payments + excluded.payments,
+            revenue = revenue + excluded.revenue,
+            rating_1 = rating_1 + excluded.rating_1,
+            rating_2 = rating_2 + excluded.rating_2,
+            rating_3 = rating_3 + excluded.rating_3,
+            rating_4 = rating_4 + excluded.rating_4,
+            rating_5 = rating_5 + excluded.rating_5
+    ''', (ts - ts % 3600, payment_method, payments, revenue, *buckets))
+
+
+def rebuild_hourly_stats():
+    """Recompute hourly_stats from payments and ratings. Returns bucket count."""
+    with db_transaction() as conn:
+        conn.execute('DELETE FROM hourly_stats')
+        conn.execute('''
+            INSERT INTO hourly_stats (hour_ts, payment_method, payments, revenue)
+            SELECT created_ts - created_ts % 3600, payment_method, COUNT(*), COALESCE(SUM(amount), 0)
+            FROM payments
+            WHERE status = 'PAID' AND created_ts IS NOT NULL
+            GROUP BY 1, 2
+        ''')
+        conn.execute('''
+            INSERT INTO hourly_stats (hour_ts, payment_method, rating_1, rating_2, rating_3, rating_4, rating_5)
+            SELECT
+                r.created_ts - r.created_ts % 3600,
+                COALESCE(p.payment_method, 'UNKNOWN'),
+                SUM(r.rating = 1), SUM(r.rating = 2), SUM(r.rating = 3), SUM(r.rating = 4), SUM(r.rating = 5)
+            FROM ratings r
+            LEFT JOIN sanitization_sessions s ON s.id = r.session_id
+            LEFT JOIN payments p ON p.id = s.payment_id
+            WHERE r.created_ts IS NOT NULL
+            GROUP BY 1, 2
+            ON CONFLICT(hour_ts, payment_method) DO UPDATE SET
+                rating_1 = excluded.rating_1,
+                rating_2 = excluded.rating_2,
+                rating_3 = excluded.rating_3,
+                rating_4 = excluded.rating_4,
+                rating_5 = excluded.rating_5
+        ''')
+        return conn.execute('SELECT COUNT(*) FROM hourly_stats').fetchone()[0]
+
+
+# ----------------------------------------
+# Sanitization latency
+# ----------------------------------------
+# Where a customer's time goes, from phase_events joined to the session's
+# payment. Stages per cycle:
+#   payment  created_ts -> paid_ts (scanning and paying)
+#   start    paid_ts -> first relay ON (queue wait, start delay, settle)
+#   cycle    first relay ON -> last relay OFF
+#   total    created_ts -> last relay OFF
+# Every timestamp involved is epoch seconds on the real clock. This scans
+# raw phase_events, so it is served on demand (/admin/latency) only.
+
+LATENCY_STAGES = ("payment", "start", "cycle", "total")
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list, or None if it is empty."""
+    if not values:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def latency_summary(values, digits=1):
+    """count, p50/p95/p99 and max of a list of durations."""
+    values = sorted(values)
+    summary = {"count": len(values)}
+    for p in (50, 95, 99):
+        value = percentile(values, p)
+        summary[f"p{p}"] = None if value is None else round(value, digits)
+    summary["max"] = round(values[-1], digits) if values else None
+    return summary
+
+
+def _cycle_stages(row):
+    """Stage durations of one cycle; stages without the timestamps they need are left out."""
+    stages = {"cycle": row["relay_off"] - row["relay_on"]}
+    if row["paid_ts"] is not None:
+        stages["start"] = row["relay_on"] - row["paid_ts"]
+        if row["created_ts"] is not None:
+            stages["payment"] = row["paid_ts"] - row["created_ts"]
+            stages["total"] = row["relay_off"] - row["created_ts"]
+    return stages
+
+
+def sanitization_latency(since_ts):
+    """Latency percentiles of the cycles run since an epoch time.
+    
+    Returns stage percentiles over the whole range, one row per relay phase
+    (actual duration and drift from its nominal duration) and per-day stage
+    percentiles for trends.
+    """
+    with db_connection() as conn:
+        cycles = conn.execute('''
+            SELECT e.job_id, MIN(e.started_ts) AS relay_on, MAX(e.ended_ts) AS relay_off,
+                   p.created_ts, p.paid_ts
+            FROM phase_events e
+            LEFT JOIN sanitization_sessions s ON s.id = e.session_id
+            LEFT JOIN payments p ON p.id = s.payment_id
+            WHERE e.started_ts >= ?
+            GROUP BY e.job_id
+            ORDER BY relay_on
+        ''', (since_ts,)).fetchall()
+        phase_rows = conn.execute('''
+            SELECT phase, nominal_start, nominal_seconds, ended_ts - started_ts AS actual
+            FROM phase_events
+            WHERE started_ts >= ?
+        ''', (since_ts,)).fetchall()
+    
+    overall = {stage: [] for stage in LATENCY_STAGES}
+    daily = {}
+    for row in cycles:
+        day = daily.setdefault(local_day(row["relay_on"]), {stage: [] for stage in LATENCY_STAGES})
+        for stage, value in _cycle_stages(row).items():
+            overall[stage].append(value)
+            day[stage].append(value)
+    
+    phases = {}
+    for row in phase_rows:
+        entry = phases.setdefault(row["phase"], {"nominal_start": row["nominal_start"],
+                                                 "nominal_seconds": row["nominal_seconds"],
+                                                 "actual": [], "drift": []})
+        entry["actual"].append(row["actual"])
+        entry["drift"].append(row["actual"] - row["nominal_seconds"])
+    
+    return {
+        "cycles": len(cycles),
+        "stages": {stage: latency_summary(values) for stage, values in overall.items()},
+        "phases": [
+            {
+                "phase": name,
+                "nominal_seconds": entry["nominal_seconds"],
+                **latency_summary(entry["actual"], digits=2),
+                "drift_p95": latency_summary(entry["drift"], digits=3)["p95"]
+            }
+            for name, entry in sorted(phases.items(), key=lambda item: item[1]["nominal_start"])
+        ],
+        "daily": [
+            {"date": d, **{stage: latency_summary(values) for stage, values in stages.items()}}
+            for d, stages in sorted(daily.items())
+        ]
+    }
+
+
+# ----------------------------------------
+# Payment listing (keyset pagination)
+# ----------------------------------------
+# Pages are ordered newest first by (created_ts, id) and continue from an
+# opaque cursor "<created_ts>.<id>" taken from the last row of the previous
+# page, so every page is a single index range scan however deep it is.
+
+PAYMENTS_PAGE_SIZE = 100
+PAYMENTS_MAX_PAGE_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+
+
+def encode_cursor(row):
+    """Cursor pointing just past a payment row."""
+    return f"{row['created_ts']}.{row['id']}"
+
+
+def decode_cursor(cursor):
+    """(created_ts, id) from a cursor string; raises ValueError if malformed."""
+    created_ts, payment_id = cursor.split(".")
+    return int(created_ts), int(payment_id)
+
+
+def payment_filters(status='all', method='all', date_from='', date_to=''):
+    """WHERE clause and params for the admin payment filters."""
+    clauses, params = [], []
+    
+    if status != 'all':
+        clauses.append('status = ?')
+        params.append(status)
+    
+    if method != 'all':
+        clauses.append('payment_method = ?')
+        params.append(method)
+    
+    if date_from:
+        clauses.append('created_ts >= ?')
+        params.append(day_bounds(date_from)[0])
+    
+    if date_to:
+        clauses.append('created_ts < ?')
+        params.append(day_bounds(date_to)[1])
+    
+    return clauses, params
+
+
+def fetch_payments_page(filters=None, cursor=None, limit=PAYMENTS_PAGE_SIZE, columns="*"):
+    """One page of payments. Returns (rows, next_cursor or None)."""
+    clauses, params = payment_filters(**(filters or {}))
+    
+    if cursor:
+        clauses.append('(created_ts, id) < (?, ?)')
+        params.extend(decode_cursor(cursor))
+    
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    query = f'SELECT {columns} FROM payments{where} ORDER BY created_ts DESC, id DESC LIMIT ?'
+    
+    # Fetch one extra row to learn whether another page exists
+    with db_connection() as conn:
+        rows = conn.execute(query, params + [limit + 1]).fetchall()
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def iter_payments(filters=None, batch_size=EXPORT_BATCH_SIZE, columns="*"):
+    """Yield every matching payment, fetched in keyset batches.
+
+    The connection goes back to the pool between batches, so a slow export
+    download never holds a read snapshot open for its whole duration.
+    """
+    cursor = None
+    while True:
+        rows, cursor = fetch_payments_page(filters, cursor, batch_size, columns)
+        yield from rows
+        if not cursor:
+            break
+
+
+# ----------------------------------------
+# Schema migrations
+# ----------------------------------------
+# Each migration is (version, description, steps). A step is either an SQL
+# string or a callable taking the connection. The applied version is kept in
+# PRAGMA user_version; every migration runs in its own transaction, so a
+# failure leaves the database at the last good version.
+
+def _add_column_if_missing(conn, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN, skipped when the column already exists."""
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+MIGRATIONS = [
+    (1, "base schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reference TEXT UNIQUE NOT NULL,
+            payment_method TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'PHP',
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            paid_at TIMESTAMP,
+            paymongo_id TEXT,
+            qr_code TEXT,
+            reference_id TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sanitization_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id INTEGER,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            duration INTEGER DEFAULT 55,
+            FOREIGN KEY (payment_id) REFERENCES payments (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ratings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER,
+            rating INTEGER NOT NULL CHECK(rating >= 1 AND rating <= 5),
+            feedback TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES sanitization_sessions (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date DATE UNIQUE NOT NULL,
+            total_payments INTEGER DEFAULT 0,
+            total_revenue REAL DEFAULT 0,
+            successful_sanitizations INTEGER DEFAULT 0,
+            average_rating REAL DEFAULT 0,
+            qrph_payments INTEGER DEFAULT 0,
+            cash_payments INTEGER DEFAULT 0
+        )
+        ''',
+    ]),
+    (2, "webhook and admin lookup indexes", [
+        # Webhook strategy 4/5: resolve our reference from PayMongo ids (covering)
+        "CREATE INDEX IF NOT EXISTS idx_payments_paymongo_id ON payments (paymongo_id, reference)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_reference_id ON payments (reference_id, reference)",
+        # Webhook strategy 6: newest pending QRPH payment for an amount
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_pending
+        ON payments (payment_method, amount, created_at, reference)
+        WHERE status = 'PENDING'
+        ''',
+        # Admin listings ordered by creation time
+        "CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments (created_at)",
+        # check_payment: latest session for a payment
+        "CREATE INDEX IF NOT EXISTS idx_sessions_payment_id ON sanitization_sessions (payment_id, id)",
+        # Dashboard joins ratings to sessions
+        "CREATE INDEX IF NOT EXISTS idx_ratings_session_id ON ratings (session_id)",
+        "CREATE INDEX IF NOT EXISTS idx_ratings_created_at ON ratings (created_at)",
+    ]),
+    (3, "running rating sum/count for incremental daily_stats", [
+        lambda conn: _add_column_if_missing(conn, "daily_stats", "rating_sum", "INTEGER DEFAULT 0"),
+        lambda conn: _add_column_if_missing(conn, "daily_stats", "rating_count", "INTEGER DEFAULT 0"),
+        # daily_stats is rebuilt by migration 4, once timestamps are normalized
+    ]),
+    (4, "epoch timestamp columns and range indexes", [
+        lambda conn: _add_column_if_missing(conn, "payments", "created_ts", "INTEGER"),
+        lambda conn: _add_column_if_missing(conn, "payments", "paid_ts", "INTEGER"),
+        lambda conn: _add_column_if_missing(conn, "sanitization_sessions", "started_ts", "INTEGER"),
+        lambda conn: _add_column_if_missing(conn, "sanitization_sessions", "completed_ts", "INTEGER"),
+        lambda conn: _add_column_if_missing(conn, "ratings", "created_ts", "INTEGER"),
+        # created_at comes from CURRENT_TIMESTAMP (UTC); the others were
+        # written from datetime.now() (local), hence the 'utc' modifier.
+        "UPDATE payments SET created_ts = CAST(strftime('%s', created_at) AS INTEGER) WHERE created_ts IS NULL",
+        "UPDATE payments SET paid_ts = CAST(strftime('%s', paid_at, 'utc') AS INTEGER) WHERE paid_ts IS NULL AND paid_at IS NOT NULL",
+        "UPDATE sanitization_sessions SET started_ts = CAST(strftime('%s', started_at, 'utc') AS INTEGER) WHERE started_ts IS NULL",
+        "UPDATE sanitization_sessions SET completed_ts = CAST(strftime('%s', completed_at, 'utc') AS INTEGER) WHERE completed_ts IS NULL AND completed_at IS NOT NULL",
+        "UPDATE ratings SET created_ts = CAST(strftime('%s', created_at) AS INTEGER) WHERE created_ts IS NULL",
+        "DROP INDEX IF EXISTS idx_payments_created_at",
+        "DROP INDEX IF EXISTS idx_payments_pending",
+        "DROP INDEX IF EXISTS idx_ratings_created_at",
+        "CREATE INDEX IF NOT EXISTS idx_payments_created_ts ON payments (created_ts, id)",
+        # Admin filters by status, and analytics sums PAID rows in a date range
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_status_created_ts
+        ON payments (status, created_ts, payment_method, amount)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_pending
+        ON payments (payment_method, amount, created_ts, reference)
+        WHERE status = 'PENDING'
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_sessions_started_ts ON sanitization_sessions (started_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_ratings_created_ts ON ratings (created_ts, rating)",
+        lambda conn: rebuild_daily_stats(),
+    ]),
+    (5, "hourly_stats rollup", [
+        '''
+        CREATE TABLE IF NOT EXISTS hourly_stats (
+            hour_ts INTEGER NOT NULL,
+            payment_method TEXT NOT NULL,
+            payments INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            rating_1 INTEGER NOT NULL DEFAULT 0,
+            rating_2 INTEGER NOT NULL DEFAULT 0,
+            rating_3 INTEGER NOT NULL DEFAULT 0,
+            rating_4 INTEGER NOT NULL DEFAULT 0,
+            rating_5 INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour_ts, payment_method)
+        ) WITHOUT ROWID
+        ''',
+        lambda conn: rebuild_hourly_stats(),
+    ]),
+    (6, "QRPh pool handout time", [
+        # NULL while a pre-generated code sits unclaimed in the pool; every
+        # other payment is claimed when it is created
+        lambda conn: _add_column_if_missing(conn, "payments", "claimed_ts", "INTEGER"),
+        "UPDATE payments SET claimed_ts = created_ts WHERE claimed_ts IS NULL",
+        # Webhook strategy 6 only matches codes a customer was shown
+        "DROP INDEX IF EXISTS idx_payments_pending",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_pending
+        ON payments (payment_method, amount, created_ts, reference)
+        WHERE status = 'PENDING' AND claimed_ts IS NOT NULL
+        ''',
+    ]),
+    (7, "webhook inbox", [
+        '''
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id TEXT UNIQUE NOT NULL,
+            event_type TEXT,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDING',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            received_ts INTEGER NOT NULL,
+            next_attempt_ts INTEGER NOT NULL,
+            processed_ts INTEGER,
+            last_error TEXT,
+            result TEXT
+        )
+        ''',
+        # Workers claim the oldest due PENDING row
+        '''
+        CREATE INDEX IF NOT EXISTS idx_webhook_inbox_due
+        ON webhook_inbox (next_attempt_ts, id)
+        WHERE status = 'PENDING'
+        ''',
+    ]),
+    (8, "stored QRPh images", [
+        # PayMongo's PNG for each QRPh code, so /qr/<ref>.png survives a
+        # restart or a QRImageCache eviction
+        '''
+        CREATE TABLE IF NOT EXISTS qrph_images (
+            payment_id INTEGER PRIMARY KEY,
+            png BLOB NOT NULL,
+            FOREIGN KEY (payment_id) REFERENCES payments (id)
+        )
+        ''',
+    ]),
+    (9, "sanitization job queue", [
+        # Only the process holding a job's lease (owner, lease_until) runs it;
+        # an expired lease means its owner died and the job may be taken over
+        '''
+        CREATE TABLE IF NOT EXISTS sanitization_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER UNIQUE,
+            status TEXT NOT NULL DEFAULT 'QUEUED',
+            start_delay REAL NOT NULL DEFAULT 2,
+            enqueued_ts INTEGER NOT NULL,
+            started_ts INTEGER,
+            finished_ts INTEGER,
+            last_error TEXT,
+            owner TEXT,
+            lease_until INTEGER,
+            FOREIGN KEY (session_id) REFERENCES sanitization_sessions (id)
+        )
+        ''',
+        # The worker takes the lowest QUEUED id; positions count active ids below
+        '''
+        CREATE INDEX IF NOT EXISTS idx_sanitization_jobs_active
+        ON sanitization_jobs (id)
+        WHERE status IN ('QUEUED', 'RUNNING')
+        ''',
+    ]),
+    (10, "relay phase timings", [
+        # One row per phase the relay engine finished; times are epoch seconds
+        '''
+        CREATE TABLE IF NOT EXISTS phase_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            session_id INTEGER,
+            phase TEXT NOT NULL,
+            nominal_start REAL NOT NULL,
+            nominal_seconds REAL NOT NULL,
+            started_ts REAL NOT NULL,
+            ended_ts REAL NOT NULL,
+            FOREIGN KEY (job_id) REFERENCES sanitization_jobs (id),
+            FOREIGN KEY (session_id) REFERENCES sanitization_sessions (id)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_phase_events_started
+        ON phase_events (started_ts)
+        ''',
+    ]),
+    (11, "failed sanitization sessions", [
+        # Set when the relay cycle failed; such a session never gets completed_at
+        lambda conn: _add_column_if_missing(conn, "sanitization_sessions", "failed_ts", "INTEGER"),
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def run_migrations():
+    """Bring the database up to SCHEMA_VERSION. Returns (old, new) versions."""
+    with db_connection() as conn:
+        start_version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for version, description, steps in MIGRATIONS:
+        with db_transaction() as conn:
+            # Re-read inside the write lock in case another process migrated first
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version <= current:
+                continue
+
+            log.info("🛠️ Applying migration %s: %s", version, description)
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version}")
+
+    if start_version < SCHEMA_VERSION:
+        with db_connection() as conn:
+            conn.execute("PRAGMA optimize")
+
+    return start_version, SCHEMA_VERSION
+
+
+def init_db():
+    """Initialize SQLite database (apply pending schema migrations)."""
+    old_version, new_version = run_migrations()
+    if old_version != new_version:
+        log.info("✅ Database Initialized (schema v%s → v%s)", old_version, new_version)
+    else:
+        log.info("✅ Database Initialized (schema v%s)", new_version)
+
+
+
+def warm_reference_index(hours=REFERENCE_INDEX_WARM_HOURS):
+    """Load recent payments into reference_index so webhooks after a restart
+    still resolve in memory. Returns the number of payments loaded."""
+    since = now_ts() - hours * 3600
+    with db_connection() as conn:
+        rows = conn.execute('''
+            SELECT reference, paymongo_id, reference_id FROM payments
+            WHERE created_ts >= ?
+            ORDER BY created_ts, id
+        ''', (since,)).fetchall()
+    for row in rows:
+        reference_index.add(row["reference"], row["paymongo_id"], row["reference_id"])
+    return len(rows)
+
+
+init_db()
+log.info("🗂️ Reference index warmed with %s recent payment(s)", warm_reference_index())
+
+# ========================================
+# SANITIZATION QUEUE
+# ========================================
+
+SANITIZER_MAX_QUEUE = int(os.getenv("SANITIZER_MAX_QUEUE", "3"))  # queued + running jobs before payments are refused; 0 = no limit
+SANITIZER_JOB_MAX_AGE = 900  # seconds; older jobs found at startup are expired, not run
+SANITIZER_LEASE_GRACE = 60  # seconds a running job's lease outlasts its expected cycle
+SANITIZER_WATCH_INTERVAL = 2  # seconds between checks for jobs enqueued by other processes
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+SANITIZATION_CYCLE_SECONDS = RELAY_SETTLE_SECONDS + relay_plan.total  # until real runs are measured
+SANITIZER_BUSY_MESSAGE = "Sanitizer is busy, please try again in a few minutes"
+
+
+class SanitizerQueue:
+    """Durable FIFO of sanitization cycles (the sanitization_jobs table).
+    
+    confirm_payment enqueues a job in the transaction that creates the
+    session, so a paid cycle survives a crash. A single worker thread owns
+    the relays: it claims the oldest QUEUED job, waits its start delay, runs
+    run_payment_relay_sequence and completes the session, or marks it
+    failed if the cycle raised, so two customers paying close together are
+    served one after the other. Each run records its measured duration on
+    the session and its phases in phase_events. `clock` only drives the
+    start delay and those measurements; job timestamps and leases are
+    now_ts() epoch seconds like every other table.
+    
+    Claiming a job stamps it with this process (owner) and a lease covering
+    its start delay and cycle plus lease_grace. Only a job whose lease has
+    run out, because its owner crashed, is taken over and rerun from the
+    start, so a maintenance command sharing the database never touches a
+    job the server is running. Jobs older than max_age are expired instead,
+    as their customer has long gone.
+    
+    Other processes (flask reconcile-payments) only enqueue. A watcher
+    thread in the server polls for job ids it has not seen every
+    watch_interval seconds, refreshes those payments in payment_cache,
+    wakes their status waiters and wakes the worker.
+    """
+
+    def __init__(self, max_depth=3, max_age=900, cycle_estimate=106, clock=None,
+                 lease_grace=60, watch_interval=2, owner=WORKER_ID):
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self.clock = clock or kiosk_clock
+        self.cycle_estimate = float(cycle_estimate)
+        self.avg_duration = float(cycle_estimate)  # moving average of measured relay sequences
+        self.lease_grace = lease_grace
+        self.watch_interval = watch_interval
+        self.owner = owner
+        self._wake = threading.Condition()
+        self._signals = 0
+        self._last_seen_id = 0
+        self._thread = None
+        self._watcher = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.refused = 0
+
+    def enqueue(self, conn, session_id=None, start_delay=2):
+        """Add a job inside the caller's transaction; call notify() after it commits."""
+        return conn.execute('''
+            INSERT INTO sanitization_jobs (session_id, start_delay, enqueued_ts) VALUES (?, ?, ?)
+        ''', (session_id, start_delay, now_ts())).lastrowid
+
+    def submit(self, session_id=None, start_delay=2):
+        """Enqueue a job in its own transaction. Returns the job id."""
+        with db_transaction() as conn:
+            job_id = self.enqueue(conn, session_id, start_delay)
+        self.notify()
+        return job_id
+
+    def notify(self):
+        """Wake this process's worker, if it runs one; the server's watcher
+        picks up jobs enqueued elsewhere."""
+        with self._wake:
+            self._signals += 1
+            self._wake.notify_all()
+
+    def depth(self):
+        """Number of jobs queued or running."""
+        with db_connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM sanitization_jobs WHERE status IN ('QUEUED', 'RUNNING')"
+            ).fetchone()[0]
+
+    def admit(self):
+        """Whether a new payment may be taken; counts refusals."""
+        if not self.max_depth or self.depth() < self.max_depth:
+            return True
+        self.refused += 1
+        return False
+
+    def position(self, session_id):
+        """Queue position and wait estimate for a session's job, or None.
         
-        # PayMongo returns the QR code as base64 PNG
-        qr_image_data = attributes.get('qr_image')
-        reference_id = attributes.get('reference_id')
+        position is 1 for the running (or next) job; wait_seconds is the
+        estimated time until this job starts, eta_seconds until it finishes.
+        """
+        with db_connection() as conn:
+            job = conn.execute(
+                "SELECT id, status, start_delay, started_ts FROM sanitization_jobs WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            if job["status"] not in ("QUEUED", "RUNNING"):
+                return {"status": job["status"], "position": 0, "jobs_ahead": 0,
+                        "wait_seconds": 0, "eta_seconds": 0}
+            ahead = conn.execute('''
+                SELECT status, start_delay, started_ts FROM sanitization_jobs
+                WHERE status IN ('QUEUED', 'RUNNING') AND id < ?
+            ''', (job["id"],)).fetchall()
         
-        if not qr_image_data:
-            print(f"❌ No QR code image in response")
-            return jsonify({"error": "No QR code received"}), 400
+        now = now_ts()
+        wait = sum(self._remaining(row, now) for row in ahead)
+        return {
+            "status": job["status"],
+            "position": len(ahead) + 1,
+            "jobs_ahead": len(ahead),
+            "wait_seconds": round(wait),
+            "eta_seconds": round(wait + self._remaining(job, now))
+        }
+
+    def start(self):
+        """Start the hardware worker (idempotent)."""
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            now = now_ts()
+            with db_transaction() as conn:
+                expired = conn.execute('''
+                    UPDATE sanitization_jobs SET status = 'EXPIRED', finished_ts = ?
+                    WHERE enqueued_ts < ? AND (status = 'QUEUED' OR (status = 'RUNNING'
+                          AND (lease_until IS NULL OR lease_until < ?)))
+                ''', (now, now - self.max_age, now)).rowcount
+                self._last_seen_id = conn.execute(
+                    "SELECT COALESCE(MAX(id), 0) FROM sanitization_jobs"
+                ).fetchone()[0]
+            if expired:
+                log.warning("⚠️ Expired %s stale sanitization job(s)", expired)
+            self._thread = threading.Thread(target=self._work, name="sanitizer-worker", daemon=True)
+            self._thread.start()
+            self._watcher = threading.Thread(target=self._watch, name="sanitizer-watch", daemon=True)
+            self._watcher.start()
+        log.info("🧼 Sanitizer worker started (max queue %s)", self.max_depth or "unlimited")
+
+    def stop(self):
+        self._stop.set()
+        with self._wake:
+            self._wake.notify_all()
+        for thread in (self._thread, self._watcher):
+            if thread is not None:
+                thread.join(timeout=1)
+        self._thread = None
+        self._watcher = None
+
+    def stats(self):
+        with db_connection() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM sanitization_jobs GROUP BY status"
+            ).fetchall())
+        return {
+            "worker_alive": bool(self._thread and self._thread.is_alive()),
+            "owner": self.owner,
+            "queued": counts.get("QUEUED", 0),
+            "running": counts.get("RUNNING", 0),
+            "max_depth": self.max_depth,
+            "avg_cycle_seconds": round(self.avg_duration, 1),
+            "completed": self.completed,
+            "failed": self.failed,
+            "refused_payments": self.refused
+        }
+
+    def _remaining(self, job, now):
+        """Estimated seconds left for a queued or running job."""
+        total = job["start_delay"] + self.avg_duration
+        if job["status"] == "RUNNING" and job["started_ts"]:
+            return max(total - (now - job["started_ts"]), 0)
+        return total
+
+    def _claim(self):
+        """Take the oldest QUEUED job, or a RUNNING one whose owner's lease ran out."""
+        now = now_ts()
+        with db_transaction() as conn:
+            job = conn.execute('''
+                SELECT id, session_id, start_delay, status, owner FROM sanitization_jobs
+                WHERE status = 'QUEUED'
+                   OR (status = 'RUNNING' AND (lease_until IS NULL OR lease_until < ?))
+                ORDER BY id LIMIT 1
+            ''', (now,)).fetchone()
+            if job:
+                lease_until = now + math.ceil(job["start_delay"] + self.cycle_estimate + self.lease_grace)
+                conn.execute('''
+                    UPDATE sanitization_jobs SET status = 'RUNNING', started_ts = ?, owner = ?, lease_until = ?
+                    WHERE id = ?
+                ''', (now, self.owner, lease_until, job["id"]))
+        if job and job["status"] == "RUNNING":
+            log.warning("🧼 Taking over sanitization job %s from %s (lease expired)", job["id"], job["owner"])
+        return job
+
+    def _work(self):
+        while not self._stop.is_set():
+            with self._wake:
+                seen = self._signals
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._run(job)
+                    continue
+            except Exception as e:
+                log.warning("⚠️ Sanitizer worker error: %s", e)
+            
+            with self._wake:
+                if self._signals == seen and not self._stop.is_set():
+                    self._wake.wait(timeout=60)
+
+    def _watch(self):
+        while not self._stop.wait(self.watch_interval):
+            try:
+                self._pick_up_new_jobs()
+            except Exception as e:
+                log.warning("⚠️ Sanitizer watcher error: %s", e)
+
+    def _pick_up_new_jobs(self):
+        """Refresh payments whose jobs were enqueued since the last look.
+        
+        Confirmations made in this process already wrote PAID through to
+        payment_cache and are skipped.
+        """
+        with db_connection() as conn:
+            rows = conn.execute('''
+                SELECT j.id, p.reference FROM sanitization_jobs j
+                LEFT JOIN sanitization_sessions s ON s.id = j.session_id
+                LEFT JOIN payments p ON p.id = s.payment_id
+                WHERE j.id > ? ORDER BY j.id
+            ''', (self._last_seen_id,)).fetchall()
+        if not rows:
+            return
+        self._last_seen_id = rows[-1]["id"]
+        
+        for row in rows:
+            reference = row["reference"]
+            cached = payment_cache.get(reference) if reference else None
+            if reference and (cached is None or cached.status != "PAID"):
+                payment_cache.invalidate(reference)
+                status_waiters.notify(reference)
+                log.info("🔁 Picked up payment %s confirmed by another process", reference)
+        self.notify()
+
+    def _run(self, job):
+        """Run one job: start delay, relay sequence, then complete the session."""
+        session_id = job["session_id"]
+        log.info("⏱️ SANITIZATION TIMER STARTED - session %s, waiting %s seconds before relay sequence",
+                 session_id, job["start_delay"])
+        
+        # Wait for sanitization to prepare
+        self.clock.sleep(job["start_delay"])
         
-        print(f"   QRPh ID: {qrph_id}")
-        print(f"   Reference ID: {reference_id}")
+        log.info("🚀 SANITIZATION TIMER REACHED - STARTING RELAY SEQUENCE")
+        started = self.clock.monotonic()
+        status, error, timings = "DONE", None, []
+        try:
+            run_payment_relay_sequence(clock=self.clock, timings=timings)
+        except Exception as e:
+            status, error = "FAILED", repr(e)[:500]
+        finally:
+            duration = self.clock.monotonic() - started
+            if session_id is not None and status == "DONE":
+                complete_sanitization_session(session_id, duration)
+                log.info("✅ Sanitization session %s complete (%.1fs)", session_id, duration)
+            elif session_id is not None:
+                fail_sanitization_session(session_id, duration)
+                log.error("❌ Sanitization session %s failed after %.1fs: %s", session_id, duration, error)
+            with db_transaction() as conn:
+                conn.executemany('''
+                    INSERT INTO phase_events
+                    (job_id, session_id, phase, nominal_start, nominal_seconds, started_ts, ended_ts)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(job["id"], session_id, *t) for t in timings])
+                conn.execute('''
+                    UPDATE sanitization_jobs SET status = ?, finished_ts = ?, last_error = ?
+                    WHERE id = ? AND owner = ?
+                ''', (status, now_ts(), error, job["id"], self.owner))
         
-        # Extract base64 data
-        if 'base64,' in qr_image_data:
-            qr_b64 = qr_image_data.split('base64,')[1]
+        if status == "DONE":
+            self.avg_duration = 0.7 * self.avg_duration + 0.3 * duration
+            self.completed += 1
         else:
-            qr_b64 = qr_image_data
+            self.failed += 1
+
+
+sanitizer_queue = SanitizerQueue(
+    max_depth=SANITIZER_MAX_QUEUE,
+    max_age=SANITIZER_JOB_MAX_AGE,
+    cycle_estimate=SANITIZATION_CYCLE_SECONDS,
+    clock=kiosk_clock,
+    lease_grace=SANITIZER_LEASE_GRACE,
+    watch_interval=SANITIZER_WATCH_INTERVAL
+)
+
+
+# ========================================
+# HELPER FUNCTIONS
+# ========================================
+ConfirmResult = namedtuple("ConfirmResult", "found won payment_id session_id")
+
+
+def confirm_payment(reference, paymongo_payment_id=None, delay_seconds=2):
+    """Confirm a payment: the single PENDING → PAID path used by every route.
+
+    The status change is a compare-and-set (UPDATE ... WHERE status =
+    'PENDING'), and the sanitization session and stats deltas are written in
+    the same transaction together with the sanitizer job. Only the caller
+    whose UPDATE matched ("won") enqueues that job, so racing webhook/poll/
+    manual paths cannot create a second session or run the relays twice.
+    Losers get the existing session back.
+    """
+    paid_ts = now_ts()
+    
+    with db_transaction() as conn:
+        c = conn.execute('''
+            UPDATE payments
+            SET status = 'PAID', paid_at = ?, paid_ts = ?, paymongo_id = COALESCE(?, paymongo_id)
+            WHERE reference = ? AND status = 'PENDING'
+        ''', (datetime.fromtimestamp(paid_ts), paid_ts, paymongo_payment_id, reference))
+        won = c.rowcount == 1
+        
+        payment = conn.execute(
+            'SELECT id, payment_method, amount FROM payments WHERE reference = ?', (reference,)
+        ).fetchone()
+        if not payment:
+            return ConfirmResult(False, False, None, None)
+        
+        if won:
+            _count_paid_payment(conn, payment["id"])
+            session_id = save_sanitization_session(payment["id"])
+            sanitizer_queue.enqueue(conn, session_id, start_delay=delay_seconds)
+        else:
+            session = conn.execute(
+                'SELECT id FROM sanitization_sessions WHERE payment_id = ? ORDER BY id DESC LIMIT 1',
+                (payment["id"],)
+            ).fetchone()
+            session_id = session[0] if session else None
+    
+    if not won:
+        log.info("ℹ️ Payment %s was already confirmed (session %s)", reference, session_id)
+        return ConfirmResult(True, False, payment["id"], session_id)
+    
+    # Write through to the status cache
+    payment_cache.put(PaymentRecord(
+        reference, payment["id"], "PAID", payment["payment_method"], payment["amount"], session_id
+    ))
+    
+    log.info("💳 PAYMENT CONFIRMED - %s - Session %s queued for the sanitizer", reference, session_id)
+    
+    # Wake kiosks waiting on /payment_events or /wait_payment
+    status_waiters.notify(reference)
+    
+    # Wake the sanitizer worker (only after the commit above)
+    sanitizer_queue.notify()
+    
+    return ConfirmResult(True, True, payment["id"], session_id)
+
+
+@app.template_filter("localtime")
+def format_localtime(ts, fmt="%Y-%m-%d %H:%M:%S"):
+    """Render an epoch *_ts column in kiosk local time."""
+    return datetime.fromtimestamp(ts).strftime(fmt) if ts else "-"
+
+
+def conditional_status(record, build_body):
+    """Answer a status poll for record, honouring If-None-Match.
+    
+    Returns a bodiless 304 when the client already holds record.etag;
+    otherwise calls build_body() and returns it as JSON with the ETag set.
+    """
+    if request.if_none_match.contains(record.etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_body())
+    response.set_etag(record.etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def login_required(f):
+    """Admin login decorator."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'admin_logged_in' not in session:
+            return redirect(url_for('admin_login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def create_paymongo_headers():
+    """Create authenticated headers for PayMongo API.
+    
+    Called once to build paymongo_client; use the client for requests.
+    """
+    auth_string = f"{PAYMONGO_SECRET_KEY}:"
+    auth_b64 = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
+    
+    return {
+        "accept": "application/json",
+        "Content-Type": "application/json",
+        "authorization": f"Basic {auth_b64}"
+    }
+
+
+paymongo_client = PayMongoClient(
+    upstream,
+    PAYMONGO_API_URL,
+    create_paymongo_headers(),
+    CircuitBreaker(
+        "PayMongo",
+        window=GATEWAY_WINDOW_SECONDS,
+        min_calls=GATEWAY_MIN_CALLS,
+        error_rate=GATEWAY_ERROR_RATE,
+        cooldown=GATEWAY_COOLDOWN_SECONDS
+    ),
+    pool_size=PAYMONGO_POOL_SIZE,
+    retries=PAYMONGO_RETRIES,
+    backoff=PAYMONGO_BACKOFF,
+    timeout=PAYMONGO_TIMEOUT
+)
+
+# ========================================
+# KIOSK ROUTES
+# ========================================
+
+@app.route("/")
+def home():
+    """Main kiosk screen."""
+    return render_template("index.html", qr_available=paymongo_client.breaker.available(),
+                           qr_unavailable_message=GATEWAY_UNAVAILABLE_MESSAGE)
+
+
+@app.route("/gateway_status")
+def gateway_status():
+    """Whether QR payments can be offered right now (polled by the index page)."""
+    available = paymongo_client.breaker.available()
+    return jsonify({
+        "qr_available": available,
+        "message": None if available else GATEWAY_UNAVAILABLE_MESSAGE
+    })
+
+
+@app.route("/pay/qr")
+def qr_payment():
+    """QRPh payment screen."""
+    return render_template("qr_payment.html")
+
+
+@app.route("/solana_pay")
+def solana_pay():
+    """Render Solana Pay payment page."""
+    return render_template("solana_payment.html")
+
+
+@app.route("/pay/cash")
+def cash_payment():
+    """Cash payment screen."""
+    return render_template("cash_payment.html")
+
+
+@app.route("/rating/<session_id>")
+def rating_page(session_id):
+    """Rating page."""
+    return render_template("rating.html", session_id=session_id)
+
+
+@app.route("/debug")
+@login_required
+def debug_page():
+    """Webhook debugger page."""
+    return render_template("debug.html")
+
+# ========================================
+# QR IMAGES
+# ========================================
+
+QR_IMAGE_CACHE_SIZE = int(os.getenv("QR_IMAGE_CACHE_SIZE", "128"))
+QR_IMAGE_MAX_AGE = 600  # seconds; a reference's QR never changes, and the kiosk shows it for 10 minutes
+QR_IMAGE_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+class QRImageCache:
+    """Bounded LRU cache of encoded QR images keyed by (reference, format).
+    
+    Solana Pay images are rendered on their first request. QRPh images come
+    from PayMongo as PNGs; they are put here when the code is handed out
+    and reloaded from the qrph_images table after a restart or eviction.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+
+    def get(self, reference, fmt):
+        key = (reference, fmt)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, reference, fmt, data):
+        key = (reference, fmt)
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return data
+
+    def render(self, reference, fmt, content):
+        """Render content as a QR image and cache it under (reference, fmt)."""
+        data = render_qr(content, fmt)
+        with self._lock:
+            self.renders += 1
+        return self.put(reference, fmt, data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "renders": self.renders,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+def render_qr(content, fmt="png"):
+    """Encode content as a QR code image; returns PNG or SVG bytes."""
+    qr = qrcode.QRCode(version=1, box_size=10, border=4)
+    qr.add_data(content)
+    qr.make(fit=True)
+    
+    buffer = BytesIO()
+    if fmt == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+qr_images = QRImageCache(maxsize=QR_IMAGE_CACHE_SIZE)
+
+
+def save_qrph_image(payment_id, png):
+    """Store PayMongo's PNG for a QRPh payment."""
+    with db_transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO qrph_images (payment_id, png) VALUES (?, ?)', (payment_id, png))
+
+
+def load_qrph_image(payment_id):
+    """PayMongo's PNG for a QRPh payment, or None if it was never stored."""
+    with db_connection() as conn:
+        row = conn.execute('SELECT png FROM qrph_images WHERE payment_id = ?', (payment_id,)).fetchone()
+    return bytes(row[0]) if row else None
+
+
+@app.route("/qr/<ref>.<fmt>", methods=["GET"])
+def qr_image(ref, fmt):
+    """Serve a payment's QR code as PNG or SVG.
+    
+    The image for a reference never changes, so it is sent with a long
+    private max-age and an ETag; repeat loads are 304s or browser cache hits.
+    QRPh codes are PayMongo's PNG, so they have no SVG (406).
+    """
+    if fmt not in QR_IMAGE_TYPES:
+        return jsonify({"error": "Unsupported format", "formats": list(QR_IMAGE_TYPES)}), 404
+    
+    etag = f"qr-{ref}-{fmt}"
+    data = qr_images.get(ref, fmt)
+    if data is None:
+        # Checked before If-None-Match, so an unknown reference is a 404, not a 304
+        payment = get_payment_status(ref)
+        if not payment:
+            return jsonify({"error": "Payment not found"}), 404
+        if payment.method not in ("SOLANA", "QRPH"):
+            return jsonify({"error": "QR image not available"}), 404
+        if payment.method == "QRPH" and fmt != "png":
+            return jsonify({"error": "QRPh codes are only available as PNG", "formats": ["png"]}), 406
+    
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        if data is None and payment.method == "SOLANA":
+            data = qr_images.render(ref, fmt, solana_pay_url(ref))
+        elif data is None:
+            data = load_qrph_image(payment.id)
+            if data is None:
+                return jsonify({"error": "QR image not available"}), 404
+            qr_images.put(ref, fmt, data)
+        response = app.response_class(data, mimetype=QR_IMAGE_TYPES[fmt])
+    
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"private, max-age={QR_IMAGE_MAX_AGE}, immutable"
+    return response
+
+
+# ========================================
+# PAYMONGO QRPh PAYMENT
+# ========================================
+
+QR_POOL_SIZE = int(os.getenv("QR_POOL_SIZE", "2"))  # 0 disables the pool
+QR_POOL_MAX_AGE = int(os.getenv("QR_POOL_MAX_AGE", "1200"))  # seconds; discard well before PayMongo expires the code
+QR_POOL_RETRY_SECONDS = 30
+
+
+class PayMongoError(Exception):
+    """PayMongo answered a request with an error response."""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+def generate_qrph_payment(pooled=False):
+    """Generate a QRPh code at PayMongo and save it as a PENDING payment.
+    
+    pooled=True leaves the payment unclaimed for QRPhPool. Returns a dict
+    with reference, qrph_id, reference_id, qr_png and amount. Raises
+    PayMongoError or UpstreamError on failure.
+    """
+    reference = f"helmet-{int(time.time())}-{os.urandom(3).hex()}"
+    amount = PAYMENT_AMOUNT
+    
+    # Create QRPh payment
+    payload = {
+        "data": {
+            "attributes": {
+                "kind": "instore",
+                "amount": int(amount * 100),
+                "currency": "PHP",
+                "reference_number": reference,
+                "description": f"Helmet Sanitization - Ref: {reference}",
+                "metadata": {
+                    "reference_number": reference,
+                    "product": "helmet_sanitization",
+                    "kiosk_id": "helmet_kiosk_001"
+                }
+            }
+        }
+    }
+    
+    log.info("🔵 Creating PayMongo QRPh for ₱%s (reference %s)", amount, reference)
+    
+    # Call the QRPh endpoint over the pooled keep-alive connection
+    response = paymongo_client.post("/qrph/generate", json=payload)
+    
+    log.debug("Response Status: %s", response.status_code)
+    
+    if response.status_code not in [200, 201]:
+        log.error("❌ PayMongo Error: %s", response.text)
+        raise PayMongoError("Payment gateway error", response.text)
+    
+    response_data = response.json()
+    
+    # Extract QR code from response
+    qrph_data = response_data.get('data', {})
+    qrph_id = qrph_data.get('id')
+    attributes = qrph_data.get('attributes', {})
+    
+    # PayMongo returns the QR code as base64 PNG
+    qr_image_data = attributes.get('qr_image')
+    reference_id = attributes.get('reference_id')
+    
+    if not qr_image_data:
+        log.error("❌ No QR code image in response")
+        raise PayMongoError("No QR code received")
+    
+    log.debug("QRPh ID: %s, Reference ID: %s", qrph_id, reference_id)
+    
+    # Extract base64 data; the PNG is served from /qr/<ref>.png, not inlined in JSON
+    if 'base64,' in qr_image_data:
+        qr_b64 = qr_image_data.split('base64,')[1]
+    else:
+        qr_b64 = qr_image_data
+    qr_png = base64.b64decode(qr_b64)
+    
+    # Save to database (also caches the PENDING status), then keep the image
+    payment_id = save_payment(
+        reference=reference,
+        method='QRPH',
+        amount=amount,
+        status='PENDING',
+        paymongo_id=qrph_id,
+        qr_code=reference_id,
+        reference_id=reference_id,
+        pooled=pooled
+    )
+    save_qrph_image(payment_id, qr_png)
+    
+    return {
+        "payment_id": payment_id,
+        "reference": reference,
+        "qrph_id": qrph_id,
+        "reference_id": reference_id,
+        "qr_png": qr_png,
+        "amount": amount
+    }
+
+
+class QRPhPool:
+    """Small pool of pre-generated QRPh codes.
+    
+    A daemon filler keeps `size` codes on hand, each already saved as a
+    PENDING payment with claimed_ts NULL, so create_payment can answer
+    without waiting on PayMongo. Handing a code out sets claimed_ts; until
+    then the amount-only webhook fallback ignores it, as no customer can
+    have paid it. Codes older than max_age are marked EXPIRED and replaced,
+    and unclaimed codes left by an earlier run are expired when the pool
+    starts. On a miss create_payment generates inline and the miss latency
+    is recorded.
+    """
+
+    def __init__(self, size=2, max_age=1200, retry_seconds=30):
+        self.size = size
+        self.max_age = max_age
+        self.retry_seconds = retry_seconds
+        self._entries = []  # (generated_at, qr), oldest first
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._recovered = False
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.expired = 0
+        self.failures = 0
+        self.miss_ms_total = 0.0
+        self.last_miss_ms = None
+
+    def start(self):
+        """Start the filler thread (idempotent; no-op when size is 0).
         
-        # Save to database
-        payment_id = save_payment(
-            reference=reference,
-            method='QRPH',
-            amount=amount,
-            status='PENDING',
-            paymongo_id=qrph_id,
-            qr_code=reference_id,
-            reference_id=reference_id
-        )
+        The first call also expires unclaimed codes a previous run left behind.
+        """
+        self._expire_leftovers()
+        with self._lock:
+            if self.size <= 0 or self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._fill_loop, name="qrph-pool", daemon=True)
+        self._thread.start()
+        log.info("🧺 QRPh pool filler started (size %s)", self.size)
+
+    def stop(self):
+        """Stop the filler and expire the codes nobody was shown."""
+        self._stop.set()
+        self._wake.set()
+        with self._lock:
+            leftovers, self._entries = self._entries, []
+            self._thread = None
+        for _, qr in leftovers:
+            self._expire(qr)
+
+    def take(self):
+        """Oldest fresh pooled code, or None on a miss. Wakes the filler."""
+        self.start()
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                generated_at, qr = self._entries.pop(0) if self._entries else (None, None)
+            if qr is None:
+                break
+            if now - generated_at >= self.max_age:
+                self._expire(qr)
+            elif self._claim(qr):
+                break
         
-        # Store in memory
-        payments[reference] = {
-            "id": payment_id,
-            "status": "PENDING",
-            "method": "QRPH",
-            "paymongo_id": qrph_id,
-            "reference_id": reference_id
-        }
+        with self._lock:
+            if qr is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._wake.set()
+        return qr
+
+    def generate_for_miss(self):
+        """Generate a code inline for a pool miss, recording the latency."""
+        started = time.monotonic()
+        try:
+            return generate_qrph_payment()
+        finally:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with self._lock:
+                self.miss_ms_total += elapsed_ms
+                self.last_miss_ms = round(elapsed_ms, 1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "target": self.size,
+                "max_age": self.max_age,
+                "running": self._thread is not None and self._thread.is_alive(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "generated": self.generated,
+                "expired": self.expired,
+                "failures": self.failures,
+                "avg_miss_ms": round(self.miss_ms_total / self.misses, 1) if self.misses else None,
+                "last_miss_ms": self.last_miss_ms
+            }
+
+    def _fill_loop(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            self._prune()
+            with self._lock:
+                short = len(self._entries) < self.size
+                oldest = self._entries[0][0] if self._entries else None
+            
+            if short:
+                try:
+                    qr = generate_qrph_payment(pooled=True)
+                except Exception as e:
+                    with self._lock:
+                        self.failures += 1
+                    log.warning("⚠️ QRPh pool refill failed: %s", e)
+                    self._stop.wait(self.retry_seconds)
+                    continue
+                if self._stop.is_set():
+                    self._expire(qr)
+                    break
+                with self._lock:
+                    self._entries.append((time.monotonic(), qr))
+                    self.generated += 1
+                continue
+            
+            # Full: sleep until the oldest code ages out or a take() wakes us
+            self._wake.wait(max(self.max_age - (time.monotonic() - oldest), 0))
+
+    def _prune(self):
+        now = time.monotonic()
+        with self._lock:
+            stale = [qr for generated_at, qr in self._entries if now - generated_at >= self.max_age]
+            self._entries = [(t, qr) for t, qr in self._entries if now - t < self.max_age]
+        for qr in stale:
+            self._expire(qr)
+
+    def _expire(self, qr):
+        with db_transaction() as conn:
+            conn.execute("UPDATE payments SET status = 'EXPIRED' WHERE id = ? AND status = 'PENDING'",
+                         (qr["payment_id"],))
+            conn.execute("DELETE FROM qrph_images WHERE payment_id = ?", (qr["payment_id"],))
+        payment_cache.invalidate(qr["reference"])
+        with self._lock:
+            self.expired += 1
+        log.info("⏰ Discarded unused pooled QRPh %s", qr['reference'])
+
+    def _claim(self, qr):
+        """Mark a pooled payment handed out, restamping its creation time."""
+        created_ts = now_ts()
+        with db_transaction() as conn:
+            claimed = conn.execute('''
+                UPDATE payments SET created_at = datetime(?, 'unixepoch'), created_ts = ?, claimed_ts = ?
+                WHERE id = ? AND status = 'PENDING' AND claimed_ts IS NULL
+            ''', (created_ts, created_ts, created_ts, qr["payment_id"])).rowcount
+        return claimed == 1
+
+    def _expire_leftovers(self):
+        """Expire unclaimed codes from an earlier run (once per process)."""
+        with self._lock:
+            if self._recovered:
+                return
+            self._recovered = True
+        with db_transaction() as conn:
+            expired = conn.execute('''
+                UPDATE payments SET status = 'EXPIRED'
+                WHERE status = 'PENDING' AND payment_method = 'QRPH' AND claimed_ts IS NULL
+            ''').rowcount
+            conn.execute('''
+                DELETE FROM qrph_images WHERE payment_id IN
+                    (SELECT id FROM payments WHERE status = 'EXPIRED' AND claimed_ts IS NULL)
+            ''')
+        if expired:
+            with self._lock:
+                self.expired += expired
+            log.info("⏰ Expired %s unclaimed pooled QRPh code(s) from an earlier run", expired)
+
+
+qrph_pool = QRPhPool(size=QR_POOL_SIZE, max_age=QR_POOL_MAX_AGE, retry_seconds=QR_POOL_RETRY_SECONDS)
+
+
+@app.route("/create_payment", methods=["POST"])
+def create_payment():
+    """Create PayMongo QRPh payment, handing out a pre-generated code when one is pooled."""
+    if not sanitizer_queue.admit():
+        return jsonify({"error": SANITIZER_BUSY_MESSAGE, "queue_depth": sanitizer_queue.depth()}), 503
+    
+    try:
+        # A pooled code needs no PayMongo call, so it is handed out even
+        # while the breaker is open; only a fresh code has to wait for it
+        qr = qrph_pool.take()
+        if qr is None:
+            if not paymongo_client.breaker.available():
+                return jsonify({"error": GATEWAY_UNAVAILABLE_MESSAGE, "use_cash": True}), 503
+            qr = qrph_pool.generate_for_miss()
         
-        print(f"✅ PayMongo QRPh Payment Created Successfully")
+        qr_images.put(qr["reference"], "png", qr["qr_png"])
+        log.info("✅ PayMongo QRPh Payment Created Successfully")
         
         return jsonify({
             "success": True,
-            "reference": reference,
-            "qr_image": qr_b64,
-            "amount": f"₱{amount:.2f}",
-            "reference_id": reference_id,
+            "reference": qr["reference"],
+            "qr_url": url_for("qr_image", ref=qr["reference"], fmt="png"),
+            "amount": f"₱{qr['amount']:.2f}",
+            "reference_id": qr["reference_id"],
             "gateway": "PayMongo QRPh",
-            "qrph_id": qrph_id
+            "qrph_id": qr["qrph_id"]
         })
     
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Network Error: {e}")
+    except PayMongoError as e:
+        return jsonify({"error": str(e), "details": e.details}), 400
+    
+    except CircuitOpenError:
+        return jsonify({"error": GATEWAY_UNAVAILABLE_MESSAGE, "use_cash": True}), 503
+    
+    except UpstreamError as e:
+        log.error("❌ Network Error: %s", e)
         return jsonify({"error": "Network error", "details": str(e)}), 500
     
     except Exception as e:
-        print(f"❌ Error creating payment: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Error creating payment: %s", e)
         return jsonify({"error": "Server error", "details": str(e)}), 500
 
 
 @app.route("/check_payment/<ref>", methods=["GET"])
 def check_payment(ref):
     """Check payment status and trigger relay if PAID."""
-    print(f"🔍 Checking payment: {ref}")
+    log.debug("🔍 Checking payment: %s", ref)
     
-    # Check database first
-    payment = get_payment_by_reference(ref)
+    # Served from the status cache; falls back to the database on a miss
+    payment = get_payment_status(ref)
     if not payment:
         return jsonify({"status": "NOT_FOUND"}), 404
     
-    # If already paid, trigger relay and return
-    if payment["status"] == "PAID":
-        # Get session ID if exists
-        conn = get_db()
-        c = conn.cursor()
-        c.execute('SELECT id FROM sanitization_sessions WHERE payment_id = ? ORDER BY id DESC LIMIT 1', (payment["id"],))
-        session = c.fetchone()
-        conn.close()
+    # For testing/demo: Allow manual marking as paid via query parameter
+    if payment.status == "PENDING" and request.args.get('test') == 'true':
+        log.info("🧪 Test mode: Manually marking %s as PAID", ref)
+        confirm_payment(ref)
+        payment = get_payment_status(ref)
+    
+    # If already paid, report the session created at confirmation
+    if payment.status == "PAID":
+        return conditional_status(payment, lambda: {
+            "status": "PAID",
+            "session_id": payment.session_id,
+            "message": "Payment confirmed - relay triggered"
+        })
+    
+    return conditional_status(payment, lambda: {"status": payment.status})
 
-        session_id = session[0] if session else None
+def payment_status_payload(ref, payment):
+    """Status body shared by the push/long-poll endpoints."""
+    if not payment:
+        return {"status": "NOT_FOUND", "reference": ref}
+    return {"status": payment.status, "session_id": payment.session_id, "reference": ref}
 
-        # If no session exists yet, create one and trigger relay
-        if not session_id:
-            print(f"✅ Payment PAID detected - creating session and triggering relay")
-            session_id = save_sanitization_session(payment["id"])
-            print(f"Triggering sanitizer for session {session_id} from check_payment route.")
-            trigger_sanitizer_background(session_id)
-        else:
-            print(f"Session {session_id} already exists for payment {ref}.")
 
+@app.route("/payment_events/<ref>", methods=["GET"])
+def payment_events(ref):
+    """Server-Sent Events stream of a payment's status.
+    
+    Sends the current status at once, then again whenever it changes, with
+    keepalive comments in between. The stream ends once the payment leaves
+    PENDING, is unknown, or after STATUS_STREAM_MAX_SECONDS.
+    """
+    def generate():
+        deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+        last_sent = None
+        while True:
+            with status_waiters.watch(ref) as changed:
+                payload = payment_status_payload(ref, get_payment_status(ref))
+                if payload != last_sent:
+                    yield f"event: status\ndata: {json.dumps(payload)}\n\n"
+                    last_sent = payload
+                if payload["status"] != "PENDING":
+                    return
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    yield "event: timeout\ndata: {}\n\n"
+                    return
+                if not changed.wait(min(STATUS_KEEPALIVE_SECONDS, remaining)):
+                    yield ": keepalive\n\n"
+    
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+@app.route("/wait_payment/<ref>", methods=["GET"])
+def wait_payment(ref):
+    """Long-poll fallback for /payment_events.
+    
+    Returns as soon as the status differs from ?status= (default PENDING),
+    or after ?timeout= seconds (max 30) with the unchanged status. A client
+    sending If-None-Match waits on that version instead, and gets a 304 if
+    it is still current at the timeout.
+    """
+    known_status = request.args.get("status", "PENDING")
+    timeout = min(request.args.get("timeout", 25, type=float), LONG_POLL_MAX_SECONDS)
+    
+    def unchanged(payment):
+        if request.if_none_match:
+            return request.if_none_match.contains(payment.etag)
+        return payment.status == known_status
+    
+    with status_waiters.watch(ref) as changed:
+        payment = get_payment_status(ref)
+        if payment and unchanged(payment):
+            changed.wait(max(timeout, 0))
+            payment = get_payment_status(ref)
+    
+    if not payment:
+        return jsonify(payment_status_payload(ref, payment)), 404
+    return conditional_status(payment, lambda: payment_status_payload(ref, payment))
+
+
+@app.route("/check_payments", methods=["POST"])
+def check_payments():
+    """Batch status lookup.
+    
+    Body: {"references": [...]} (up to STATUS_BATCH_MAX). Returns each
+    reference's status and session id, NOT_FOUND for unknown ones.
+    """
+    data = request.get_json(silent=True) or {}
+    references = data.get("references")
+    if not isinstance(references, list) or not all(isinstance(r, str) for r in references):
+        return jsonify({"error": "references must be a list of strings"}), 400
+    if len(references) > STATUS_BATCH_MAX:
+        return jsonify({"error": f"At most {STATUS_BATCH_MAX} references per request"}), 400
+    
+    records = get_payment_statuses(references)
+    return jsonify({
+        "count": len(records),
+        "payments": {ref: payment_status_payload(ref, records.get(ref)) for ref in references}
+    })
+
+
+@app.route("/queue_position/<ref>", methods=["GET"])
+def queue_position(ref):
+    """Where a paid payment's sanitization cycle is in the sanitizer queue.
+    
+    Lets the kiosk show "You are #2, about 3 minutes" while earlier
+    customers' cycles run.
+    """
+    payment = get_payment_status(ref)
+    if not payment:
+        return jsonify({"status": "NOT_FOUND", "reference": ref}), 404
+    
+    position = sanitizer_queue.position(payment.session_id) if payment.session_id else None
+    if position is None or not position["position"]:
         return jsonify({
-            "status": "PAID",
-            "session_id": session_id,
-            "message": "Payment confirmed - relay triggered"
+            "reference": ref,
+            "payment_status": payment.status,
+            "job_status": position["status"] if position else None,
+            "queued": False
         })
     
-    # For testing/demo: Allow manual marking as paid via query parameter
-    if request.args.get('test') == 'true':
-        print(f"🧪 Test mode: Manually marking {ref} as PAID")
-        return mark_payment_as_paid(ref, payment["id"])
+    minutes = max(1, math.ceil(position["eta_seconds"] / 60))
+    return jsonify({
+        "reference": ref,
+        "session_id": payment.session_id,
+        "queued": True,
+        **position,
+        "message": f"You are #{position['position']}, about {minutes} minute{'s' if minutes != 1 else ''}"
+    })
+
+# ========================================
+# PAYMONGO WEBHOOK (FIXED VERSION)
+# ========================================
+
+@app.route("/paymongo_webhook", methods=["POST"])
+def paymongo_webhook():
+    """
+    PayMongo webhook endpoint.
+    
+    Only stores the raw event in webhook_inbox (keyed by event id, so
+    PayMongo's retries are dropped) and acknowledges; the inbox workers do
+    the actual processing.
+    """
+    raw_data = request.get_data(as_text=True)
     
-    return jsonify({"status": "PENDING"})
+    try:
+        data = json.loads(raw_data)
+    except json.JSONDecodeError as e:
+        log.error("❌ Webhook JSON parsing error: %s", e)
+        log.debug("📄 Raw data preview: %s", raw_data[:500])
+        return jsonify({"received": True}), 200
+    
+    event_id, event_type = webhook_event_key(data, raw_data)
+    stored = webhook_inbox.add(event_id, event_type, raw_data)
+    log.info("📩 PAYMONGO WEBHOOK RECEIVED: %s %s%s", event_type, event_id, '' if stored else ' (duplicate)')
+    
+    return jsonify({"received": True, "event_id": event_id, "duplicate": not stored}), 200
+
+
+def webhook_event_key(data, raw_data):
+    """(event_id, event_type) for a webhook body.
+    
+    The id is PayMongo's event id; bodies without one fall back to a hash
+    of the raw body so identical redeliveries still collapse.
+    """
+    event_type = data.get("type") or data.get("event")
+    event_id = None
+    
+    if data.get("data") and isinstance(data["data"], dict):
+        event_id = data["data"].get("id")
+        # Also check nested event type
+        if not event_type:
+            event_type = data["data"].get("attributes", {}).get("type")
+    
+    if not event_id:
+        event_id = "sha256:" + hashlib.sha256(raw_data.encode("utf-8")).hexdigest()
+    return event_id, event_type
+
 
+def handle_webhook_event(data, event_type):
+    """Process one PayMongo event. Returns a result dict; raises on
+    errors that are worth retrying."""
+    log.debug("🎯 Event Type: %s", event_type)
+    
+    # Handle payment.paid event
+    if event_type in ["payment.paid", "payment.success", "payment_success"]:
+        log.info("💰 PAYMENT PAID EVENT DETECTED - Will process and trigger brushing if possible.")
+        return process_webhook_payment(data)
+    elif event_type in ["payment.failed", "payment.failure"]:
+        log.warning("❌ PAYMENT FAILED EVENT")
+        return {"received": True}
+    elif event_type in ["qrpayment.expired", "qr.expired"]:
+        log.info("⏰ QR PAYMENT EXPIRED EVENT")
+        return {"received": True}
+    else:
+        log.warning("⚠️ Unhandled event type: %s - Will attempt to process as payment.", event_type)
+        return process_webhook_payment(data)
 
-def mark_payment_as_paid(ref, payment_db_id):
-    """Mark payment as paid and trigger relay sequence."""
-    # Update payment status
-    update_payment_status(ref, "PAID")
+
+def process_webhook_payment(data):
+    """Process payment webhook data. Returns a result dict."""
+    # Try different possible data structures
+    payment_data = None
+    event_data = None
+    
+    # NEW: Check if this is an event wrapper (payment.paid structure)
+    if data.get("data") and isinstance(data["data"], dict):
+        # This is the event attributes level
+        event_attrs = data["data"].get("attributes", {})
+        
+        # The actual payment is inside event_attrs.data
+        if event_attrs.get("data") and isinstance(event_attrs["data"], dict):
+            event_data = event_attrs["data"]
+            payment_data = event_data.get("attributes", {})
+            log.debug("📦 Found payment in event wrapper structure")
+        
+        # Fallback: direct attributes
+        elif data["data"].get("attributes"):
+            payment_data = data["data"]["attributes"]
+    
+    # Structure 2: direct attributes
+    elif data.get("attributes"):
+        payment_data = data["attributes"]
+    
+    if not payment_data:
+        log.error("❌ Could not extract payment data from webhook")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("🔍 Data structure: %s", json.dumps(data, indent=2)[:800])
+        return {"received": True}
+    
+    log.debug("📋 Payment data keys: %s", list(payment_data.keys()))
+    
+    # Extract amount and status
+    amount = payment_data.get("amount", 0)
+    if isinstance(amount, int):
+        amount = amount / 100  # Convert centavos to PHP
+    
+    status = payment_data.get("status", "")
+    description = payment_data.get("description", "")
+    
+    log.debug("💰 Amount: ₱%.2f", amount)
+    log.debug("📊 Status: %s", status)
+    log.debug("📝 Description: %s", description)
+    
+    # Get the payment ID from the event data
+    payment_id_from_webhook = None
+    if event_data:
+        payment_id_from_webhook = event_data.get("id")
+        log.debug("🆔 Payment ID: %s", payment_id_from_webhook)
+    
+    # NEW: Try to get the QRPh ID from the source
+    source = payment_data.get("source", {})
+    qrph_id = None
+    if isinstance(source, dict):
+        qrph_id = source.get("id")
+        log.debug("🔍 QRPh ID from source: %s", qrph_id)
+    
+    # Strategy 1: Get reference from metadata
+    metadata = payment_data.get("metadata") or {}
+    reference = metadata.get("reference_number") if isinstance(metadata, dict) else None
+    if reference:
+        log.info("✅ Reference from metadata: %s", reference)
+    
+    # Strategy 2: Get from billing
+    if not reference:
+        billing = payment_data.get("billing") or {}
+        reference = billing.get("reference_number") or billing.get("reference") if isinstance(billing, dict) else None
+        if reference:
+            log.info("✅ Reference from billing: %s", reference)
+    
+    # Strategy 3: Extract from description (QR id pattern)
+    if not reference and description:
+        # Look for our reference pattern first
+        match = re.search(r'helmet-\d+-[a-f0-9]+', description)
+        if match:
+            reference = match.group(0)
+            log.info("✅ Found reference in description: %s", reference)
     
-    # Create sanitization session
-    session_id = save_sanitization_session(payment_db_id)
+    # Strategy 4: NEW - Look up by QRPh ID (in-memory index, then database)
+    if not reference and qrph_id:
+        reference = reference_index.resolve("paymongo_id", qrph_id)
+        if reference:
+            log.info("✅ Found reference via QRPh ID (index): %s", reference)
     
-    # Update memory
-    if ref in payments:
-        payments[ref]["status"] = "PAID"
-        payments[ref]["session_id"] = session_id
+    if not reference and qrph_id:
+        log.debug("🔍 Searching database for QRPh ID: %s", qrph_id)
+        try:
+            with db_connection() as conn:
+                result = conn.execute('SELECT reference FROM payments WHERE paymongo_id = ?', (qrph_id,)).fetchone()
+            
+            if result:
+                reference = result[0]
+                log.info("✅ Found reference via QRPh ID: %s", reference)
+        except Exception as e:
+            log.warning("⚠️ Error searching by QRPh ID: %s", e)
     
-    print(f"\n💳 PAYMENT CONFIRMED - Session {session_id}")
+    # Strategy 5: NEW - Look up by reference_id or external_reference_number
+    if not reference:
+        external_ref = payment_data.get("external_reference_number") or payment_data.get("reference_id")
+        reference = reference_index.resolve("reference_id", external_ref)
+        if reference:
+            log.info("✅ Found reference via external reference (index): %s", reference)
+        elif external_ref:
+            log.debug("🔍 Searching database for external reference: %s", external_ref)
+            try:
+                with db_connection() as conn:
+                    result = conn.execute('SELECT reference FROM payments WHERE reference_id = ?', (external_ref,)).fetchone()
+                
+                if result:
+                    reference = result[0]
+                    log.info("✅ Found reference via external reference: %s", reference)
+            except Exception as e:
+                log.warning("⚠️ Error searching by external ref: %s", e)
     
-    # Run relay sequence in background thread
-    def run_sequence():
+    # Strategy 6: LAST RESORT - Search for most recent pending payment with matching amount
+    # (only codes shown to a customer; unclaimed pooled codes cannot have been paid)
+    if not reference and amount > 0:
+        log.info("🔍 Last resort: searching for pending payment with amount ₱%.2f", amount)
         try:
-            run_payment_relay_sequence()
+            with db_connection() as conn:
+                result = conn.execute('''
+                    SELECT reference FROM payments 
+                    WHERE status = 'PENDING' 
+                    AND payment_method = 'QRPH'
+                    AND claimed_ts IS NOT NULL
+                    AND amount = ?
+                    ORDER BY created_ts DESC 
+                    LIMIT 1
+                ''', (amount,)).fetchone()
+            
+            if result:
+                reference = result[0]
+                log.warning("⚠️ Matched by amount to pending payment: %s", reference)
         except Exception as e:
-            print(f"❌ Error in background relay sequence: {e}")
-        finally:
-            complete_sanitization_session(session_id)
-            update_daily_stats()
+            log.warning("⚠️ Error searching by amount: %s", e)
+    
+    if not reference:
+        log.error("❌ No reference found in webhook data after all strategies")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("📦 Full payment data: %s", json.dumps(payment_data, indent=2)[:1000])
+        return {"received": True, "error": "No reference found"}
+    
+    log.info("🎯 Processing payment for reference: %s", reference)
+    
+    # Find payment (index first, then database)
+    if not reference_index.resolve("reference", reference) and not get_payment_by_reference(reference):
+        log.warning("⚠️ Payment not found in database: %s", reference)
+        # Create new payment record; confirm_payment moves it to PAID below
+        payment_id = save_payment(
+            reference=reference,
+            method='QRPH',
+            amount=amount,
+            status='PENDING',
+            paymongo_id=payment_id_from_webhook or qrph_id
+        )
+        if payment_id:
+            log.info("✅ Created new payment record: %s", reference)
+        elif not get_payment_by_reference(reference):
+            raise RuntimeError(f"Failed to create payment record for {reference}")
     
-    thread = threading.Thread(target=run_sequence, daemon=True, name=f"relay-{session_id}")
-    thread.start()
-    print(f"✅ Relay sequence started in background thread")
+    log.debug("💳 Confirming payment...")
+    result = confirm_payment(reference, payment_id_from_webhook or qrph_id)
     
-    print(f"✅ Payment {ref} completed!")
+    # Skip if already paid
+    if not result.won:
+        log.info("✅ Payment already marked as PAID: %s", reference)
+        return {"received": True, "already_paid": True}
     
-    return jsonify({"status": "PAID", "session_id": session_id})
+    log.info("✅ Payment %s processed successfully via webhook!", reference)
+    
+    return {
+        "success": True,
+        "message": "Payment processed",
+        "reference": reference,
+        "session_id": result.session_id
+    }
 
 # ========================================
-# PAYMONGO WEBHOOK (FIXED VERSION)
+# WEBHOOK INBOX
 # ========================================
 
-@app.route("/paymongo_webhook", methods=["POST"])
-def paymongo_webhook():
-    """
-    PayMongo webhook endpoint - FIXED VERSION
-    """
-    print("\n" + "="*60)
-    print("📩 PAYMONGO WEBHOOK RECEIVED")
-    print("="*60)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_RETRY_BASE_SECONDS = 5  # 5s, 10s, 20s, 40s between attempts
+
+
+class WebhookInbox:
+    """Durable queue of received webhook events (the webhook_inbox table).
     
-    try:
-        # Get raw data and try to parse it
-        raw_data = request.get_data(as_text=True)
-        print(f"📦 Raw data length: {len(raw_data)} bytes")
+    add() is all the webhook endpoint does: INSERT OR IGNORE on the event
+    id, so a redelivered event is stored once. A pool of worker threads
+    claims due PENDING rows (PENDING -> PROCESSING under the write lock,
+    so each row goes to one worker), runs handle_webhook_event and marks
+    them DONE. A failing row goes back to PENDING with exponential backoff
+    and becomes FAILED after max_attempts. Rows left PROCESSING by a crash
+    are re-queued when the workers start.
+    """
+
+    def __init__(self, workers=2, max_attempts=5, retry_base=5):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self._wake = threading.Condition()
+        self._signals = 0  # bumped on every notify so a worker never sleeps through one
+        self._threads = []
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def add(self, event_id, event_type, body):
+        """Store an event. Returns False if event_id was already stored."""
+        received_ts = now_ts()
+        with db_transaction() as conn:
+            stored = conn.execute('''
+                INSERT OR IGNORE INTO webhook_inbox (event_id, event_type, body, received_ts, next_attempt_ts)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (event_id, event_type, body, received_ts, received_ts)).rowcount == 1
         
-        # Try to parse as JSON
-        try:
-            data = json.loads(raw_data)
-            print(f"📊 Parsed JSON successfully")
-            print(f"📋 Data keys: {list(data.keys())}")
+        if stored:
+            self.received += 1
+            self.start()
+            self._signal()
+        else:
+            self.duplicates += 1
+        return stored
+
+    def start(self):
+        """Start the worker threads (idempotent)."""
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            with db_transaction() as conn:
+                requeued = conn.execute(
+                    "UPDATE webhook_inbox SET status = 'PENDING' WHERE status = 'PROCESSING'"
+                ).rowcount
+            if requeued:
+                log.info("📥 Re-queued %s interrupted webhook event(s)", requeued)
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"webhook-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        log.info("📥 Webhook inbox started with %s worker(s)", self.workers)
+
+    def stop(self):
+        self._stop.set()
+        self._signal()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def retry_failed(self):
+        """Put FAILED rows back in the queue. Returns how many."""
+        with db_transaction() as conn:
+            count = conn.execute('''
+                UPDATE webhook_inbox SET status = 'PENDING', attempts = 0, next_attempt_ts = ?
+                WHERE status = 'FAILED'
+            ''', (now_ts(),)).rowcount
+        self._signal()
+        return count
+
+    def stats(self):
+        with db_connection() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM webhook_inbox GROUP BY status"
+            ).fetchall())
+        return {
+            "workers": sum(1 for t in self._threads if t.is_alive()),
+            "pending": counts.get("PENDING", 0),
+            "processing": counts.get("PROCESSING", 0),
+            "done": counts.get("DONE", 0),
+            "failed": counts.get("FAILED", 0),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "processed": self.processed,
+            "retried": self.retried
+        }
+
+    def _signal(self):
+        with self._wake:
+            self._signals += 1
+            self._wake.notify_all()
+
+    def _claim(self):
+        """Claim the oldest due PENDING row, or return (None, seconds until the next one)."""
+        now = now_ts()
+        with db_transaction() as conn:
+            row = conn.execute('''
+                SELECT id, event_id, event_type, body, attempts FROM webhook_inbox
+                WHERE status = 'PENDING' AND next_attempt_ts <= ?
+                ORDER BY next_attempt_ts, id LIMIT 1
+            ''', (now,)).fetchone()
+            if row:
+                conn.execute('''
+                    UPDATE webhook_inbox SET status = 'PROCESSING', attempts = attempts + 1 WHERE id = ?
+                ''', (row["id"],))
+                return row, None
+            
+            next_due = conn.execute(
+                "SELECT MIN(next_attempt_ts) FROM webhook_inbox WHERE status = 'PENDING'"
+            ).fetchone()[0]
+        return None, (max(next_due - now, 1) if next_due is not None else None)
+
+    def _work(self):
+        while not self._stop.is_set():
+            with self._wake:
+                seen = self._signals
+            try:
+                row, wait = self._claim()
+                if row is not None:
+                    self._process(row)
+                    continue
+            except Exception as e:
+                log.warning("⚠️ Webhook inbox worker error: %s", e)
+                wait = 5
             
-            # Log the full data structure for debugging
-            print("\n📋 WEBHOOK DATA STRUCTURE:")
-            print(json.dumps(data, indent=2)[:1000])  # First 1000 chars
+            with self._wake:
+                if self._signals == seen and not self._stop.is_set():
+                    self._wake.wait(timeout=min(wait, 60) if wait is not None else 60)
+
+    def _process(self, row):
+        attempts = row["attempts"] + 1
+        try:
+            with app.app_context():
+                result = handle_webhook_event(json.loads(row["body"]), row["event_type"])
+        except Exception as e:
+            log.exception("❌ Webhook event %s failed (attempt %s): %s", row['event_id'], attempts, e)
             
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON parsing error: {e}")
-            print(f"📄 Raw data preview: {raw_data[:500]}")
-            return jsonify({"received": True}), 200
-        
-        # Handle different webhook formats
-        event_type = data.get("type") or data.get("event")
-        
-        # Also check nested event type
-        if not event_type and data.get("data") and isinstance(data["data"], dict):
-            nested_attrs = data["data"].get("attributes", {})
-            event_type = nested_attrs.get("type")
-        
-        print(f"🎯 Event Type: {event_type}")
+            if attempts >= self.max_attempts:
+                status, next_attempt_ts = "FAILED", now_ts()
+                self.failed += 1
+            else:
+                status, next_attempt_ts = "PENDING", now_ts() + self.retry_base * 2 ** (attempts - 1)
+                self.retried += 1
+            with db_transaction() as conn:
+                conn.execute('''
+                    UPDATE webhook_inbox SET status = ?, next_attempt_ts = ?, last_error = ? WHERE id = ?
+                ''', (status, next_attempt_ts, repr(e)[:500], row["id"]))
+            return
         
-        # Handle payment.paid event
-        if event_type in ["payment.paid", "payment.success", "payment_success"]:
-            print("💰 PAYMENT PAID EVENT DETECTED - Will process and trigger brushing if possible.")
-            resp = process_webhook_payment(data)
-            print("Webhook processing response:", resp.get_json() if hasattr(resp, 'get_json') else resp)
-            return resp
-        elif event_type in ["payment.failed", "payment.failure"]:
-            print("❌ PAYMENT FAILED EVENT")
-            return jsonify({"received": True}), 200
-        elif event_type in ["qrpayment.expired", "qr.expired"]:
-            print("⏰ QR PAYMENT EXPIRED EVENT")
-            return jsonify({"received": True}), 200
-        else:
-            print(f"⚠️ Unhandled event type: {event_type} - Will attempt to process as payment.")
-            resp = process_webhook_payment(data)
-            print("Webhook processing response:", resp.get_json() if hasattr(resp, 'get_json') else resp)
-            return resp
+        with db_transaction() as conn:
+            conn.execute('''
+                UPDATE webhook_inbox SET status = 'DONE', processed_ts = ?, result = ?, last_error = NULL
+                WHERE id = ?
+            ''', (now_ts(), json.dumps(result, default=str), row["id"]))
+        self.processed += 1
+
+
+webhook_inbox = WebhookInbox(
+    workers=WEBHOOK_WORKERS,
+    max_attempts=WEBHOOK_MAX_ATTEMPTS,
+    retry_base=WEBHOOK_RETRY_BASE_SECONDS
+)
+
+# ========================================
+# PAYMENT RECONCILIATION
+# ========================================
+
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "30"))  # seconds between sweeps, ±RECONCILE_JITTER
+RECONCILE_JITTER = 0.2
+RECONCILE_MAX_INTERVAL = 300  # backoff ceiling after API errors / 429s
+RECONCILE_MIN_CALL_SPACING = float(os.getenv("RECONCILE_MIN_CALL_SPACING", "5"))  # seconds between API calls
+RECONCILE_PAGE_SIZE = 100
+
+
+class PaymentReconciler:
+    """Confirms pending payments whose confirmation never arrived.
     
-    except Exception as e:
-        print(f"❌ Webhook processing error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"received": True}), 200
+    Each sweep lists PENDING payments younger than QR_POOL_MAX_AGE that
+    were shown to a customer (not codes still sitting in the pool). For
+    QRPH ones it fetches PayMongo's most recent payments in one call; for
+    SOLANA ones with a submitted signature it asks the RPC node for their
+    statuses in one call. Both run concurrently on the upstream loop.
+    Paid QRPh entries that match a pending payment by reference, QRPh id
+    or reference id, and confirmed signatures, go through confirm_payment
+    exactly like a webhook. Sweeps are jittered, PayMongo calls are spaced
+    at least min_call_spacing apart, and the interval doubles (up to
+    max_interval) after errors.
+    """
 
+    def __init__(self, interval=30, jitter=0.2, max_interval=300, min_call_spacing=5, page_size=100):
+        self.interval = interval
+        self.jitter = jitter
+        self.max_interval = max_interval
+        self.min_call_spacing = min_call_spacing
+        self.page_size = page_size
+        self._delay = interval
+        self._next_call_at = 0.0
+        self._call_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.sweeps = 0
+        self.api_calls = 0
+        self.confirmed = 0
+        self.failures = 0
+        self.last_sweep = None
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="payment-reconciler", daemon=True)
+        self._thread.start()
+        log.info("🔁 Payment reconciler started (every ~%ss)", self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "interval": self.interval,
+            "current_delay": self._delay,
+            "sweeps": self.sweeps,
+            "api_calls": self.api_calls,
+            "confirmed": self.confirmed,
+            "failures": self.failures,
+            "last_sweep": self.last_sweep
+        }
 
-def process_webhook_payment(data):
-    """Process payment webhook data - FIXED VERSION."""
-    try:
-        # Try different possible data structures
-        payment_data = None
-        event_data = None
-        
-        # NEW: Check if this is an event wrapper (payment.paid structure)
-        if data.get("data") and isinstance(data["data"], dict):
-            # This is the event attributes level
-            event_attrs = data["data"].get("attributes", {})
-            
-            # The actual payment is inside event_attrs.data
-            if event_attrs.get("data") and isinstance(event_attrs["data"], dict):
-                event_data = event_attrs["data"]
-                payment_data = event_data.get("attributes", {})
-                print(f"📦 Found payment in event wrapper structure")
-            
-            # Fallback: direct attributes
-            elif data["data"].get("attributes"):
-                payment_data = data["data"]["attributes"]
-        
-        # Structure 2: direct attributes
-        elif data.get("attributes"):
-            payment_data = data["attributes"]
-        
-        if not payment_data:
-            print("❌ Could not extract payment data from webhook")
-            print(f"🔍 Data structure: {json.dumps(data, indent=2)[:800]}")
-            return jsonify({"received": True}), 200
-        
-        print(f"📋 Payment data keys: {list(payment_data.keys())}")
-        
-        # Extract amount and status
-        amount = payment_data.get("amount", 0)
-        if isinstance(amount, int):
-            amount = amount / 100  # Convert centavos to PHP
-        
-        status = payment_data.get("status", "")
-        description = payment_data.get("description", "")
-        
-        print(f"💰 Amount: ₱{amount:.2f}")
-        print(f"📊 Status: {status}")
-        print(f"📝 Description: {description}")
-        
-        # Get the payment ID from the event data
-        payment_id_from_webhook = None
-        if event_data:
-            payment_id_from_webhook = event_data.get("id")
-            print(f"🆔 Payment ID: {payment_id_from_webhook}")
-        
-        # NEW: Try to get the QRPh ID from the source
-        source = payment_data.get("source", {})
-        qrph_id = None
-        if isinstance(source, dict):
-            qrph_id = source.get("id")
-            print(f"🔍 QRPh ID from source: {qrph_id}")
-        
-        # Strategy 1: Get reference from metadata
-        metadata = payment_data.get("metadata") or {}
-        reference = metadata.get("reference_number") if isinstance(metadata, dict) else None
-        if reference:
-            print(f"✅ Reference from metadata: {reference}")
-        
-        # Strategy 2: Get from billing
-        if not reference:
-            billing = payment_data.get("billing") or {}
-            reference = billing.get("reference_number") or billing.get("reference") if isinstance(billing, dict) else None
-            if reference:
-                print(f"✅ Reference from billing: {reference}")
-        
-        # Strategy 3: Extract from description (QR id pattern)
-        if not reference and description:
-            # Look for our reference pattern first
-            match = re.search(r'helmet-\d+-[a-f0-9]+', description)
-            if match:
-                reference = match.group(0)
-                print(f"✅ Found reference in description: {reference}")
-        
-        # Strategy 4: NEW - Look up by QRPh ID in database
-        if not reference and qrph_id:
-            print(f"🔍 Searching database for QRPh ID: {qrph_id}")
+    def _run(self):
+        while not self._stop.wait(self._delay * random.uniform(1 - self.jitter, 1 + self.jitter)):
             try:
-                conn = get_db()
-                c = conn.cursor()
-                c.execute('SELECT reference FROM payments WHERE paymongo_id = ?', (qrph_id,))
-                result = c.fetchone()
-                conn.close()
-                
-                if result:
-                    reference = result[0]
-                    print(f"✅ Found reference via QRPh ID: {reference}")
+                self.sweep()
+                self._delay = self.interval
             except Exception as e:
-                print(f"⚠️ Error searching by QRPh ID: {e}")
-        
-        # Strategy 5: NEW - Look up by reference_id or external_reference_number
-        if not reference:
-            external_ref = payment_data.get("external_reference_number") or payment_data.get("reference_id")
-            if external_ref:
-                print(f"🔍 Searching database for external reference: {external_ref}")
-                try:
-                    conn = get_db()
-                    c = conn.cursor()
-                    c.execute('SELECT reference FROM payments WHERE reference_id = ?', (external_ref,))
-                    result = c.fetchone()
-                    conn.close()
-                    
-                    if result:
-                        reference = result[0]
-                        print(f"✅ Found reference via external reference: {reference}")
-                except Exception as e:
-                    print(f"⚠️ Error searching by external ref: {e}")
+                self.failures += 1
+                self._delay = min(self._delay * 2, self.max_interval)
+                log.warning("⚠️ Reconciliation sweep failed: %s (next in ~%ss)", e, self._delay)
+
+    def sweep(self):
+        """Run one reconciliation pass. Returns the references confirmed."""
+        self.sweeps += 1
+        self.last_sweep = datetime.now().isoformat()
         
-        # Strategy 6: LAST RESORT - Search for most recent pending payment with matching amount
-        if not reference and amount > 0:
-            print(f"🔍 Last resort: searching for pending payment with amount ₱{amount:.2f}")
-            try:
-                conn = get_db()
-                c = conn.cursor()
-                c.execute('''
-                    SELECT reference FROM payments 
-                    WHERE status = 'PENDING' 
-                    AND payment_method = 'QRPH'
-                    AND amount = ?
-                    ORDER BY created_at DESC 
-                    LIMIT 1
-                ''', (amount,))
-                result = c.fetchone()
-                conn.close()
-                
-                if result:
-                    reference = result[0]
-                    print(f"⚠️ Matched by amount to pending payment: {reference}")
-            except Exception as e:
-                print(f"⚠️ Error searching by amount: {e}")
+        with db_connection() as conn:
+            pending = conn.execute('''
+                SELECT reference, payment_method, paymongo_id, reference_id FROM payments
+                WHERE status = 'PENDING' AND created_ts >= ? AND payment_method IN ('QRPH', 'SOLANA')
+                AND claimed_ts IS NOT NULL
+            ''', (now_ts() - QR_POOL_MAX_AGE,)).fetchall()
         
-        if not reference:
-            print("❌ No reference found in webhook data after all strategies")
-            print(f"📦 Full payment data:")
-            print(json.dumps(payment_data, indent=2)[:1000])
-            return jsonify({"received": True, "error": "No reference found"}), 200
+        lookup = {}
+        signatures = {}
+        for row in pending:
+            if row["payment_method"] == "SOLANA":
+                if row["paymongo_id"]:
+                    signatures[row["paymongo_id"]] = row["reference"]
+                continue
+            lookup[row["reference"]] = row["reference"]
+            if row["paymongo_id"]:
+                lookup[row["paymongo_id"]] = row["reference"]
+            if row["reference_id"]:
+                lookup[row["reference_id"]] = row["reference"]
         
-        print(f"🎯 Processing payment for reference: {reference}")
+        calls = []
+        if lookup:
+            calls.append(self._fetch_recent_payments(self._reserve_call()))
+        if signatures:
+            calls.append(solana_rpc.signature_statuses_async(list(signatures)[:256]))
+        if not calls:
+            return []
+        results = upstream.gather(*calls, timeout=60)
         
-        # Find payment in database
-        payment = get_payment_by_reference(reference)
-        if not payment:
-            print(f"⚠️ Payment not found in database: {reference}")
-            # Create new payment record
-            payment_id = save_payment(
-                reference=reference,
-                method='QRPH',
-                amount=amount,
-                status='PAID',
-                paymongo_id=payment_id_from_webhook or qrph_id
-            )
-            if payment_id:
-                payment = {"id": payment_id, "status": "PENDING"}
-                print(f"✅ Created new payment record: {reference}")
+        matches = []
+        errors = []
+        if lookup:
+            payments = results.pop(0)
+            if isinstance(payments, Exception):
+                errors.append(payments)
             else:
-                return jsonify({"received": True, "error": "Failed to create payment"}), 200
-        
-        # Skip if already paid
-        if payment["status"] == "PAID":
-            print(f"✅ Payment already marked as PAID: {reference}")
-            return jsonify({"received": True, "already_paid": True}), 200
-        
-        print(f"💳 Updating payment status to PAID...")
-        
-        # Update payment status
-        update_payment_status(reference, "PAID", payment_id_from_webhook or qrph_id)
-        
-        # Create sanitization session
-        session_id = save_sanitization_session(payment["id"])
-        
-        # Update memory
-        if reference in payments:
-            payments[reference]["status"] = "PAID"
-            payments[reference]["session_id"] = session_id
-        else:
-            payments[reference] = {
-                "id": payment["id"],
-                "status": "PAID",
-                "session_id": session_id,
-                "method": "QRPH"
-            }
-        
-        print(f"🧼 Triggering sanitizer for session {session_id}")
-        
-        # Start sanitization timer in background (2 second delay before relays start)
-        trigger_sanitizer_background(session_id, delay_seconds=2)
-        
-        # Update stats
-        update_daily_stats()
+                for item in payments:
+                    attributes = item.get("attributes") or {}
+                    if attributes.get("status") != "paid":
+                        continue
+                    reference = self._match(attributes, lookup)
+                    if reference:
+                        matches.append((reference, item.get("id")))
+        if signatures:
+            statuses = results.pop(0)
+            if isinstance(statuses, Exception):
+                errors.append(statuses)
+            else:
+                for signature, status in statuses.items():
+                    if signature_confirmed(status):
+                        matches.append((signatures[signature], signature))
         
-        print(f"✅ Payment {reference} processed successfully via webhook!")
-        print(f"✅ Session {session_id} completed!")
+        confirmed = []
+        for reference, external_id in matches:
+            if reference in confirmed:
+                continue
+            result = confirm_payment(reference, external_id)
+            if result.won:
+                log.info("🔁 Reconciled missed confirmation: %s", reference)
+                self.confirmed += 1
+                confirmed.append(reference)
         
-        return jsonify({
-            "success": True,
-            "message": "Payment processed",
-            "reference": reference,
-            "session_id": session_id
-        }), 200
-    
-    except Exception as e:
-        print(f"❌ Error processing webhook payment: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"received": True}), 200
+        if errors:
+            raise errors[0]
+        return confirmed
+
+    def _reserve_call(self):
+        """Seconds to wait before the next PayMongo call may go out."""
+        with self._call_lock:
+            now = time.monotonic()
+            wait = max(self._next_call_at - now, 0)
+            self._next_call_at = now + wait + self.min_call_spacing
+            self.api_calls += 1
+        return wait
+
+    async def _fetch_recent_payments(self, wait):
+        if wait:
+            await asyncio.sleep(wait)
+        response = await paymongo_client.request_async("GET", "/payments", params={"limit": self.page_size})
+        if response.status_code != 200:
+            raise PayMongoError(f"List payments failed with HTTP {response.status_code}", response.text)
+        return response.json().get("data") or []
+
+    @staticmethod
+    def _match(attributes, lookup):
+        metadata = attributes.get("metadata") or {}
+        source = attributes.get("source") or {}
+        candidates = [
+            metadata.get("reference_number") if isinstance(metadata, dict) else None,
+            source.get("id") if isinstance(source, dict) else None,
+            attributes.get("external_reference_number"),
+            attributes.get("reference_id"),
+        ]
+        match = re.search(r'helmet-\d+-[a-f0-9]+', attributes.get("description") or "")
+        if match:
+            candidates.append(match.group(0))
+        for candidate in candidates:
+            if candidate in lookup:
+                return lookup[candidate]
+        return None
+
+
+payment_reconciler = PaymentReconciler(
+    interval=RECONCILE_INTERVAL,
+    jitter=RECONCILE_JITTER,
+    max_interval=RECONCILE_MAX_INTERVAL,
+    min_call_spacing=RECONCILE_MIN_CALL_SPACING,
+    page_size=RECONCILE_PAGE_SIZE
+)
 
 # ========================================
 # CASH PAYMENT
@@ -1105,71 +3919,57 @@ def simulate_cash():
     reference = f"helmet-cash-{int(time.time())}-{os.urandom(3).hex()}"
     amount = PAYMENT_AMOUNT
     
-    payment_id = save_payment(reference, 'CASH', amount, 'PAID')
-    session_id = save_sanitization_session(payment_id)
-    
-    print(f"💵 Cash Payment: {reference}")
+    save_payment(reference, 'CASH', amount, 'PENDING')
+    log.info("💵 Cash Payment: %s", reference)
     
-    # Start sanitization timer (2 second delay before relays start)
-    trigger_sanitizer_background(session_id, delay_seconds=2)
-    
-    update_daily_stats()
+    # Confirm and start sanitization timer (2 second delay before relays start)
+    result = confirm_payment(reference)
     
     return jsonify({
         "status": "PAID",
         "message": "Cash received",
-        "session_id": session_id
+        "reference": reference,
+        "session_id": result.session_id
     })
 
 # ========================================
 # SOLANA PAY ROUTES
 # ========================================
 
+def solana_pay_url(reference):
+    """Build the Solana Pay transfer URL encoded in a payment's QR code."""
+    params = {
+        'recipient': SOLANA_RECIPIENT_ADDRESS,
+        'amount': str(SOLANA_AMOUNT),
+        'label': SOLANA_LABEL,
+        'message': SOLANA_MESSAGE,
+        'reference': reference,
+        'memo': f"Helmet-{reference}"
+    }
+    
+    # Use urlencode to properly encode the parameters
+    return f"solana:{SOLANA_RECIPIENT_ADDRESS}?{urlencode(params)}"
+
+
 @app.route("/create_solana_payment", methods=["POST"])
 def create_solana_payment():
-    """Create Solana Pay payment request."""
+    """Create Solana Pay payment request; the QR is rendered by /qr/<ref>.png."""
+    if not sanitizer_queue.admit():
+        return jsonify({"error": SANITIZER_BUSY_MESSAGE, "queue_depth": sanitizer_queue.depth()}), 503
+    
     try:
         reference = f"helmet-sol-{int(time.time())}-{os.urandom(3).hex()}"
         
-        # Save to database
-        payment_id = save_payment(reference, 'SOLANA', SOLANA_AMOUNT, 'PENDING')
+        # Save to database (also caches the PENDING status)
+        save_payment(reference, 'SOLANA', SOLANA_AMOUNT, 'PENDING')
+        solana_url = solana_pay_url(reference)
         
-        # Store in memory
-        payments[reference] = {
-            "id": payment_id,
-            "status": "PENDING",
-            "method": "SOLANA"
-        }
-        
-        # Build Solana Pay URL
-        params = {
-            'recipient': SOLANA_RECIPIENT_ADDRESS,
-            'amount': str(SOLANA_AMOUNT),
-            'label': SOLANA_LABEL,
-            'message': SOLANA_MESSAGE,
-            'reference': reference,
-            'memo': f"Helmet-{reference}"
-        }
-        
-        # Use urlencode to properly encode the parameters
-        solana_url = f"solana:{SOLANA_RECIPIENT_ADDRESS}?{urlencode(params)}"
-        
-        # Generate QR code
-        qr = qrcode.QRCode(version=1, box_size=10, border=4)
-        qr.add_data(solana_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        qr_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        
-        print(f"✅ Solana Payment Created: {reference}")
+        log.info("✅ Solana Payment Created: %s", reference)
         
         return jsonify({
             "success": True,
             "reference": reference,
-            "qr_image": qr_b64,
+            "qr_url": url_for("qr_image", ref=reference, fmt="png"),
             "amount": f"{SOLANA_AMOUNT} SOL",
             "solana_url": solana_url,
             "recipient": SOLANA_RECIPIENT_ADDRESS,
@@ -1177,9 +3977,7 @@ def create_solana_payment():
         })
     
     except Exception as e:
-        print(f"❌ Error creating Solana payment: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Error creating Solana payment: %s", e)
         return jsonify({
             "error": "Failed to create Solana payment",
             "details": str(e)
@@ -1190,14 +3988,14 @@ def create_solana_payment():
 def check_solana_payment(ref):
     """Check Solana payment status."""
     try:
-        payment = get_payment_by_reference(ref)
+        payment = get_payment_status(ref)
         if payment:
-            return jsonify({
+            return conditional_status(payment, lambda: {
                 "success": True,
-                "status": payment["status"],
+                "status": payment.status,
                 "reference": ref,
-                "amount": payment["amount"],
-                "method": payment["payment_method"]
+                "amount": payment.amount,
+                "method": payment.method
             })
         return jsonify({
             "success": False,
@@ -1205,7 +4003,7 @@ def check_solana_payment(ref):
             "status": "NOT_FOUND"
         }), 404
     except Exception as e:
-        print(f"❌ Error checking Solana payment: {str(e)}")
+        log.error("❌ Error checking Solana payment: %s", e)
         return jsonify({
             "success": False,
             "error": "Server error",
@@ -1215,7 +4013,12 @@ def check_solana_payment(ref):
 
 @app.route("/confirm_solana_payment", methods=["POST"])
 def confirm_solana_payment():
-    """Confirm Solana payment (simulated for testing)."""
+    """Confirm Solana payment.
+    
+    Simulated signatures (testing) confirm directly. Real ones are checked
+    with getSignatureStatuses first; one that is not confirmed yet is
+    stored on the payment for the reconciler to finish.
+    """
     try:
         data = request.get_json()
         if not data:
@@ -1227,37 +4030,40 @@ def confirm_solana_payment():
         if not reference:
             return jsonify({"error": "Missing reference"}), 400
         
-        # Update payment status
-        update_payment_status(reference, "PAID", signature)
-        
-        # Update memory
-        if reference in payments:
-            payments[reference]["status"] = "PAID"
-            
-            # Create sanitization session
-            payment = get_payment_by_reference(reference)
-            if payment:
-                session_id = save_sanitization_session(payment["id"])
-                payments[reference]["session_id"] = session_id
-        
-        # Trigger sanitizer in background
-        if reference in payments and "session_id" in payments[reference]:
-            trigger_sanitizer_background(payments[reference]["session_id"], delay_seconds=2)
+        if not signature.startswith("simulated"):
+            status = solana_rpc.signature_statuses([signature]).get(signature)
+            if status and status.get("err") is not None:
+                return jsonify({"success": False, "error": "Transaction failed", "details": status["err"]}), 400
+            if not signature_confirmed(status):
+                with db_transaction() as conn:
+                    recorded = conn.execute('''
+                        UPDATE payments SET paymongo_id = ?
+                        WHERE reference = ? AND payment_method = 'SOLANA' AND status = 'PENDING'
+                    ''', (signature, reference)).rowcount
+                if not recorded and not get_payment_status(reference):
+                    return jsonify({"success": False, "error": "Payment not found", "status": "NOT_FOUND"}), 404
+                log.info("🟣 Solana signature not confirmed yet: %s", reference)
+                return jsonify({"success": True, "status": "PENDING", "message": "Waiting for confirmation"}), 202
         
-        # Update stats
-        update_daily_stats()
+        result = confirm_payment(reference, signature)
+        if not result.found:
+            return jsonify({"success": False, "error": "Payment not found", "status": "NOT_FOUND"}), 404
         
-        print(f"🟣 Solana Payment Confirmed: {reference}")
+        log.info("🟣 Solana Payment Confirmed: %s", reference)
         
         return jsonify({
             "success": True,
             "status": "PAID",
-            "message": "Payment confirmed",
-            "session_id": payments[reference].get("session_id") if reference in payments else None
+            "message": "Payment confirmed" if result.won else "Payment already confirmed",
+            "session_id": result.session_id
         })
     
+    except UpstreamError as e:
+        log.error("❌ Solana RPC Error: %s", e)
+        return jsonify({"success": False, "error": "Solana RPC unavailable", "details": str(e)}), 502
+    
     except Exception as e:
-        print(f"❌ Error confirming Solana payment: {str(e)}")
+        log.error("❌ Error confirming Solana payment: %s", e)
         return jsonify({
             "success": False,
             "error": "Failed to confirm payment",
@@ -1285,13 +4091,12 @@ def submit_rating():
             return jsonify({"error": "Invalid rating"}), 400
         
         save_rating(session_id, rating, feedback)
-        update_daily_stats()
         
-        print(f"⭐ Rating: {rating} stars (Session: {session_id})")
+        log.info("⭐ Rating: %s stars (Session: %s)", rating, session_id)
         return jsonify({"success": True, "message": "Thank you!"})
     
     except Exception as e:
-        print(f"❌ Rating error: {e}")
+        log.error("❌ Rating error: %s", e)
         return jsonify({"error": "Failed to save"}), 500
 
 # ========================================
@@ -1307,10 +4112,8 @@ def test_relay(relay_name, state):
             "valid_relays": list(GPIO_PINS.keys())
         }), 400
     
-    print(f"\n🧪 MANUAL RELAY TEST")
-    print(f"   Relay: {relay_name}")
-    print(f"   State: {'ON (1)' if state else 'OFF (0)'}")
-    print(f"   Mode: {'🔴 HARDWARE' if RPI_AVAILABLE else '💡 SIMULATION'}")
+    log.info("🧪 MANUAL RELAY TEST: %s %s (%s)", relay_name, "ON" if state else "OFF",
+             "HARDWARE" if RPI_AVAILABLE else "SIMULATION")
     
     set_relay(relay_name, state)
     
@@ -1325,79 +4128,86 @@ def test_relay(relay_name, state):
 
 @app.route("/gpio_status", methods=["GET"])
 def gpio_status():
-    """Check GPIO status and relay configuration."""
-    print("\n🔍 GPIO STATUS CHECK")
-    print(f"   RPI Available: {RPI_AVAILABLE}")
-    print(f"   Relay Lines Count: {len(relay_lines)}")
-    print(f"   GPIO Pins: {GPIO_PINS}")
+    """Check GPIO status, relay configuration and live relay state."""
+    log.info("🔍 GPIO STATUS CHECK: RPI available %s, %s relay device(s), pins %s",
+             RPI_AVAILABLE, len(relay_devices), GPIO_PINS)
     
+    all_configured = not RPI_AVAILABLE or len(relay_devices) == len(GPIO_PINS)
     return jsonify({
         "rpi_available": RPI_AVAILABLE,
         "mode": "HARDWARE" if RPI_AVAILABLE else "SIMULATION",
         "relay_pins": GPIO_PINS,
-        "relay_lines_configured": list(relay_lines.keys()),
-        "total_relays": len(relay_lines),
-        "message": "All systems operational" if len(relay_lines) == 4 else "⚠️ Not all relays configured"
+        "relay_lines_configured": list(relay_devices.keys()),
+        "total_relays": len(relay_devices),
+        "relays": relay_controller.snapshot(),
+        **relay_controller.stats(),
+        "message": "All systems operational" if all_configured else "⚠️ Not all relays configured"
+    })
+
+
+@app.route("/relay_state", methods=["GET"])
+def relay_state():
+    """Live relay shadow state (cheap enough to poll)."""
+    return jsonify({
+        "mode": "HARDWARE" if RPI_AVAILABLE else "SIMULATION",
+        "relays": relay_controller.snapshot(),
+        **relay_controller.stats()
     })
 
 
 @app.route("/test_relay_sequence", methods=["GET"])
 def test_relay_sequence():
     """Test full relay sequence manually."""
-    print("\n🧪 TESTING FULL RELAY SEQUENCE")
+    log.info("🧪 TESTING FULL RELAY SEQUENCE")
     
-    # Run in background
-    thread = threading.Thread(target=run_payment_relay_sequence, daemon=True, name="test-relay-sequence")
-    thread.start()
+    # Queue it behind any paid cycles so it never drives the relays concurrently
+    job_id = sanitizer_queue.submit(start_delay=0)
     
     return jsonify({
         "success": True,
-        "message": "Relay sequence started in background",
+        "job_id": job_id,
+        "message": "Relay sequence queued on the sanitizer worker",
         "mode": "HARDWARE" if RPI_AVAILABLE else "SIMULATION",
         "note": "Check console output for relay control logs"
     })
 
 
+@app.route("/relay_timeline", methods=["GET", "POST"])
+def relay_timeline():
+    """Dry-run a relay timeline: the active one (GET) or a proposed one (POST).
+    
+    POST body: {"phases": [{"name", "relays", "offset", "duration", "after"}, ...]}.
+    Nothing is switched; the response is the validated schedule and cycle time.
+    """
+    if request.method == "GET":
+        return jsonify({"valid": True, **timeline_summary(relay_plan)})
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        plan = plan_timeline(parse_timeline(data.get("phases")))
+    except TimelineError as e:
+        return jsonify({"valid": False, "problems": e.problems}), 400
+    return jsonify({"valid": True, **timeline_summary(plan)})
+
+
 @app.route("/test_payment/<ref>", methods=["GET"])
 def test_payment(ref):
     """Test endpoint to mark payment as paid."""
-    print(f"\n🧪 TESTING PAYMENT: {ref}")
+    log.info("🧪 TESTING PAYMENT: %s", ref)
     
     payment = get_payment_by_reference(ref)
     if not payment:
-        print(f"❌ Payment not found: {ref}")
+        log.error("❌ Payment not found: %s", ref)
         return jsonify({"error": "Payment not found"}), 404
     
-    print(f"✅ Payment found: {ref}")
-    print(f"   Status: {payment['status']}")
-    print(f"   Amount: ₱{payment['amount']}")
+    log.info("✅ Payment found: %s (status %s, ₱%s)", ref, payment['status'], payment['amount'])
     
-    # Update to paid
-    update_payment_status(ref, "PAID")
-    print(f"✅ Payment status updated to PAID")
-    
-    # Create session
-    session_id = save_sanitization_session(payment["id"])
-    print(f"✅ Sanitization session created: {session_id}")
-    
-    # Store session ID
-    if ref in payments:
-        payments[ref]["status"] = "PAID"
-        payments[ref]["session_id"] = session_id
-    
-    print(f"\n⏱️ SANITIZATION TIMER STARTED")
-    print(f"   Session ID: {session_id}")
-    print(f"   Mode: {'🔴 HARDWARE' if RPI_AVAILABLE else '💡 SIMULATION'}")
-    print(f"   Waiting 2 seconds before relay sequence...")
-    
-    # Start sanitization timer (2 second delay before relays start)
-    trigger_sanitizer_background(session_id, delay_seconds=2)
-    
-    # Update stats
-    update_daily_stats()
-    
-    print(f"\n✅ TEST COMPLETE: Payment {ref} marked as paid. Session: {session_id}")
-    print(f"✅ Relay sequence will start in 2 seconds (check console for logs)")
+    # Update to paid, create session and start sanitization timer
+    # (2 second delay before relays start)
+    result = confirm_payment(ref)
+    session_id = result.session_id
+    log.info("✅ TEST COMPLETE: Payment %s marked as paid. Session: %s (%s)", ref, session_id,
+             "HARDWARE" if RPI_AVAILABLE else "SIMULATION")
     
     return jsonify({
         "status": "MANUALLY_PAID",
@@ -1412,28 +4222,15 @@ def test_payment(ref):
 @app.route("/mark_paid/<ref>", methods=["POST"])
 def mark_paid(ref):
     """Manually mark payment as paid."""
-    print(f"✅ Manually marking payment as paid: {ref}")
+    log.info("✅ Manually marking payment as paid: %s", ref)
     
     payment = get_payment_by_reference(ref)
     if not payment:
         return jsonify({"error": "Payment not found"}), 404
     
-    # Update payment status
-    update_payment_status(ref, "PAID")
-    
-    # Create sanitization session
-    session_id = save_sanitization_session(payment["id"])
-    
-    # Update memory
-    if ref in payments:
-        payments[ref]["status"] = "PAID"
-        payments[ref]["session_id"] = session_id
-    
-    # Start sanitization timer (2 second delay before relays start)
-    trigger_sanitizer_background(session_id, delay_seconds=2)
-    
-    # Update stats
-    update_daily_stats()
+    # Update payment status, create session and start sanitization timer
+    result = confirm_payment(ref)
+    session_id = result.session_id
     
     return jsonify({
         "success": True,
@@ -1446,7 +4243,7 @@ def mark_paid(ref):
 @app.route("/payment_paid", methods=["POST"])
 def payment_paid():
     """Simulate payment paid webhook."""
-    print("💰 SIMULATING PAYMENT PAID WEBHOOK")
+    log.info("💰 SIMULATING PAYMENT PAID WEBHOOK")
     
     data = request.get_json()
     if not data:
@@ -1456,30 +4253,24 @@ def payment_paid():
     if not reference:
         return jsonify({"error": "No reference"}), 400
     
-    print(f"🔍 Processing simulated payment for: {reference}")
+    log.info("🔍 Processing simulated payment for: %s", reference)
     
     payment = get_payment_by_reference(reference)
     if not payment:
         return jsonify({"error": "Payment not found"}), 404
     
     # Process as paid
-    return mark_payment_as_paid(reference, payment["id"])
+    result = confirm_payment(reference)
+    return jsonify({"status": "PAID", "session_id": result.session_id})
 
 
 @app.route("/webhook_debug", methods=["POST"])
 def webhook_debug():
     """Debug webhook endpoint."""
-    print("\n🔧 WEBHOOK DEBUG ENDPOINT")
-    
-    # Log headers
-    print("📋 Headers:")
-    for key, value in request.headers.items():
-        print(f"   {key}: {value}")
-    
-    # Log raw data
     raw_data = request.get_data(as_text=True)
-    print(f"📦 Raw data ({len(raw_data)} bytes):")
-    print(raw_data[:500] + "..." if len(raw_data) > 500 else raw_data)
+    log.info("🔧 WEBHOOK DEBUG ENDPOINT (%s bytes)", len(raw_data))
+    log.debug("📋 Headers: %s", dict(request.headers))
+    log.debug("📦 Raw data: %s", raw_data[:500])
     
     return jsonify({
         "received": True,
@@ -1500,10 +4291,10 @@ def admin_login():
         
         if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
             session['admin_logged_in'] = True
-            print(f"✅ Admin Login: {username}")
+            log.info("✅ Admin Login: %s", username)
             return redirect(url_for('admin_dashboard'))
         else:
-            print(f"❌ Failed Login Attempt: {username}")
+            log.warning("❌ Failed Login Attempt: %s", username)
             return render_template("admin_login.html", error="Invalid credentials")
     
     return render_template("admin_login.html")
@@ -1513,7 +4304,7 @@ def admin_login():
 def admin_logout():
     """Admin logout."""
     session.pop('admin_logged_in', None)
-    print("🚪 Admin Logged Out")
+    log.info("🚪 Admin Logged Out")
     return redirect(url_for('admin_login'))
 
 
@@ -1522,57 +4313,56 @@ def admin_logout():
 @login_required
 def admin_dashboard():
     """Admin dashboard with overview."""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Today's stats
     today = datetime.now().date()
-    c.execute('SELECT * FROM daily_stats WHERE date = ?', (today,))
-    today_stats = c.fetchone()
-    
-    # This week's stats
-    week_ago = today - timedelta(days=7)
-    c.execute('''
-        SELECT 
-            SUM(total_payments) as total_payments,
-            SUM(total_revenue) as total_revenue,
-            SUM(successful_sanitizations) as successful_sanitizations,
-            AVG(average_rating) as average_rating
-        FROM daily_stats 
-        WHERE date >= ?
-    ''', (week_ago,))
-    week_stats = c.fetchone()
-    
-    # All-time stats
-    c.execute('''
-        SELECT 
-            COUNT(*) as total_payments,
-            COALESCE(SUM(amount), 0) as total_revenue
-        FROM payments 
-        WHERE status = 'PAID'
-    ''')
-    alltime_stats = c.fetchone()
-    
-    # Recent payments
-    c.execute('''
-        SELECT * FROM payments 
-        ORDER BY created_at DESC 
-        LIMIT 20
-    ''')
-    recent_payments = c.fetchall()
-    
-    # Recent ratings
-    c.execute('''
-        SELECT r.*, s.id as session_id, p.reference
-        FROM ratings r
-        JOIN sanitization_sessions s ON r.session_id = s.id
-        JOIN payments p ON s.payment_id = p.id
-        ORDER BY r.created_at DESC
-        LIMIT 10
-    ''')
-    recent_ratings = c.fetchall()
-    
-    conn.close()
+    
+    with db_connection() as conn:
+        c = conn.cursor()
+        
+        # Today's stats
+        c.execute('SELECT * FROM daily_stats WHERE date = ?', (today,))
+        today_stats = c.fetchone()
+        
+        # This week's stats
+        week_ago = today - timedelta(days=7)
+        c.execute('''
+            SELECT 
+                SUM(total_payments) as total_payments,
+                SUM(total_revenue) as total_revenue,
+                SUM(successful_sanitizations) as successful_sanitizations,
+                AVG(average_rating) as average_rating
+            FROM daily_stats 
+            WHERE date >= ?
+        ''', (week_ago,))
+        week_stats = c.fetchone()
+        
+        # All-time stats
+        c.execute('''
+            SELECT 
+                COUNT(*) as total_payments,
+                COALESCE(SUM(amount), 0) as total_revenue
+            FROM payments 
+            WHERE status = 'PAID'
+        ''')
+        alltime_stats = c.fetchone()
+        
+        # Recent payments
+        c.execute('''
+            SELECT * FROM payments 
+            ORDER BY created_ts DESC, id DESC 
+            LIMIT 20
+        ''')
+        recent_payments = c.fetchall()
+        
+        # Recent ratings
+        c.execute('''
+            SELECT r.*, s.id as session_id, p.reference
+            FROM ratings r
+            JOIN sanitization_sessions s ON r.session_id = s.id
+            JOIN payments p ON s.payment_id = p.id
+            ORDER BY r.created_ts DESC
+            LIMIT 10
+        ''')
+        recent_ratings = c.fetchall()
     
     return render_template("admin_dashboard.html",
                          today_stats=dict(today_stats) if today_stats else None,
@@ -1585,105 +4375,162 @@ def admin_dashboard():
 @app.route("/admin/payments")
 @login_required
 def admin_payments():
-    """View all payments with filters."""
-    conn = get_db()
-    c = conn.cursor()
-    
+    """View all payments with filters (keyset paginated)."""
     # Get filter parameters
-    status = request.args.get('status', 'all')
-    method = request.args.get('method', 'all')
-    date_from = request.args.get('date_from', '')
-    date_to = request.args.get('date_to', '')
-    
-    # Build query
-    query = 'SELECT * FROM payments WHERE 1=1'
-    params = []
+    filters = {
+        'status': request.args.get('status', 'all'),
+        'method': request.args.get('method', 'all'),
+        'date_from': request.args.get('date_from', ''),
+        'date_to': request.args.get('date_to', '')
+    }
+    cursor = request.args.get('cursor') or None
     
-    if status != 'all':
-        query += ' AND status = ?'
-        params.append(status)
+    try:
+        payments_list, next_cursor = fetch_payments_page(filters, cursor)
+    except ValueError:
+        return redirect(url_for('admin_payments', **filters))
     
-    if method != 'all':
-        query += ' AND payment_method = ?'
-        params.append(method)
+    return render_template("admin_payments.html", 
+                         payments=[dict(p) for p in payments_list],
+                         filters=filters,
+                         cursor=cursor,
+                         next_cursor=next_cursor)
+
+
+EXPORT_COLUMNS = [
+    "id", "reference", "payment_method", "amount", "currency", "status",
+    "created_ts", "paid_ts", "paymongo_id", "reference_id"
+]
+
+
+@app.route("/admin/payments/export.<fmt>")
+@login_required
+def export_payments(fmt):
+    """Stream every payment matching the filters as CSV or NDJSON."""
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "Unsupported format", "formats": ["csv", "ndjson"]}), 400
     
-    if date_from:
-        query += ' AND DATE(created_at) >= ?'
-        params.append(date_from)
+    filters = {
+        'status': request.args.get('status', 'all'),
+        'method': request.args.get('method', 'all'),
+        'date_from': request.args.get('date_from', ''),
+        'date_to': request.args.get('date_to', '')
+    }
+    rows = iter_payments(filters, columns=", ".join(EXPORT_COLUMNS))
     
-    if date_to:
-        query += ' AND DATE(created_at) <= ?'
-        params.append(date_to)
+    def export_record(row):
+        record = dict(row)
+        record["created_at"] = format_localtime(row["created_ts"]) if row["created_ts"] else None
+        record["paid_at"] = format_localtime(row["paid_ts"]) if row["paid_ts"] else None
+        return record
     
-    query += ' ORDER BY created_at DESC LIMIT 100'
+    def generate_csv():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS + ["created_at", "paid_at"])
+        for row in rows:
+            record = export_record(row)
+            writer.writerow([record[col] for col in EXPORT_COLUMNS + ["created_at", "paid_at"]])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
     
-    c.execute(query, params)
-    payments_list = c.fetchall()
-    conn.close()
+    def generate_ndjson():
+        for row in rows:
+            yield json.dumps(export_record(row)) + "\n"
     
-    return render_template("admin_payments.html", 
-                         payments=[dict(p) for p in payments_list],
-                         filters={'status': status, 'method': method, 
-                                 'date_from': date_from, 'date_to': date_to})
+    filename = f"payments-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    return Response(
+        stream_with_context(generate_csv() if fmt == "csv" else generate_ndjson()),
+        mimetype="text/csv" if fmt == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
 
 @app.route("/admin/analytics")
 @login_required
 def admin_analytics():
     """Detailed analytics page."""
-    conn = get_db()
-    c = conn.cursor()
-    
     # Get date range
     days = int(request.args.get('days', 30))
     start_date = datetime.now().date() - timedelta(days=days)
+    start_ts = day_bounds(start_date)[0]
     
-    # Daily stats
-    c.execute('''
-        SELECT * FROM daily_stats
-        WHERE date >= ?
-        ORDER BY date
-    ''', (start_date,))
-    daily_stats = c.fetchall()
+    with db_connection() as conn:
+        c = conn.cursor()
+        
+        # Daily stats
+        c.execute('''
+            SELECT * FROM daily_stats
+            WHERE date >= ?
+            ORDER BY date
+        ''', (start_date,))
+        daily_stats = c.fetchall()
+        
+        # Everything below reads the hourly_stats rollup
+        c.execute('''
+            SELECT hour_ts, payment_method, payments, revenue,
+                   rating_1, rating_2, rating_3, rating_4, rating_5
+            FROM hourly_stats
+            WHERE hour_ts >= ?
+        ''', (start_ts,))
+        buckets = c.fetchall()
     
     # Payment method breakdown
-    c.execute('''
-        SELECT payment_method, COUNT(*) as count, COALESCE(SUM(amount), 0) as total
-        FROM payments
-        WHERE status = 'PAID' AND DATE(created_at) >= ?
-        GROUP BY payment_method
-    ''', (start_date,))
-    payment_methods = c.fetchall()
+    method_totals = {}
+    for b in buckets:
+        totals = method_totals.setdefault(b["payment_method"], {"count": 0, "total": 0.0})
+        totals["count"] += b["payments"]
+        totals["total"] += b["revenue"]
+    payment_methods = [
+        {"payment_method": m, "count": t["count"], "total": t["total"]}
+        for m, t in sorted(method_totals.items()) if t["count"] > 0
+    ]
     
     # Rating distribution
-    c.execute('''
-        SELECT rating, COUNT(*) as count
-        FROM ratings
-        WHERE DATE(created_at) >= ?
-        GROUP BY rating
-        ORDER BY rating
-    ''', (start_date,))
-    rating_distribution = c.fetchall()
-    
-    # Hourly distribution
-    c.execute('''
-        SELECT strftime('%H', created_at) as hour, COUNT(*) as count
-        FROM payments
-        WHERE status = 'PAID' AND DATE(created_at) >= ?
-        GROUP BY hour
-        ORDER BY hour
-    ''', (start_date,))
-    hourly_distribution = c.fetchall()
+    rating_counts = [sum(b[f"rating_{i}"] for b in buckets) for i in range(1, 6)]
+    rating_distribution = [
+        {"rating": i, "count": n} for i, n in enumerate(rating_counts, start=1) if n > 0
+    ]
     
-    conn.close()
+    # Hourly distribution: fold absolute hour buckets into local hour-of-day
+    # (stays correct across DST changes)
+    hour_counts = {}
+    for b in buckets:
+        if b["payments"]:
+            hour = datetime.fromtimestamp(b["hour_ts"]).strftime('%H')
+            hour_counts[hour] = hour_counts.get(hour, 0) + b["payments"]
+    hourly_distribution = [{"hour": h, "count": n} for h, n in sorted(hour_counts.items())]
     
     return render_template("admin_analytics.html",
                          daily_stats=[dict(d) for d in daily_stats],
-                         payment_methods=[dict(p) for p in payment_methods],
-                         rating_distribution=[dict(r) for r in rating_distribution],
-                         hourly_distribution=[dict(h) for h in hourly_distribution],
+                         payment_methods=payment_methods,
+                         rating_distribution=rating_distribution,
+                         hourly_distribution=hourly_distribution,
                          days=days)
 
+@app.route("/admin/latency")
+@login_required
+def admin_latency():
+    """Sanitization latency percentiles (stages, relay phases, per day) as JSON."""
+    days = int(request.args.get('days', 7))
+    start_ts = day_bounds(datetime.now().date() - timedelta(days=days))[0]
+    return jsonify({"days": days, **sanitization_latency(start_ts)})
+
+@app.route("/admin/stats/check", methods=["GET", "POST"])
+@login_required
+def admin_check_stats():
+    """Verify daily_stats against raw data; POST rebuilds mismatching days."""
+    repair = request.method == "POST"
+    mismatches = check_daily_stats(repair=repair)
+    
+    return jsonify({
+        "consistent": not mismatches,
+        "repaired": repair and bool(mismatches),
+        "mismatches": mismatches
+    })
+
 # ========================================
 # UTILITY ENDPOINTS
 # ========================================
@@ -1696,7 +4543,17 @@ def health():
         "gpio_available": RPI_AVAILABLE,
         "database": "connected",
         "payment_gateway": "PayMongo QRPh",
+        "paymongo_circuit": paymongo_client.breaker.stats(),
         "webhook_enabled": True,
+        "payment_cache": payment_cache.stats(),
+        "reference_index": reference_index.stats(),
+        "status_waiters": status_waiters.stats(),
+        "qrph_pool": qrph_pool.stats(),
+        "qr_images": qr_images.stats(),
+        "reconciler": payment_reconciler.stats(),
+        "webhook_inbox": webhook_inbox.stats(),
+        "sanitizer_queue": sanitizer_queue.stats(),
+        "relays": relay_controller.stats(),
         "timestamp": datetime.now().isoformat()
     })
 
@@ -1714,37 +4571,169 @@ def webhook_info():
 @app.route("/list_payments", methods=["GET"])
 @login_required
 def list_payments():
-    """List all payments."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT * FROM payments ORDER BY created_at DESC LIMIT 50')
-    payments_list = c.fetchall()
-    conn.close()
+    """List payments, newest first.
+    
+    Pass ?limit= (max 500) and the X-Next-Cursor header of the previous
+    response as ?cursor= to walk further back.
+    """
+    limit = min(request.args.get('limit', 50, type=int), PAYMENTS_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor') or None
+    
+    try:
+        payments_list, next_cursor = fetch_payments_page(cursor=cursor, limit=max(limit, 1))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    
+    response = jsonify([dict(p) for p in payments_list])
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{url_for("list_payments", limit=limit, cursor=next_cursor)}>; rel="next"'
+    return response
+
+# ========================================
+# MAINTENANCE COMMANDS (flask --app app <command>)
+# ========================================
+
+@app.cli.command("check-stats")
+@click.option("--repair", is_flag=True, help="Rebuild days that do not match the raw data.")
+def check_stats_command(repair):
+    """Verify daily_stats against payments, sessions and ratings."""
+    mismatches = check_daily_stats(repair=repair)
+    for m in mismatches:
+        click.echo(f"{m['date']} {m['field']}: stored={m['stored']} expected={m['expected']}")
+    if not mismatches:
+        click.echo("✅ daily_stats is consistent")
+    elif repair:
+        click.echo(f"🛠️ Repaired {len({m['date'] for m in mismatches})} day(s)")
+
+
+@app.cli.command("backfill-hourly-stats")
+def backfill_hourly_stats_command():
+    """Rebuild the hourly_stats rollup from payments and ratings."""
+    buckets = rebuild_hourly_stats()
+    click.echo(f"✅ Rebuilt hourly_stats ({buckets} bucket(s))")
+
+
+@app.cli.command("rebuild-stats")
+@click.option("--day", default=None, help="Only rebuild this day (YYYY-MM-DD).")
+def rebuild_stats_command(day):
+    """Recompute daily_stats from the raw tables."""
+    days = rebuild_daily_stats(day)
+    click.echo(f"✅ Rebuilt daily_stats for {days} day(s)")
+
+
+@app.cli.command("retry-webhooks")
+def retry_webhooks_command():
+    """Re-queue webhook events that exhausted their retries."""
+    count = webhook_inbox.retry_failed()
+    click.echo(f"✅ Re-queued {count} failed webhook event(s)")
+
+
+@app.cli.command("reconcile-payments")
+def reconcile_payments_command():
+    """Run one reconciliation sweep against the PayMongo API.
+    
+    Confirmed payments are queued for the sanitizer; the running kiosk
+    picks them up within SANITIZER_WATCH_INTERVAL seconds (or when it next
+    starts) and updates the customer's screen.
+    """
+    confirmed = payment_reconciler.sweep()
+    click.echo(f"✅ Reconciled {len(confirmed)} payment(s): {', '.join(confirmed) or '-'}")
+    if confirmed:
+        click.echo("🧼 Queued for the running kiosk's sanitizer")
+
+
+@app.cli.command("relay-timeline")
+@click.option("--file", "path", default=None, help="Check this JSON timeline instead of the active one.")
+def relay_timeline_command(path):
+    """Validate and dry-run a relay timeline, printing its schedule."""
+    try:
+        plan = plan_timeline(load_relay_timeline(path)) if path else relay_plan
+    except TimelineError as e:
+        for problem in e.problems:
+            click.echo(f"❌ {problem}")
+        raise SystemExit(1)
+    
+    for phase, start, end in plan.phases:
+        click.echo(f"{start:7.1f}s → {end:7.1f}s  {phase.name:<10} {', '.join(phase.relays)}")
+    summary = timeline_summary(plan)
+    click.echo(f"✅ {len(plan.phases)} phase(s), {summary['cycle_seconds']:.1f}s per cycle "
+               f"({summary['cycles_per_hour']} per hour)")
+
+
+@app.cli.command("simulate-cycles")
+@click.option("--count", default=1000, show_default=True, help="Number of sanitization cycles to run.")
+def simulate_cycles_command(count):
+    """Run relay cycles on a virtual clock and report simulated throughput."""
+    if RPI_AVAILABLE:
+        raise click.ClickException("Refusing to run simulated cycles on real relays")
     
-    return jsonify([dict(p) for p in payments_list])
+    sim = VirtualClock(start=0)
+    wall_started = time.perf_counter()
+    for _ in range(count):
+        run_payment_relay_sequence(clock=sim)
+    wall = time.perf_counter() - wall_started
+    click.echo(f"✅ {count} cycle(s): {sim.time():.0f}s simulated in {wall:.2f}s "
+               f"({3600 * count / sim.time():.1f} cycles per simulated hour)")
 
 # ========================================
 # APP RUNNER
 # ========================================
 
+_background_workers_started = threading.Event()
+
+
+def start_background_workers():
+    """Start the serving process's background workers (idempotent).
+    
+    Called from __main__ and before the first request, so `flask run` and
+    WSGI servers get them too. Maintenance commands (flask <command>) serve
+    no requests, so they never recover jobs, fill the QRPh pool or sweep.
+    """
+    if _background_workers_started.is_set():
+        return
+    _background_workers_started.set()
+    sanitizer_queue.start()
+    webhook_inbox.start()
+    qrph_pool.start()
+    payment_reconciler.start()
+
+
+def stop_background_workers():
+    payment_reconciler.stop()
+    webhook_inbox.stop()
+    sanitizer_queue.stop()
+    qrph_pool.stop()
+
+
+@app.before_request
+def ensure_background_workers():
+    if not _background_workers_started.is_set():
+        start_background_workers()
+
+
 if __name__ == "__main__":
-    print("\n" + "="*60)
-    print("🚀 HELMET SANITIZER KIOSK - COMPLETE FIXED VERSION")
-    print("="*60)
-    print(f"GPIO: {'YES ✅' if RPI_AVAILABLE else 'NO ⚠️ (Simulation)'}")
-    print(f"Payment Gateway: PayMongo QRPh (GCash & Maya)")
-    print(f"Database: helmet_sanitizer.db")
-    print(f"Webhook URL: https://overgreedy-appealingly-elodia.ngrok-free.dev/paymongo_webhook")
-    print(f"\n📱 Kiosk: http://localhost:5000")
-    print(f"🔐 Admin: http://localhost:5000/admin")
-    print(f"   Username: {ADMIN_USERNAME}")
-    print(f"   Password: {ADMIN_PASSWORD}")
-    print(f"🔍 Debug: http://localhost:5000/debug")
-    print(f"\n🔧 Test Endpoints:")
-    print(f"   Health Check: http://localhost:5000/health")
-    print(f"   Webhook Info: http://localhost:5000/webhook_info")
-    print(f"   Mark Paid: POST http://localhost:5000/mark_paid/<reference>")
-    print("="*60 + "\n")
+    log.info("=" * 60)
+    log.info("🚀 HELMET SANITIZER KIOSK - COMPLETE FIXED VERSION")
+    log.info("=" * 60)
+    log.info("GPIO: %s", 'YES ✅' if RPI_AVAILABLE else 'NO ⚠️ (Simulation)')
+    log.info("Payment Gateway: PayMongo QRPh (GCash & Maya)")
+    log.info("Database: %s", os.path.abspath(DATABASE_PATH))
+    log.info("Log file: %s", os.path.abspath(LOG_FILE) if LOG_FILE else "disabled")
+    log.info("Webhook URL: https://overgreedy-appealingly-elodia.ngrok-free.dev/paymongo_webhook")
+    log.info("📱 Kiosk: http://localhost:5000")
+    log.info("🔐 Admin: http://localhost:5000/admin")
+    log.info("   Username: %s", ADMIN_USERNAME)
+    # The banner now lands in the log file, so the password is not written out
+    log.info("   Password: %s", "admin123 (default)" if ADMIN_PASSWORD == "admin123" else "set by ADMIN_PASSWORD")
+    log.info("🔍 Debug: http://localhost:5000/debug")
+    log.info("🔧 Test Endpoints:")
+    log.info("   Health Check: http://localhost:5000/health")
+    log.info("   Webhook Info: http://localhost:5000/webhook_info")
+    log.info("   Mark Paid: POST http://localhost:5000/mark_paid/<reference>")
+    log.info("=" * 60)
+    
+    start_background_workers()
     
     try:
         app.run(
@@ -1754,14 +4743,17 @@ if __name__ == "__main__":
             port=5000
         )
     except KeyboardInterrupt:
-        print("\n⚠️ Shutting down...")
+        log.warning("⚠️ Shutting down...")
     finally:
         if RPI_AVAILABLE and relay_devices:
-            print("\n🧹 Cleaning up GPIO...")
+            log.info("🧹 Cleaning up GPIO...")
             try:
-                all_relays_off()
+                all_relays_off(force=True)
                 for device in relay_devices.values():
                     device.close()
-                print("✅ GPIO Cleaned")
+                log.info("✅ GPIO Cleaned")
             except Exception as e:
-                print(f"⚠️ GPIO cleanup error: {e}")
+                log.warning("⚠️ GPIO cleanup error: %s", e)
+        stop_background_workers()
+        upstream.close()
+        db_pool.close_all()
@@ -12,7 +12,7 @@ document.addEventListener("DOMContentLoaded", async () => {
         const response = await fetch("/create_payment", { method: "POST" });
         const data = await response.json();
 
-        if (!data.qr_image) {
+        if (!data.qr_url) {
             loadingText.innerText = "⚠️ Failed to generate QR code.";
             loadingText.style.color = "#ff5252";
             loader.style.display = "none";
@@ -24,7 +24,7 @@ document.addEventListener("DOMContentLoaded", async () => {
         loadingText.innerText = "";
         
         const img = document.createElement("img");
-        img.src = `data:image/png;base64,${data.qr_image}`;
+        img.src = data.qr_url;
         img.alt = "Payment QR Code";
         qrSection.appendChild(img);
 
@@ -0,0 +1,113 @@
+"""
+Shared setup for the kiosk tests.
+
+app.py configures itself from the environment at import time, so the test
+settings (a throwaway database, no log file, virtual time for relay cycles,
+no background workers) are put in place before it is imported.
+Nothing here talks to PayMongo; tests use local stubs.
+
+Run from the project directory:  python -m pytest -q tests
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix="kiosk-tests-")
+
+os.environ.update({
+    "DATABASE_PATH": os.path.join(TEST_DIR, "kiosk-test.db"),
+    "LOG_FILE": "",
+    "LOG_LEVEL": "WARNING",
+    "SIM_TIME_SCALE": "0",
+    "QR_POOL_SIZE": "0",
+    "RECONCILE_INTERVAL": "0",
+    "RECONCILE_MIN_CALL_SPACING": "0",
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as kiosk  # noqa: E402
+
+# Tests start the workers they need themselves
+kiosk._background_workers_started.set()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def shutdown():
+    yield
+    kiosk.upstream.close()
+    kiosk.db_pool.close_all()
+
+
+@pytest.fixture
+def db():
+    """Empty payment tables (schema kept) and empty in-memory caches."""
+    with kiosk.db_transaction() as conn:
+        for table in ("phase_events", "sanitization_jobs", "ratings", "sanitization_sessions",
+                      "qrph_images", "payments", "daily_stats", "hourly_stats", "webhook_inbox"):
+            conn.execute(f"DELETE FROM {table}")
+    kiosk.payment_cache._entries.clear()
+    kiosk.qr_images._entries.clear()
+    yield kiosk
+
+
+class StubResponse:
+    """Just enough of UpstreamResponse for the payment code."""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = kiosk.json.dumps(body)
+
+    def json(self):
+        return kiosk.json.loads(self.text)
+
+
+class StubPayMongo:
+    """Stands in for paymongo_client: generates QRPh codes locally and
+    serves a scripted list of PayMongo payments."""
+
+    def __init__(self):
+        self.breaker = kiosk.CircuitBreaker("stub-paymongo")
+        self.generated = []
+        self.payments = []
+        self.list_calls = 0
+
+    def post(self, path, json=None, **kwargs):
+        assert path == "/qrph/generate"
+        n = len(self.generated) + 1
+        reference = json["data"]["attributes"]["reference_number"]
+        self.generated.append(reference)
+        qr_png = kiosk.render_qr(f"stub-qrph-{n}", "png")
+        return StubResponse(200, {"data": {
+            "id": f"qrph_stub_{n}",
+            "attributes": {
+                "qr_image": "data:image/png;base64," + kiosk.base64.b64encode(qr_png).decode(),
+                "reference_id": f"refid_stub_{n}"
+            }
+        }})
+
+    async def request_async(self, method, path, **kwargs):
+        assert (method, path) == ("GET", "/payments")
+        self.list_calls += 1
+        return StubResponse(200, {"data": self.payments})
+
+    def pay(self, reference, amount=None):
+        """Add a paid PayMongo payment for one of our references."""
+        self.payments.append({
+            "id": f"pay_stub_{len(self.payments) + 1}",
+            "attributes": {
+                "status": "paid",
+                "amount": int((amount or kiosk.PAYMENT_AMOUNT) * 100),
+                "metadata": {"reference_number": reference}
+            }
+        })
+
+
+@pytest.fixture
+def paymongo(monkeypatch):
+    stub = StubPayMongo()
+    monkeypatch.setattr(kiosk, "paymongo_client", stub)
+    return stub
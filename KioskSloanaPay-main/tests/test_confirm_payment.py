@@ -0,0 +1,68 @@
+"""
+confirm_payment, the single PENDING -> PAID path: however many callers
+confirm the same payment, exactly one wins and the stats move once.
+"""
+
+import threading
+
+import pytest
+
+from conftest import kiosk
+
+
+@pytest.fixture
+def pending(db):
+    kiosk.save_payment("helmet-1-confirm", "QRPH", kiosk.PAYMENT_AMOUNT)
+    return "helmet-1-confirm"
+
+
+def stats():
+    with kiosk.db_connection() as conn:
+        daily = conn.execute(
+            "SELECT SUM(total_payments), SUM(total_revenue), SUM(qrph_payments) FROM daily_stats").fetchone()
+        hourly = conn.execute("SELECT SUM(payments), SUM(revenue) FROM hourly_stats").fetchone()
+        return tuple(daily), tuple(hourly)
+
+
+def counts():
+    with kiosk.db_connection() as conn:
+        return tuple(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                     for table in ("sanitization_sessions", "sanitization_jobs"))
+
+
+def test_second_confirmation_loses(pending):
+    first = kiosk.confirm_payment(pending, "pay_1")
+    second = kiosk.confirm_payment(pending, "pay_2")
+
+    assert first.found and first.won
+    assert second.found and not second.won
+    assert second.session_id == first.session_id
+    assert counts() == (1, 1)
+    assert stats() == ((1, kiosk.PAYMENT_AMOUNT, 1), (1, kiosk.PAYMENT_AMOUNT))
+    assert kiosk.get_payment_by_reference(pending)["paymongo_id"] == "pay_1"
+
+
+def test_concurrent_confirmations_have_one_winner(pending):
+    barrier = threading.Barrier(2)
+    results = []
+
+    def confirm(paymongo_id):
+        barrier.wait()
+        results.append(kiosk.confirm_payment(pending, paymongo_id))
+
+    threads = [threading.Thread(target=confirm, args=(f"pay_{n}",)) for n in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert sorted(result.won for result in results) == [False, True]
+    assert results[0].session_id == results[1].session_id is not None
+    assert counts() == (1, 1)
+    assert stats() == ((1, kiosk.PAYMENT_AMOUNT, 1), (1, kiosk.PAYMENT_AMOUNT))
+    assert kiosk.get_payment_status(pending).status == "PAID"
+
+
+def test_unknown_reference_is_not_found(db):
+    assert kiosk.confirm_payment("helmet-1-missing") == (False, False, None, None)
+    assert counts() == (0, 0)
@@ -0,0 +1,89 @@
+"""
+Schema migrations: a database created by the original app (base tables,
+user_version 0) is upgraded in place to SCHEMA_VERSION.
+"""
+
+import sqlite3
+from datetime import datetime, timezone
+
+import pytest
+
+from conftest import kiosk
+
+BASELINE_TABLES = kiosk.MIGRATIONS[0][2]
+
+
+@pytest.fixture
+def baseline_db(monkeypatch, tmp_path):
+    """A pre-migration database with one paid, rated QRPH payment, swapped in
+    as the app's database for the duration of the test."""
+    path = str(tmp_path / "baseline.db")
+    conn = sqlite3.connect(path)
+    for sql in BASELINE_TABLES:
+        conn.execute(sql)
+    conn.execute('''
+        INSERT INTO payments (reference, payment_method, amount, status, created_at, paid_at)
+        VALUES ('SANI-OLD-1', 'QRPH', 50, 'PAID', '2024-03-01 02:00:00', '2024-03-01 10:01:00')
+    ''')
+    conn.execute("INSERT INTO sanitization_sessions (payment_id, started_at) VALUES (1, '2024-03-01 10:01:05')")
+    conn.execute("INSERT INTO ratings (session_id, rating, created_at) VALUES (1, 4, '2024-03-01 02:03:00')")
+    conn.commit()
+    conn.close()
+
+    pool = kiosk.ConnectionPool(path, size=2)
+    monkeypatch.setattr(kiosk, "db_pool", pool)
+    yield pool
+    pool.close_all()
+
+
+def columns(conn, table):
+    return {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def indexes(conn):
+    return {row["name"]: row["sql"] for row in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'")}
+
+
+def test_baseline_database_is_upgraded_to_latest_version(baseline_db):
+    assert kiosk.run_migrations() == (0, kiosk.SCHEMA_VERSION)
+
+    with kiosk.db_connection() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == kiosk.SCHEMA_VERSION
+        assert {"created_ts", "paid_ts", "claimed_ts"} <= columns(conn, "payments")
+        assert {"started_ts", "completed_ts", "failed_ts"} <= columns(conn, "sanitization_sessions")
+        assert "created_ts" in columns(conn, "ratings")
+        assert {"rating_sum", "rating_count"} <= columns(conn, "daily_stats")
+        assert {"owner", "lease_until"} <= columns(conn, "sanitization_jobs")
+        for table in ("hourly_stats", "webhook_inbox", "qrph_images", "phase_events"):
+            assert columns(conn, table), table
+
+        found = indexes(conn)
+        for name in ("idx_payments_created_ts", "idx_payments_status_created_ts", "idx_payments_paymongo_id",
+                     "idx_sessions_started_ts", "idx_ratings_created_ts", "idx_webhook_inbox_due",
+                     "idx_sanitization_jobs_active", "idx_phase_events_started"):
+            assert name in found, name
+        # Replaced by the epoch-column indexes
+        assert "idx_payments_created_at" not in found
+        assert "idx_ratings_created_at" not in found
+        # The amount-only webhook index only covers codes a customer was shown
+        assert "created_ts" in found["idx_payments_pending"]
+        assert "claimed_ts IS NOT NULL" in found["idx_payments_pending"]
+
+        payment = conn.execute("SELECT * FROM payments").fetchone()
+        assert payment["created_ts"] == datetime(2024, 3, 1, 2, 0, tzinfo=timezone.utc).timestamp()
+        assert payment["claimed_ts"] == payment["created_ts"]
+        assert payment["paid_ts"] is not None
+
+        # The rollups are rebuilt from the existing rows
+        hourly = conn.execute("SELECT SUM(payments), SUM(revenue), SUM(rating_4) FROM hourly_stats").fetchone()
+        assert tuple(hourly) == (1, 50, 1)
+        daily = conn.execute("SELECT SUM(total_payments), SUM(rating_count) FROM daily_stats").fetchone()
+        assert tuple(daily) == (1, 1)
+
+    assert kiosk.check_daily_stats() == []
+
+
+def test_migrations_are_idempotent(baseline_db):
+    kiosk.run_migrations()
+
+    assert kiosk.run_migrations() == (kiosk.SCHEMA_VERSION, kiosk.SCHEMA_VERSION)
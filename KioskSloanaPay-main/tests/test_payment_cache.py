@@ -0,0 +1,76 @@
+"""
+PaymentCache: LRU and TTL eviction, and status updates that only move forward.
+"""
+
+import pytest
+
+from conftest import kiosk
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controls time.monotonic as seen by the cache."""
+    now = [1000.0]
+    monkeypatch.setattr(kiosk.time, "monotonic", lambda: now[0])
+    return now
+
+
+def record(reference, status="PENDING", session_id=None):
+    return kiosk.PaymentRecord(reference, int(reference[-1]), status, "QRPH", kiosk.PAYMENT_AMOUNT, session_id)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = kiosk.PaymentCache(maxsize=2, ttl=300)
+    cache.put(record("ref-1"))
+    cache.put(record("ref-2"))
+    assert cache.get("ref-1") is not None
+
+    cache.put(record("ref-3"))
+
+    assert cache.get("ref-2") is None
+    assert cache.get("ref-1").reference == "ref-1"
+    assert cache.get("ref-3").reference == "ref-3"
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size"] == 2
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = kiosk.PaymentCache(maxsize=8, ttl=30)
+    cache.put(record("ref-1"))
+
+    clock[0] += 30
+    assert cache.get("ref-1") is not None
+    clock[0] += 1
+    assert cache.get("ref-1") is None
+    assert cache.stats()["size"] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_put_refreshes_ttl(clock):
+    cache = kiosk.PaymentCache(maxsize=8, ttl=30)
+    cache.put(record("ref-1"))
+
+    clock[0] += 20
+    cache.put(record("ref-1", "PAID", session_id=7))
+    clock[0] += 20
+
+    assert cache.get("ref-1").status == "PAID"
+
+
+@pytest.mark.parametrize("stale", ["PENDING", "FAILED", "EXPIRED"])
+def test_paid_is_not_overwritten_by_a_lower_status(stale):
+    cache = kiosk.PaymentCache(maxsize=8, ttl=300)
+    paid = cache.put(record("ref-1", "PAID", session_id=7))
+
+    assert cache.put(record("ref-1", stale)) is paid
+    assert cache.get("ref-1").status == "PAID"
+    assert cache.get("ref-1").etag == "1-PAID-7"
+
+
+def test_pending_moves_forward():
+    cache = kiosk.PaymentCache(maxsize=8, ttl=300)
+    cache.put(record("ref-1"))
+
+    cache.put(record("ref-1", "EXPIRED"))
+
+    assert cache.get("ref-1").status == "EXPIRED"
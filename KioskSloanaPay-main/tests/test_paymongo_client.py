@@ -0,0 +1,119 @@
+"""
+PayMongoClient against a local stub server: keep-alive, retries, and the
+circuit breaker.
+"""
+
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import kiosk
+
+
+@pytest.fixture
+def stub_server():
+    """A PayMongo stand-in on 127.0.0.1. Answers with the statuses queued in
+    `statuses` (200 once they run out) and counts the requests and client
+    connections it saw."""
+    state = {"statuses": [], "hits": 0, "connections": set()}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def answer(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            state["hits"] += 1
+            state["connections"].add(self.client_address)
+            status = state["statuses"].pop(0) if state["statuses"] else 200
+            body = b'{"data": []}'
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = answer
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["url"] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(url, retries=2, min_calls=5):
+    """A client on its own event loop, so it does not share the app's session."""
+    breaker = kiosk.CircuitBreaker("stub", window=60, min_calls=min_calls, error_rate=0.5, cooldown=30)
+    return kiosk.PayMongoClient(kiosk.AsyncUpstream(), url, {}, breaker, pool_size=1,
+                                retries=retries, backoff=0.01, timeout=(1, 1))
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_requests_share_one_connection(stub_server):
+    client = make_client(stub_server["url"])
+
+    for _ in range(3):
+        assert client.get("/payments").status_code == 200
+
+    assert stub_server["hits"] == 3
+    assert len(stub_server["connections"]) == 1
+    client.upstream.close()
+
+
+def test_get_is_retried_after_5xx(stub_server):
+    stub_server["statuses"] = [503, 502]
+    client = make_client(stub_server["url"])
+
+    response = client.get("/payments")
+
+    assert response.status_code == 200
+    assert stub_server["hits"] == 3
+    client.upstream.close()
+
+
+def test_post_is_not_resent_after_5xx(stub_server):
+    stub_server["statuses"] = [503]
+    client = make_client(stub_server["url"])
+
+    response = client.post("/qrph/generate", json={})
+
+    assert response.status_code == 503
+    assert stub_server["hits"] == 1
+    client.upstream.close()
+
+
+def test_connection_refused_is_retried_then_raises():
+    client = make_client(f"http://127.0.0.1:{closed_port()}", retries=2)
+
+    with pytest.raises(kiosk.UpstreamError, match="PayMongo unreachable"):
+        client.post("/qrph/generate", json={})
+
+    assert client.breaker.stats()["calls"] == 1
+    assert client.breaker.stats()["error_rate"] == 1.0
+    client.upstream.close()
+
+
+def test_breaker_opens_and_fails_fast(stub_server):
+    stub_server["statuses"] = [500] * 3
+    client = make_client(stub_server["url"], retries=0, min_calls=3)
+
+    for _ in range(3):
+        assert client.get("/payments").status_code == 500
+    assert client.breaker.state == kiosk.CircuitBreaker.OPEN
+
+    with pytest.raises(kiosk.CircuitOpenError):
+        client.get("/payments")
+    assert stub_server["hits"] == 3
+    assert client.breaker.stats()["rejected"] == 1
+    client.upstream.close()
@@ -0,0 +1,52 @@
+"""
+The /qr/<ref>.<fmt> endpoint for QRPh codes when the image cache is cold.
+"""
+
+from conftest import kiosk
+
+
+def test_qrph_png_is_reloaded_after_a_restart(db, paymongo):
+    qr = kiosk.generate_qrph_payment()
+    kiosk.qr_images._entries.clear()  # as after a restart or an eviction
+
+    response = kiosk.app.test_client().get(f"/qr/{qr['reference']}.png")
+
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.data == qr["qr_png"]
+    assert kiosk.qr_images.get(qr["reference"], "png") == qr["qr_png"]
+
+
+def test_qrph_svg_is_refused(db, paymongo):
+    qr = kiosk.generate_qrph_payment()
+
+    response = kiosk.app.test_client().get(f"/qr/{qr['reference']}.svg")
+
+    assert response.status_code == 406
+    assert response.get_json()["formats"] == ["png"]
+
+
+def test_unknown_reference_is_404_even_with_an_etag(db):
+    response = kiosk.app.test_client().get(
+        "/qr/helmet-1-unknown.png", headers={"If-None-Match": '"qr-helmet-1-unknown-png"'})
+
+    assert response.status_code == 404
+
+
+def test_known_reference_with_its_etag_is_304(db, paymongo):
+    qr = kiosk.generate_qrph_payment()
+    kiosk.qr_images._entries.clear()
+    etag = '"qr-%s-png"' % qr["reference"]
+
+    response = kiosk.app.test_client().get(f"/qr/{qr['reference']}.png", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+
+
+def test_expired_pooled_code_drops_its_image(db, paymongo):
+    pool = kiosk.QRPhPool(size=0)
+    qr = kiosk.generate_qrph_payment(pooled=True)
+
+    pool._expire(qr)
+
+    assert kiosk.load_qrph_image(qr["payment_id"]) is None
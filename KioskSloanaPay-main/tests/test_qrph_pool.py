@@ -0,0 +1,126 @@
+"""
+QRPhPool with PayMongo stubbed out: handout, expiry, and which pending
+payment an amount-only webhook is allowed to confirm.
+"""
+
+import time
+
+import pytest
+
+from conftest import kiosk
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for condition")
+        time.sleep(0.01)
+
+
+def statuses():
+    with kiosk.db_connection() as conn:
+        return {row["reference"]: (row["status"], row["claimed_ts"]) for row in conn.execute(
+            "SELECT reference, status, claimed_ts FROM payments")}
+
+
+@pytest.fixture
+def pool(db, paymongo, monkeypatch):
+    pool = kiosk.QRPhPool(size=2, max_age=60, retry_seconds=1)
+    monkeypatch.setattr(kiosk, "qrph_pool", pool)
+    yield pool
+    pool.stop()
+
+
+def test_handout_claims_the_code_and_refills(pool, paymongo):
+    pool.start()
+    wait_for(lambda: pool.stats()["size"] == 2)
+
+    response = kiosk.app.test_client().post("/create_payment")
+
+    reference = response.get_json()["reference"]
+    assert reference == paymongo.generated[0]
+    assert statuses()[reference][1] is not None
+    wait_for(lambda: len(paymongo.generated) == 3 and pool.stats()["size"] == 2)
+    assert [ref for ref, (_, claimed) in statuses().items() if claimed is None] == paymongo.generated[1:]
+    assert pool.stats()["hits"] == 1
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(0, ok=False)
+    assert not breaker.available()
+
+
+def test_pooled_code_is_handed_out_while_the_breaker_is_open(pool, paymongo):
+    pool.start()
+    wait_for(lambda: pool.stats()["size"] == 2)
+    open_breaker(paymongo.breaker)
+
+    response = kiosk.app.test_client().post("/create_payment")
+
+    assert response.status_code == 200
+    assert response.get_json()["reference"] == paymongo.generated[0]
+    assert pool.stats()["hits"] == 1
+
+
+def test_miss_is_refused_while_the_breaker_is_open(db, paymongo):
+    open_breaker(paymongo.breaker)
+
+    response = kiosk.app.test_client().post("/create_payment")
+
+    assert response.status_code == 503
+    assert response.get_json()["use_cash"] is True
+    assert paymongo.generated == []
+
+
+def test_amount_only_webhook_confirms_the_code_shown(pool, paymongo):
+    pool.start()
+    wait_for(lambda: pool.stats()["size"] == 2)
+    shown = kiosk.app.test_client().post("/create_payment").get_json()["reference"]
+    wait_for(lambda: len(paymongo.generated) == 3)
+
+    result = kiosk.process_webhook_payment({"data": {"attributes": {
+        "amount": int(kiosk.PAYMENT_AMOUNT * 100), "status": "paid", "description": "QRPh payment"
+    }}})
+
+    assert result["reference"] == shown
+    current = statuses()
+    assert current[shown][0] == "PAID"
+    assert [current[ref][0] for ref in paymongo.generated if ref != shown] == ["PENDING", "PENDING"]
+
+
+def test_reconciler_ignores_unclaimed_codes(pool, paymongo):
+    pool.start()
+    wait_for(lambda: pool.stats()["size"] == 2)
+    paymongo.pay(paymongo.generated[0])
+
+    confirmed = kiosk.PaymentReconciler(interval=0, min_call_spacing=0).sweep()
+
+    assert confirmed == []
+    assert statuses()[paymongo.generated[0]] == ("PENDING", None)
+
+
+def test_aged_codes_are_expired_and_replaced(db, paymongo):
+    pool = kiosk.QRPhPool(size=2, max_age=0.2, retry_seconds=1)
+    pool.start()
+    try:
+        wait_for(lambda: pool.stats()["expired"] >= 2)
+    finally:
+        pool.stop()
+
+    current = statuses()
+    assert current[paymongo.generated[0]][0] == "EXPIRED"
+    assert current[paymongo.generated[1]][0] == "EXPIRED"
+    assert all(status != "PENDING" for status, _ in current.values())
+
+
+def test_unclaimed_codes_from_an_earlier_run_expire_at_start(db, paymongo):
+    leftover = kiosk.generate_qrph_payment(pooled=True)["reference"]
+    shown = kiosk.generate_qrph_payment()["reference"]
+
+    kiosk.QRPhPool(size=0).start()
+
+    current = statuses()
+    assert current[leftover][0] == "EXPIRED"
+    assert current[shown][0] == "PENDING"
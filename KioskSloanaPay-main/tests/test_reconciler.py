@@ -0,0 +1,99 @@
+"""
+PaymentReconciler with PayMongo stubbed out, and how its confirmations reach
+the serving process when it runs as `flask reconcile-payments`.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import kiosk
+from test_qrph_pool import wait_for
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def jobs():
+    with kiosk.db_connection() as conn:
+        return [dict(row) for row in conn.execute(
+            "SELECT id, session_id, status, owner FROM sanitization_jobs ORDER BY id")]
+
+
+def add_running_job(owner, lease_until):
+    with kiosk.db_transaction() as conn:
+        return conn.execute('''
+            INSERT INTO sanitization_jobs (status, start_delay, enqueued_ts, started_ts, owner, lease_until)
+            VALUES ('RUNNING', 0, ?, ?, ?, ?)
+        ''', (kiosk.now_ts(),) * 2 + (owner, lease_until)).lastrowid
+
+
+@pytest.fixture
+def server_queue(db):
+    """A sanitizer queue standing in for the serving process."""
+    queue = kiosk.SanitizerQueue(max_depth=0, watch_interval=0.05, owner="server:1")
+    yield queue
+    queue.stop()
+
+
+def test_missed_payment_is_confirmed_exactly_once(db, paymongo):
+    reference = kiosk.generate_qrph_payment()["reference"]
+    paymongo.pay(reference)
+    reconciler = kiosk.PaymentReconciler(interval=0, min_call_spacing=0)
+
+    assert reconciler.sweep() == [reference]
+    assert reconciler.sweep() == []
+    assert kiosk.process_webhook_payment({"data": {"attributes": {
+        "amount": int(kiosk.PAYMENT_AMOUNT * 100), "status": "paid",
+        "metadata": {"reference_number": reference}
+    }}}) == {"received": True, "already_paid": True}
+
+    assert kiosk.get_payment_by_reference(reference)["status"] == "PAID"
+    assert len(jobs()) == 1
+    assert reconciler.confirmed == 1
+
+
+def test_cli_sweep_does_not_touch_the_servers_jobs(db, paymongo):
+    running = add_running_job("server:1", kiosk.now_ts() + 600)
+    reference = kiosk.generate_qrph_payment()["reference"]
+    paymongo.pay(reference)
+
+    result = kiosk.app.test_cli_runner().invoke(args=["reconcile-payments"])
+
+    assert reference in result.output
+    assert kiosk.sanitizer_queue._thread is None
+    assert [(job["id"], job["status"], job["owner"]) for job in jobs()] == [
+        (running, "RUNNING", "server:1"),
+        (running + 1, "QUEUED", None),
+    ]
+
+
+def test_server_picks_up_a_confirmation_made_elsewhere(server_queue):
+    kiosk.save_payment("helmet-1-abc123", "QRPH", kiosk.PAYMENT_AMOUNT)
+    server_queue.start()
+    assert kiosk.get_payment_status("helmet-1-abc123").status == "PENDING"
+
+    with kiosk.status_waiters.watch("helmet-1-abc123") as changed:
+        subprocess.run(
+            [sys.executable, "-c", "import app; app.confirm_payment('helmet-1-abc123')"],
+            cwd=PROJECT_DIR, env=os.environ, check=True, capture_output=True
+        )
+        assert changed.wait(timeout=5)
+    assert kiosk.get_payment_status("helmet-1-abc123").status == "PAID"
+    wait_for(lambda: jobs()[0]["status"] == "DONE")
+    assert jobs()[0]["owner"] == "server:1"
+
+
+def test_only_expired_leases_are_taken_over(server_queue):
+    now = kiosk.now_ts()
+    live = add_running_job("other:1", now + 10 ** 6)
+    dead = add_running_job("crashed:1", now - 1)
+
+    server_queue.start()
+
+    wait_for(lambda: jobs()[1]["status"] == "DONE")
+    assert [(job["id"], job["status"], job["owner"]) for job in jobs()] == [
+        (live, "RUNNING", "other:1"),
+        (dead, "DONE", "server:1"),
+    ]
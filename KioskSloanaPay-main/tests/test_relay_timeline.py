@@ -0,0 +1,219 @@
+"""
+Relay timeline validation (plan_timeline, parse_timeline, timeline files)
+and cycles run on a VirtualClock.
+"""
+
+import json
+
+import pytest
+
+from conftest import kiosk
+from test_qrph_pool import wait_for
+
+Phase = kiosk.RelayPhase
+
+
+def problems(phases):
+    with pytest.raises(kiosk.TimelineError) as e:
+        kiosk.plan_timeline(phases)
+    return e.value.problems
+
+
+def test_default_timeline_plans():
+    plan = kiosk.plan_timeline(kiosk.DEFAULT_RELAY_TIMELINE)
+
+    assert plan.total == 105
+    assert [(p.name, start, end) for p, start, end in plan.phases] == [
+        ("brush", 0, 20), ("mist", 0, 105), ("solenoid", 20, 25),
+        ("pumps", 25, 45), ("blower", 45, 75), ("uv", 75, 105),
+    ]
+
+
+def test_overlapping_phases_on_one_relay_are_rejected():
+    assert problems([
+        Phase("first", ("brush",), 0, 10, ()),
+        Phase("second", ("brush",), 5, 10, ()),
+    ]) == ["second: relay 'brush' is still on for 'first'"]
+
+
+def test_negative_offset_overlapping_the_same_relay_is_rejected():
+    assert problems([
+        Phase("first", ("uv",), 0, 10, ()),
+        Phase("second", ("uv",), -2, 10, ("first",)),
+    ]) == ["second: relay 'uv' is still on for 'first'"]
+
+
+def test_back_to_back_phases_may_share_a_relay():
+    plan = kiosk.plan_timeline([
+        Phase("first", ("uv",), 0, 10, ()),
+        Phase("second", ("uv",), 0, 10, ("first",)),
+    ])
+
+    # The handover at 10s is one OFF and one ON in the same batch, OFF first
+    assert [(at, state) for at, _, state, _ in plan.events] == [(0, 1), (10, 0), (10, 1), (20, 0)]
+
+
+def test_unknown_relays_and_dependencies_are_rejected():
+    assert problems([
+        Phase("spray", ("sprayer",), 0, 10, ()),
+        Phase("dry", ("blower",), 0, 10, ("wash",)),
+    ]) == ["spray: unknown relay 'sprayer'", "dry: depends on unknown phase 'wash'"]
+
+
+def test_bad_durations_are_rejected():
+    assert problems([
+        Phase("zero", ("brush",), 0, 0, ()),
+        Phase("text", ("uv",), 0, "10", ()),
+        Phase("flag", ("blower",), 0, True, ()),
+        Phase("timed", ("solenoid",), 0, 5, ()),
+    ]) == [f"{name}: duration must be a positive number of seconds or null" for name in ("zero", "text", "flag")]
+
+
+def test_untimed_phases_need_a_timed_one():
+    assert problems([Phase("mist", ("mist1",), 0, None, ())]) == [
+        "timeline needs at least one phase with a duration"
+    ]
+
+
+def test_nothing_may_follow_an_untimed_phase():
+    assert problems([
+        Phase("mist", ("mist1",), 0, None, ()),
+        Phase("uv", ("uv",), 0, 10, ("mist",)),
+    ]) == ["uv: cannot follow 'mist', which runs until the end"]
+
+
+def test_untimed_phase_starting_after_the_cycle_is_rejected():
+    assert problems([
+        Phase("uv", ("uv",), 0, 10, ()),
+        Phase("mist", ("mist1",), 10, None, ()),
+    ]) == ["mist: starts after the last timed phase ends"]
+
+
+def test_dependency_cycles_and_early_starts_are_rejected():
+    assert problems([
+        Phase("a", ("brush",), 0, 5, ("b",)),
+        Phase("b", ("uv",), 0, 5, ("a",)),
+    ]) == ["a: dependency cycle"]
+    assert problems([Phase("uv", ("uv",), -1, 5, ())]) == ["uv: starts 1s before the cycle"]
+
+
+def test_duplicate_names_and_empty_relays_are_rejected():
+    assert problems([
+        Phase("uv", ("uv",), 0, 5, ()),
+        Phase("uv", (), 0, 5, ()),
+    ]) == ["uv: duplicate phase name", "uv: no relays"]
+
+
+def test_parse_timeline_accepts_shorthand():
+    assert kiosk.parse_timeline([
+        {"name": "uv", "duration": 30},
+        {"name": "dry", "relays": ["blower", "brush"], "duration": 10, "after": "uv", "offset": -5},
+    ]) == [
+        Phase("uv", ("uv",), 0, 30, ()),
+        Phase("dry", ("blower", "brush"), -5, 10, ("uv",)),
+    ]
+
+
+@pytest.mark.parametrize("content, problem", [
+    ('{"name": "uv"}', "timeline must be a list of phases"),
+    ('[{"relays": ["uv"], "duration": 5}]', "phase #1: expected an object with a name"),
+    ('[{"name": "uv", "duration": 5}', "invalid JSON"),
+])
+def test_invalid_timeline_files_are_rejected(tmp_path, content, problem):
+    path = tmp_path / "timeline.json"
+    path.write_text(content, encoding="utf-8")
+
+    with pytest.raises(kiosk.TimelineError, match=problem):
+        kiosk.load_relay_timeline(str(path))
+
+
+def test_cli_rejects_an_invalid_timeline_file(tmp_path):
+    path = tmp_path / "timeline.json"
+    path.write_text(json.dumps([{"name": "uv", "relays": ["uv", "laser"], "duration": 5}]), encoding="utf-8")
+
+    result = kiosk.app.test_cli_runner().invoke(args=["relay-timeline", "--file", str(path)])
+
+    assert result.exit_code == 1
+    assert "❌ uv: unknown relay 'laser'" in result.output
+
+
+def test_cli_prints_a_valid_timeline_file(tmp_path):
+    path = tmp_path / "timeline.json"
+    path.write_text(json.dumps([{"name": "uv", "duration": 30}]), encoding="utf-8")
+
+    result = kiosk.app.test_cli_runner().invoke(args=["relay-timeline", "--file", str(path)])
+
+    assert result.exit_code == 0
+    assert "1 phase(s), 30.5s per cycle" in result.output
+
+
+@pytest.fixture
+def switched(monkeypatch):
+    """Records (clock time, {relay: state}) for every batch sent to the relays."""
+    batches = []
+    clock = kiosk.VirtualClock(start=0)
+    apply = kiosk.relay_controller.apply
+
+    def record(changes, force=False):
+        batches.append((clock.time(), dict(changes)))
+        return apply(changes, force)
+
+    monkeypatch.setattr(kiosk.relay_controller, "apply", record)
+    return clock, batches
+
+
+def test_timeline_runs_phases_in_order_on_virtual_time(switched):
+    clock, batches = switched
+    timings = []
+
+    kiosk.run_relay_timeline(kiosk.plan_timeline(kiosk.DEFAULT_RELAY_TIMELINE), clock, timings)
+
+    assert clock.time() == 105
+    assert batches == [
+        (0, {"brush": 1, "mist1": 1, "mist2": 1}),
+        (20, {"brush": 0, "solenoid": 1}),
+        (25, {"solenoid": 0, "pump_left": 1, "pump_middle": 1, "pump_right": 1}),
+        (45, {"pump_left": 0, "pump_middle": 0, "pump_right": 0, "blower": 1}),
+        (75, {"blower": 0, "uv": 1}),
+        (105, {"mist1": 0, "mist2": 0, "uv": 0}),
+    ]
+    # Reported as each phase ends, stamped in real epoch time
+    assert [(t.phase, t.nominal_start, t.nominal_seconds) for t in timings] == [
+        ("brush", 0, 20), ("solenoid", 20, 5), ("pumps", 25, 20),
+        ("blower", 45, 30), ("mist", 0, 105), ("uv", 75, 30),
+    ]
+    assert all(kiosk.now_ts() - 5 <= t.started_ts <= t.ended_ts for t in timings)
+    assert kiosk.relay_controller.stats()["on"] == []
+
+
+def test_relay_sequence_settles_before_the_first_phase(switched):
+    clock, batches = switched
+
+    timings = kiosk.run_payment_relay_sequence(clock=clock)
+
+    assert clock.time() == kiosk.RELAY_SETTLE_SECONDS + kiosk.relay_plan.total
+    first_on = next(at for at, changes in batches if any(changes.values()))
+    assert first_on == kiosk.RELAY_SETTLE_SECONDS
+    assert len(timings) == len(kiosk.relay_plan.phases)
+
+
+def test_queue_measures_cycles_on_its_clock_but_stamps_real_time(db):
+    clock = kiosk.VirtualClock(start=0)
+    queue = kiosk.SanitizerQueue(max_depth=0, clock=clock, watch_interval=0.05, owner="test:1")
+    kiosk.save_payment("helmet-1-virtual", "QRPH", kiosk.PAYMENT_AMOUNT)
+    session_id = kiosk.confirm_payment("helmet-1-virtual", delay_seconds=2).session_id
+    before = kiosk.now_ts()
+
+    queue.start()
+    wait_for(lambda: queue.completed == 1)
+    queue.stop()
+
+    cycle = kiosk.RELAY_SETTLE_SECONDS + kiosk.relay_plan.total
+    assert clock.time() == 2 + cycle
+    with kiosk.db_connection() as conn:
+        session = conn.execute("SELECT * FROM sanitization_sessions WHERE id = ?", (session_id,)).fetchone()
+        job = conn.execute("SELECT * FROM sanitization_jobs").fetchone()
+    assert session["duration"] == round(cycle)
+    for ts in (session["started_ts"], session["completed_ts"], job["enqueued_ts"], job["started_ts"],
+               job["finished_ts"], job["lease_until"]):
+        assert ts >= before - 5
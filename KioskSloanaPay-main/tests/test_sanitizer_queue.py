@@ -0,0 +1,108 @@
+"""
+SanitizerQueue: what a failed relay cycle leaves behind, latency time
+bases, and shutdown.
+"""
+
+import pytest
+
+from conftest import kiosk
+from test_qrph_pool import wait_for
+
+
+@pytest.fixture
+def queue(db):
+    queue = kiosk.SanitizerQueue(max_depth=0, watch_interval=0.05, owner="test:1")
+    yield queue
+    queue.stop()
+
+
+@pytest.fixture
+def broken_relays(monkeypatch):
+    """A relay timeline that finishes one phase and then fails; records the
+    all-off calls."""
+    calls = []
+
+    def run_relay_timeline(plan, clock=None, timings=None):
+        timings.append(kiosk.PhaseTiming("fan", 0, 5, clock.time(), clock.time() + 5))
+        raise RuntimeError("relay board not responding")
+
+    monkeypatch.setattr(kiosk, "run_relay_timeline", run_relay_timeline)
+    monkeypatch.setattr(kiosk, "all_relays_off", lambda force=False: calls.append(force))
+    return calls
+
+
+def confirmed_session():
+    kiosk.save_payment("helmet-1-relay", "QRPH", kiosk.PAYMENT_AMOUNT)
+    return kiosk.confirm_payment("helmet-1-relay", delay_seconds=0).session_id
+
+
+def test_relay_failure_is_reraised_after_an_emergency_shutdown(broken_relays):
+    timings = []
+
+    with pytest.raises(RuntimeError, match="not responding"):
+        kiosk.run_payment_relay_sequence(clock=kiosk.VirtualClock(), timings=timings)
+
+    assert [t.phase for t in timings] == ["fan"]
+    assert broken_relays == [False, True, False]
+
+
+def test_failed_cycle_marks_the_job_and_session_failed(queue, broken_relays):
+    session_id = confirmed_session()
+
+    queue.start()
+
+    wait_for(lambda: queue.failed == 1)
+    with kiosk.db_connection() as conn:
+        job = conn.execute("SELECT status, last_error FROM sanitization_jobs").fetchone()
+        session = conn.execute(
+            "SELECT completed_at, failed_ts FROM sanitization_sessions WHERE id = ?", (session_id,)).fetchone()
+        phases = conn.execute("SELECT phase FROM phase_events").fetchall()
+        sanitized = conn.execute("SELECT SUM(successful_sanitizations) FROM daily_stats").fetchone()[0]
+    assert job["status"] == "FAILED"
+    assert "not responding" in job["last_error"]
+    assert session["completed_at"] is None
+    assert session["failed_ts"] is not None
+    assert [row["phase"] for row in phases] == ["fan"]
+    assert not sanitized
+    assert queue.completed == 0
+    assert kiosk.check_daily_stats() == []
+
+
+def test_completed_cycle_counts_as_successful(queue):
+    session_id = confirmed_session()
+
+    queue.start()
+
+    wait_for(lambda: queue.completed == 1)
+    with kiosk.db_connection() as conn:
+        session = conn.execute(
+            "SELECT completed_at, failed_ts FROM sanitization_sessions WHERE id = ?", (session_id,)).fetchone()
+        sanitized = conn.execute("SELECT SUM(successful_sanitizations) FROM daily_stats").fetchone()[0]
+    assert session["completed_at"] is not None
+    assert session["failed_ts"] is None
+    assert sanitized == 1
+
+
+def test_latency_stages_share_the_real_time_base(db):
+    # Virtual time far from the epoch: a stage mixing the two time bases would be huge
+    queue = kiosk.SanitizerQueue(max_depth=0, clock=kiosk.VirtualClock(start=0), owner="test:1")
+    confirmed_session()
+
+    queue.start()
+    wait_for(lambda: queue.completed == 1)
+    queue.stop()
+
+    latency = kiosk.sanitization_latency(kiosk.now_ts() - 3600)
+    assert latency["cycles"] == 1
+    for stage in kiosk.LATENCY_STAGES:
+        assert 0 <= latency["stages"][stage]["max"] < 60, stage
+    assert [day["date"] for day in latency["daily"]] == [kiosk.local_day(kiosk.now_ts())]
+
+
+def test_stop_joins_the_worker_and_the_watcher(queue):
+    queue.start()
+    threads = [queue._thread, queue._watcher]
+
+    queue.stop()
+
+    assert not any(thread.is_alive() for thread in threads)